@@ -1,57 +1,223 @@
 import sys
 import numpy as np
-import copy
-import matplotlib
-import matplotlib.pyplot as plt
 import logging
 import json
-from scipy.interpolate import make_interp_spline
-from scipy.signal import find_peaks
 import io
 import base64
+import threading
+import time
+import tracemalloc
+import contextlib
+from collections import OrderedDict
 
-matplotlib.use('Agg')
 
+_BLOCK_ROWS = 4096
 
-def importData(file):
+_DROP_REASONS = {1: "Missing Data", 2: "Non-Numerical Entry"}
+_DROP_KEYS = {1: "missing_data", 2: "non_numerical"}
+
+SAMPLE_LINES = 20  # line numbers kept per drop reason
+LOG_LINES = 10  # dropped lines logged individually per recording
+
+
+class ValidationReport:
+    """Counts and samples the lines dropped while reading a recording
+
+    Every dropped line is counted by reason, and the line numbers of the
+    first sampleLimit lines of each reason are kept, so the report stays
+    small however damaged the recording is. Only the first logLimit dropped
+    lines are logged as errors, followed by a single warning that further
+    dropped lines are only counted. A report covers one recording and may be
+    fed in consecutive pieces.
+
+    :param sampleLimit: Number of line numbers kept per reason
+    :param logLimit: Number of dropped lines logged individually
+    """
+
+    def __init__(self, sampleLimit=SAMPLE_LINES, logLimit=LOG_LINES):
+        self.sampleLimit = sampleLimit
+        self.logLimit = logLimit
+        self.rows = 0
+        self.dropped = {key: 0 for key in _DROP_KEYS.values()}
+        self.samples = {key: [] for key in _DROP_KEYS.values()}
+        self._logged = 0
+
+    def add(self, status, firstLine):
+        """Records the status of consecutive lines of the recording
+
+        :param status: numpy array of status codes, 0 for a valid line and a
+        key of _DROP_REASONS for a dropped one
+        :param firstLine: Line number of the first line in the file
+        """
+
+        self.rows += len(status)
+
+        bad = np.flatnonzero(status)
+        if not len(bad):
+            return
+
+        for code, key in _DROP_KEYS.items():
+            lines = bad[status[bad] == code]
+            self.dropped[key] += len(lines)
+            room = self.sampleLimit - len(self.samples[key])
+            self.samples[key].extend((lines[:room] + firstLine).tolist())
+
+        room = self.logLimit - self._logged
+        for i in bad[:max(room, 0)]:
+            logging.error(f"{_DROP_REASONS[status[i]]} on line "
+                          f"{firstLine + i}")
+        if 0 <= room < len(bad):
+            logging.warning("Further dropped lines are only counted in the "
+                            "validation report")
+        self._logged += len(bad)
+
+    def summary(self):
+        """Summarises the report for the metrics dictionary
+
+        :returns: Dictionary containing rows (lines read), valid, dropped
+        (counts by reason) and sample_lines (line numbers by reason)
+        """
+
+        return {"rows": self.rows,
+                "valid": self.rows - sum(self.dropped.values()),
+                "dropped": dict(self.dropped),
+                "sample_lines": {key: list(lines)
+                                 for key, lines in self.samples.items()}}
+
+
+def importData(file, report=None):
     """Read Patient CPAP measurements from txt file
 
-    Iterates through each line if of the input data file. The function skips
-    the first line as it contains information on what information is contained
-    on each line of the txt file. For the rest of the lines, the lines are
-    split into a one dimensional numpy array with the comma deliminator. The
-    new line character is then stripped off at the end of the line and the
-    strings in array are converted to floats. The processed array is then
-    passed into valInput() function to be validated. If the data is valid, the
-    numpy arrays are then appended to the list called data.
+    Logs the start of the analysis and passes the file to loadRecording(),
+    which parses every valid line of the file into one contiguous two
+    dimensional numpy array. Lines that are missing values or contain
+    non-numerical entries are dropped, just as valInput() would reject them.
+    Logging is not configured here; the host process does it once, see
+    cpap_logging.
 
     :param file: filepath for Patient CPAP txt data file
+    :param report: Optional ValidationReport of the dropped lines
 
-    :returns: List containing patient time dependant CPAP metric data
+    :returns: (N, 7) numpy array containing patient time dependant CPAP
+    metric data, one row per valid time point
     """
 
-    logging.basicConfig(filename="cpapAnalyis.log", filemode="w",
-                        level=logging.INFO)
-
     logging.info(f"Starting Analysis of: {file}")
 
-    data = []
+    data, dropped = loadRecording(file, report)
+
+    return data
+
 
-    filepath = file
+def loadRecording(file, report=None):
+    """Bulk loads a Patient CPAP txt file into a two dimensional array
 
-    with open(filepath, "r") as in_file:
+    The first line of the file is skipped as it contains the column names. The
+    rest of the file is read at once, split into lines and handed to
+    parseLines() which converts all of the valid lines in a single pass.
+
+    :param file: filepath for Patient CPAP txt data file
+    :param report: Optional ValidationReport of the dropped lines
+
+    :returns data: (N, 7) float numpy array of the valid time points
+    :returns dropped: Dictionary counting the dropped lines by reason, with
+    the keys missing_data and non_numerical
+    """
+
+    with open(file, "r") as in_file:
 
         in_file.readline()
+        lines = in_file.read().split("\n")
 
-        for line in in_file:
+    if lines[-1] == "":
+        lines.pop()
 
-            split = np.array(line.split(','))
-            split[-1] = split[-1].strip("\n")
+    return parseLines(lines, report, firstLine=2)
 
-            if valInput(split):
-                data.append(np.asfarray(split, dtype=float))
 
-    return data
+def parseLines(lines, report=None, firstLine=1):
+    """Converts lines of comma seperated ADC values into a float array
+
+    The lines are processed in blocks. Lines that do not contain exactly 7
+    values are flagged as missing data. The remaining lines of the block are
+    joined and converted to floats with a single numpy call. If that call
+    fails, the block contains a non-numerical entry and its lines are converted
+    one at a time to find the offending ones. Lines that converted to NaN are
+    checked for a literal "NaN" entry, which valInput() also rejects. The
+    dropped lines are recorded in a ValidationReport, which logs the first few
+    of them with their line numbers.
+
+    :param lines: List of data lines without their new line characters
+    :param report: Optional ValidationReport, a new one is used if None
+    :param firstLine: Line number of the first line in the file
+
+    :returns data: (N, 7) float numpy array of the valid lines
+    :returns dropped: Dictionary counting the dropped lines by reason, with
+    the keys missing_data and non_numerical
+    """
+
+    data = np.empty((len(lines), 7))
+    status = np.zeros(len(lines), dtype=np.int8)
+    n = 0
+
+    for start in range(0, len(lines), _BLOCK_ROWS):
+
+        block = lines[start:start + _BLOCK_ROWS]
+        blockStatus = status[start:start + len(block)]
+
+        complete = np.array([line.count(",") == 6 for line in block],
+                            dtype=bool)
+        blockStatus[~complete] = 1
+        rows = [line for line, ok in zip(block, complete) if ok]
+        idx = np.flatnonzero(complete)
+
+        try:
+            values = np.array(",".join(rows).split(","),
+                              dtype=float).reshape(-1, 7)
+        except ValueError:
+            values, numeric = _parseRowsSlow(rows)
+            blockStatus[idx[~numeric]] = 2
+            idx = idx[numeric]
+            rows = [row for row, ok in zip(rows, numeric) if ok]
+            values = values[numeric]
+
+        for i in np.flatnonzero(np.isnan(values).any(axis=1)):
+            if "NaN" in rows[i].split(","):
+                blockStatus[idx[i]] = 2
+
+        values = values[blockStatus[idx] == 0]
+        data[n:n + len(values)] = values
+        n += len(values)
+
+    if report is None:
+        report = ValidationReport()
+    report.add(status, firstLine)
+
+    dropped = {"missing_data": int(np.count_nonzero(status == 1)),
+               "non_numerical": int(np.count_nonzero(status == 2))}
+
+    return data[:n], dropped
+
+
+def _parseRowsSlow(rows):
+    """Converts rows one at a time, flagging the non-numerical ones
+
+    :param rows: List of data lines that each contain 7 values
+
+    :returns values: (N, 7) float numpy array, rows that failed are left as 0
+    :returns numeric: Boolean numpy array of which rows converted successfully
+    """
+
+    values = np.zeros((len(rows), 7))
+    numeric = np.ones(len(rows), dtype=bool)
+
+    for i, row in enumerate(rows):
+        try:
+            values[i] = [float(x) for x in row.split(",")]
+        except ValueError:
+            numeric[i] = False
+
+    return values, numeric
 
 
 def valInput(dataPoint):
@@ -86,6 +252,25 @@ def valInput(dataPoint):
     return True
 
 
+_ADC_SCALE = (25.4) / (14745 - 1638)  # cm-H2O per ADC count
+_ADC_OFFSET = 1638
+
+_AIR_DENSITY = 1.199  # kg/m^3
+_AREA_1 = np.pi * ((15 / 2) / 1000) ** 2  # m^2, d1 = 15mm
+_AREA_2 = np.pi * ((12 / 2) / 1000) ** 2  # m^2, d2 = 12mm
+_AREA_RATIO_TERM = (_AREA_1 / _AREA_2) ** 2 - 1
+
+VENTURI_COLUMNS = ((1, 2, 3), (4, 5, 6))  # p2, ins and exp of each venturi
+
+RESAMPLE_RATE = .027  # spline points per recorded sample
+PEAK_HEIGHT = .05  # L/sec
+PEAK_PROMINENCE = 0.18  # L/sec
+APNEA_GAP = 10  # seconds between breaths
+MIN_EPOCH = 1.0  # seconds, shortest epoch of epochMetrics()
+INTERVAL_PERCENTILES = (5, 25, 50, 75, 95)
+PLOT_SIZES_KEPT = 4  # renders of other than the default size per DeferredPlot
+
+
 def adcToPressure(raw):
     """Converts ADC Values to Pressure Readings
 
@@ -93,18 +278,36 @@ def adcToPressure(raw):
     is converted to a pressure values of units cm-h20 via the following formula
     Pressure (cm-H2O) = [(25.4) / (14745 - 1638)] * (ADC_value - 1638)
 
-    :param raw: List of numpy arrays containing adc values for each time point
+    The raw data is copied into a two dimensional array and converted by
+    pressureArray(), so the input is left untouched.
+
+    :param raw: (N, 7) array or list of numpy arrays containing adc values for
+    each time point
 
-    :returns: List of numpy arrays containing pressure values for each time
+    :returns: (N, 7) numpy array containing pressure values for each time
     point
     """
 
-    pressures = copy.deepcopy(raw)
+    return pressureArray(np.array(raw, dtype=float), inplace=True)
 
-    for i in range(len(pressures)):
 
-        ptr = pressures[i]
-        ptr[1:] = ((25.4) / (14745 - 1638)) * (ptr[1:] - 1638)
+def pressureArray(adc, inplace=False):
+    """Converts a Two Dimensional Array of ADC Values to Pressures
+
+    Every column but the first (time) column is converted to cm-h20 with a
+    single array operation, using the same formula as adcToPressure(). When
+    inplace is True the input array is overwritten instead of copied, which
+    obtainMetrics() uses since it owns the freshly loaded array.
+
+    :param adc: (N, 7) float numpy array of adc values
+    :param inplace: If True, convert adc itself instead of a copy
+
+    :returns: (N, 7) numpy array containing pressure values for each time
+    point
+    """
+
+    pressures = adc if inplace else adc.copy()
+    pressures[:, 1:] = _ADC_SCALE * (pressures[:, 1:] - _ADC_OFFSET)
 
     return pressures
 
@@ -119,23 +322,20 @@ def calcFlows(p1, p2):
     diameters. The following Equation was used to calculate flow rate
     a1 * np.sqrt((2 / p) * ((p1 - p2) / ((a1 / a2) ** 2 - 1)))
 
+    The areas are computed once at import time, and the pressures may be
+    scalars or numpy arrays of equal shape.
+
     :param p1: upstream pressure in cm-h20
     :param p2: pressue at constriction in cm-h20
 
     :returns: volumetric flow rate in L/sec
     """
 
-    p = 1.199  # kg/m^3
-    d1 = 15  # mm
-    d2 = 12  # mm
-
-    a1 = np.pi * ((d1 / 2) / 1000) ** 2  # m^2
-    a2 = np.pi * ((d2 / 2) / 1000) ** 2  # m^2
-
     p1 = p1 * 98.0665  # pascals
     p2 = p2 * 98.0665  # pascals
 
-    q = a1 * np.sqrt((2 / p) * ((p1 - p2) / ((a1 / a2) ** 2 - 1)))  # m^3/s
+    q = _AREA_1 * np.sqrt((2 / _AIR_DENSITY)
+                          * ((p1 - p2) / _AREA_RATIO_TERM))  # m^3/s
 
     return q * 1000  # L/sec
 
@@ -143,40 +343,87 @@ def calcFlows(p1, p2):
 def flowTimeSeries(pressures):
     """Calculates Flow Rate for Each Time
 
-    The function iterates through the pressures data and for each time point
-    the inspiratory p1 pressure (ins) is compared to expiratory
-    p1 pressure (exp). The time point is appened to the time list (t) and if
-    ins is greater than or equal to exp, the flow is calculated with p1 as ins
-    and p2 as p2. If ins is less than exp, the flow is calculate with p1 as
-    exp and p2 as p2 and is negated to reflect expiration. This calculated flow
-    value is appended to the q list.
+    For each time point the inspiratory p1 pressure (ins) is compared to
+    expiratory p1 pressure (exp). If ins is greater than or equal to exp, the
+    flow is calculated with p1 as ins and p2 as p2. If ins is less than exp,
+    the flow is calculate with p1 as exp and p2 as p2 and is negated to reflect
+    expiration. The work is done by flowArrays() and the results are returned
+    as lists.
 
-    :param pressures: List of numpy arrays containing pressure values within
-    venturi tubes at each time points
+    :param pressures: (N, 7) array or list of numpy arrays containing pressure
+    values within venturi tubes at each time points
 
-    :returns t: list of time values in seconds and q for
+    :returns t: list of time values in seconds
     :returns q: list of flow values in L/sec
+    :returns totalTime: time spanned by the recording in seconds
     """
-    t = []
-    q = []
 
-    for dp in pressures:
+    t, q = flowArrays(np.asarray(pressures, dtype=float))
 
-        ins = dp[2]
-        exp = dp[3]
-        p2 = dp[1]
-        t.append(dp[0])
+    totalTime = t.max() - t.min()
+    return t.tolist(), q.tolist(), totalTime
 
-        if ins >= exp:
-            q.append(calcFlows(ins, p2))
-        else:
-            q.append(-1 * calcFlows(exp, p2))
 
-    totalTime = max(t) - min(t)
-    return t, q, totalTime
+def flowArrays(pressures):
+    """Calculates Flow Rate for Each Time as Whole Columns
 
+    The inspiratory/expiratory comparison of flowTimeSeries() is made for every
+    time point at once by venturiFlow().
+
+    :param pressures: (N, 7) numpy array containing pressure values within
+    venturi tubes at each time points
+
+    :returns t: numpy array of time values in seconds
+    :returns q: numpy array of flow values in L/sec
+    """
+
+    return pressures[:, 0], venturiFlow(pressures[:, 1], pressures[:, 2],
+                                        pressures[:, 3])
+
+
+def channelFlows(pressures, columns=VENTURI_COLUMNS):
+    """Calculates Flow Rate for Each Time in Every Venturi
+
+    The pressure columns of all venturis are gathered into one (C, 3, N)
+    array and passed to venturiFlow() together, so every venturi is computed
+    in a single vectorized pass. The first row equals the flow of
+    flowArrays().
+
+    :param pressures: (N, 7) numpy array containing pressure values within
+    venturi tubes at each time points
+    :param columns: p2, ins and exp column indices of each venturi
 
-def findPeaks(x, y):
+    :returns t: numpy array of time values in seconds
+    :returns q: (C, N) numpy array of flow values in L/sec, one row per
+    venturi
+    """
+
+    p = pressures[:, np.array(columns)].transpose(1, 2, 0)
+    return pressures[:, 0], venturiFlow(p[:, 0], p[:, 1], p[:, 2])
+
+
+def venturiFlow(p2, ins, exp):
+    """Calculates the Signed Flow of One Venturi from its Pressure Columns
+
+    The larger of the two upstream pressures is passed to calcFlows() with the
+    constriction pressure in a single call, and the flows of the expiratory
+    time points are negated.
+
+    :param p2: numpy array of constriction pressures in cm-h20
+    :param ins: numpy array of inspiratory upstream pressures in cm-h20
+    :param exp: numpy array of expiratory upstream pressures in cm-h20
+
+    :returns: numpy array of flow values in L/sec
+    """
+
+    inspiring = ins >= exp
+    q = calcFlows(np.where(inspiring, ins, exp), p2)
+    q[~inspiring] *= -1
+
+    return q
+
+
+def findPeaks(x, y, plot="png", engine="spline", profile=None):
     """Obtains Peaks from a CPAP signal
 
     The lists x and y are converted into numpy arrays and a spline is applied
@@ -184,38 +431,392 @@ def findPeaks(x, y):
     scipy algorithm was applied with a height limit of .05 and a width of 2 to
     obtain the indixes of the peaks. The times and values of the peaks are
     returned as lists. Additionally the data with a smoothed curve and peaks
-    marked is saved as curveFitting.png to perform quality control.
+    marked is rendered as a PNG to perform quality control.
+
+    The plot argument controls the rendering. With "png" the plot is rendered
+    and base64 encoded right away, with "deferred" a DeferredPlot is returned
+    that renders only when asked to, and with None no plot is made and
+    matplotlib is never imported. The engine argument selects the smoothing
+    used by smoothPeaks(). Rendering is timed as the plot stage of profile.
 
     :param x: time array
     :param y: volumetric flow rate array
+    :param plot: "png", "deferred" or None
+    :param engine: Name of the smoothing engine, see SMOOTHING_ENGINES
+    :param profile: Optional StageProfile
 
     :returns: list of times of peak occurences
+    :returns: encoded plot string, DeferredPlot or None depending on plot
     """
 
-    x = np.array(x)
-    y = np.array(y)
-    X_Y_Spline = make_interp_spline(x, y)
-    X_ = np.linspace(x.min(), x.max(), int(len(x) * .027))
-    Y_ = X_Y_Spline(X_)
-    peaks, _ = find_peaks(Y_, .05, prominence=0.18)
+    X_, Y_, peaks = smoothPeaks(x, y, engine, profile=profile)
+
+    if plot is None:
+        return (X_[peaks], None)
+
+    deferred = DeferredPlot(X_, Y_, peaks)
+    if plot == "deferred":
+        return (X_[peaks], deferred)
+
+    with profileStage(profile, "plot") as record:
+        encodedPlot = deferred.encoded()
+        record["rows"] = len(X_)
+
+    return (X_[peaks], encodedPlot)
 
-    plt.plot(X_, Y_)
-    plt.plot(X_[peaks], Y_[peaks], 'x', c='black', markersize=4)
-    plt.xlabel("Time (Seconds)")
-    plt.ylabel("Flow (Liters/ Second)")
-    plt.plot(np.zeros_like(X_), "--", color="gray")
 
-    plt.xlim(min(x), max(x))
+def smoothPeaks(x, y, engine="spline", step=None, profile=None):
+    """Smooths a CPAP signal and locates its peaks
+
+    This is the metric half of findPeaks(). The signal is smoothed with one of
+    the SMOOTHING_ENGINES and sampled at RESAMPLE_RATE points per recorded
+    sample, or every step seconds if a step is given. scipy find_peaks is
+    then applied with the PEAK_HEIGHT and PEAK_PROMINENCE limits. The two
+    steps are timed as the smoothing and peaks stages of profile.
+
+    :param x: time array
+    :param y: volumetric flow rate array
+    :param engine: Name of the smoothing engine, see SMOOTHING_ENGINES
+    :param step: Optional time between smoothed points in seconds
+    :param profile: Optional StageProfile
+
+    :returns X_: numpy array of smoothed time values
+    :returns Y_: numpy array of smoothed flow values
+    :returns peaks: numpy array of the indices of the peaks in X_ and Y_
+    """
+
+    x = np.asarray(x)
+    y = np.asarray(y)
+
+    with profileStage(profile, "smoothing") as record:
+        if step is None:
+            X_ = np.linspace(x.min(), x.max(), int(len(x) * RESAMPLE_RATE))
+        else:
+            X_ = np.arange(x.min(), x.max() + step / 2, step)
+
+        Y_ = SMOOTHING_ENGINES[engine](x, y, X_)
+        record["rows"] = len(X_)
+
+    with profileStage(profile, "peaks") as record:
+        from scipy.signal import find_peaks
+        peaks, _ = find_peaks(Y_, PEAK_HEIGHT, prominence=PEAK_PROMINENCE)
+        record["rows"] = len(peaks)
+
+    return X_, Y_, peaks
+
+
+def splineSmooth(x, y, X_):
+    """Evaluates one interpolating spline through the whole signal
+
+    This is the original findPeaks() behaviour. The fit involves every
+    sample, so the whole recording has to be in memory.
+
+    :param x: increasing time array
+    :param y: volumetric flow rate array
+    :param X_: time values at which to evaluate the spline
+
+    :returns: numpy array of smoothed flow values at X_
+    """
+
+    from scipy.interpolate import make_interp_spline
+
+    return make_interp_spline(x, y)(X_)
+
+
+def sectionedSplineSmooth(x, y, X_, overlap=64, block=1024):
+    """Evaluates the interpolating spline one section at a time
+
+    X_ is split into blocks of points. Each block is evaluated on a spline
+    fitted only to the samples it spans plus overlap samples on either side.
+    The influence of a sample on a cubic interpolating spline decays by a
+    factor of about 0.27 per sample, so with the default overlap the result
+    matches splineSmooth() to within floating point precision, and the peak
+    times are the same. The work is linear in the number of samples and only
+    one section is fitted at a time, which is how BreathTracker handles
+    chunked input.
+
+    :param x: increasing time array
+    :param y: volumetric flow rate array
+    :param X_: increasing time values at which to evaluate the spline
+    :param overlap: Number of samples added on each side of a section
+    :param block: Number of points of X_ evaluated per section
+
+    :returns: numpy array of smoothed flow values at X_
+    """
+
+    from scipy.interpolate import make_interp_spline
+
+    Y_ = np.empty(len(X_))
+    bounds = np.searchsorted(x, X_)
+
+    for start in range(0, len(X_), block):
+        stop = min(start + block, len(X_))
+        lo = max(bounds[start] - overlap, 0)
+        hi = min(bounds[stop - 1] + overlap, len(x))
+        spline = make_interp_spline(x[lo:hi], y[lo:hi])
+        Y_[start:stop] = spline(X_[start:stop])
+
+    return Y_
+
+
+def savgolSmooth(x, y, X_, window=15, polyorder=3):
+    """Smooths the signal with a Savitzky-Golay filter before resampling
+
+    The filter is a short FIR filter applied at the recorded sample rate, so
+    it runs in linear time and a chunk only needs window samples of overlap.
+    The filtered signal is linearly interpolated at X_. Unlike the spline
+    engines it also removes sample noise, so peak heights are slightly lower.
+    On recordings sampled at 100 Hz the detected breaths are the same as with
+    splineSmooth() and their times differ by at most one resampling step.
+
+    :param x: increasing time array
+    :param y: volumetric flow rate array
+    :param X_: time values at which to sample the filtered signal
+    :param window: Filter length in samples
+    :param polyorder: Order of the fitted polynomials
+
+    :returns: numpy array of smoothed flow values at X_
+    """
+
+    from scipy.signal import savgol_filter
+
+    if len(y) <= window:
+        return np.interp(X_, x, y)
+
+    return np.interp(X_, x, savgol_filter(y, window, polyorder))
+
+
+SMOOTHING_ENGINES = {"spline": splineSmooth,
+                     "sectioned": sectionedSplineSmooth,
+                     "savgol": savgolSmooth}
+
+
+def renderPlot(X_, Y_, peaks, size=None):
+    """Renders the smoothed flow curve with its peaks marked
+
+    The plot is drawn on this thread's figure template from plotTemplate(),
+    rather than through the pyplot state machine, so analyses running in
+    parallel threads render independently of each other. Only the data and
+    limits are updated for each plot.
+
+    Before plotting, the curve is reduced by envelope() to two points per
+    pixel column of the axes, which looks the same at that resolution but
+    is much cheaper to rasterize. The peaks are always kept, so every breath
+    marker stays on the curve.
+
+    :param X_: numpy array of smoothed time values
+    :param Y_: numpy array of smoothed flow values
+    :param peaks: numpy array of the indices of the peaks
+    :param size: Optional (width, height) of the image in pixels, defaults to
+    the matplotlib figure size
+
+    :returns: base64 encoded PNG image string
+    """
+
+    template = plotTemplate()
+
+    template.peaks.set_data(X_[peaks], Y_[peaks])
+    template.zero.set_data([0, len(X_) - 1], [0, 0])
+    template.flow.set_data(X_, Y_)
+
+    template.ax.relim()
+    template.ax.autoscale_view()
+    template.ax.set_xlim(X_.min(), X_.max())
+    template.resize(size)
+
+    keep = envelope(Y_, template.axesWidth(), peaks)
+    template.flow.set_data(X_[keep], Y_[keep])
 
     buff = io.BytesIO()
-    plt.savefig(buff, format='png')
-    buff.seek(0)
+    template.canvas.print_png(buff)
 
-    encodedPlot = base64.b64encode(buff.read()).decode('utf-8')
+    return base64.b64encode(buff.getvalue()).decode('utf-8')
 
-    plt.clf()
 
-    return (X_[peaks], encodedPlot)
+def envelope(y, width, keep=()):
+    """Selects the samples of a signal that preserve its min/max envelope
+
+    The signal is divided into width equal runs of samples and the minimum
+    and maximum of every run are kept, in their original order, along with
+    the first and last sample. Drawn at width pixels, the selected samples
+    cover exactly the same pixels as the full signal.
+
+    :param y: numpy array of signal values
+    :param width: Number of runs, usually the plot width in pixels
+    :param keep: Indices that must be part of the selection
+
+    :returns: Sorted numpy array of the indices of the selected samples
+    """
+
+    n = len(y)
+    width = max(int(width), 1)
+
+    if n <= 2 * width:
+        return np.arange(n)
+
+    run = -(-n // width)
+    padded = np.concatenate((y, np.full(run * width - n, y[-1])))
+    runs = padded.reshape(width, run)
+    starts = np.arange(width) * run
+
+    lows = starts + runs.argmin(axis=1)
+    highs = starts + runs.argmax(axis=1)
+
+    selected = np.concatenate(([0, n - 1], lows, highs,
+                               np.asarray(keep, dtype=int)))
+
+    return np.unique(np.minimum(selected, n - 1))
+
+
+_plotTemplates = threading.local()
+
+
+class PlotTemplate:
+    """Pre-configured flow plot that is reused for every rendering
+
+    The Figure is attached directly to an Agg canvas and its axes, labels and
+    line artists are created once. matplotlib is only imported when the first
+    template is built.
+    """
+
+    def __init__(self):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self.figure = Figure()
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot()
+
+        self.flow, = self.ax.plot([], [])
+        self.peaks, = self.ax.plot([], [], 'x', c='black', markersize=4)
+        self.zero, = self.ax.plot([], [], "--", color="gray")
+
+        self.ax.set_xlabel("Time (Seconds)")
+        self.ax.set_ylabel("Flow (Liters/ Second)")
+
+        self.defaultSize = tuple(self.figure.get_size_inches())
+        params = self.figure.subplotpars
+        self.defaultMargins = {"left": params.left, "right": params.right,
+                               "bottom": params.bottom, "top": params.top}
+        self.size = None
+
+    def resize(self, size=None):
+        """Sets the image size in pixels, None restoring the default size
+
+        Other sizes get a tight layout so that the labels stay inside small
+        images.
+        """
+
+        size = None if size is None else tuple(size)
+        if size == self.size:
+            return
+
+        if size is None:
+            self.figure.set_size_inches(self.defaultSize)
+            self.figure.subplots_adjust(**self.defaultMargins)
+        else:
+            dpi = self.figure.get_dpi()
+            self.figure.set_size_inches(size[0] / dpi, size[1] / dpi)
+            self.figure.tight_layout()
+
+        self.size = size
+
+    def axesWidth(self):
+        """Width of the plotting area in pixels"""
+
+        return self.ax.get_position().width * self.figure.bbox.width
+
+
+def plotTemplate():
+    """Returns the PlotTemplate of the calling thread, creating it if needed
+
+    :returns: PlotTemplate owned by the current thread
+    """
+
+    template = getattr(_plotTemplates, "template", None)
+
+    if template is None:
+        template = PlotTemplate()
+        _plotTemplates.template = template
+
+    return template
+
+
+def prewarm(background=True):
+    """Loads scipy and the matplotlib Agg backend ahead of the first analysis
+
+    scipy and matplotlib are only imported by the functions that use them,
+    so importing this module stays cheap. A host process that expects to
+    analyze recordings, such as the server or the patient GUI, can call
+    prewarm() at startup so that the first analysis does not pay for the
+    imports. The result cache module is loaded as well.
+
+    :param background: True to import in a daemon thread
+
+    :returns: The started thread, or None when not in the background
+    """
+
+    def load():
+        import cpap_cache
+        import scipy.interpolate
+        import scipy.signal
+        import matplotlib.figure
+        import matplotlib.backends.backend_agg
+
+    if not background:
+        load()
+        return None
+
+    thread = threading.Thread(target=load, name="cpap-prewarm", daemon=True)
+    thread.start()
+    return thread
+
+
+class DeferredPlot:
+    """Flow plot that is only rendered when it is first requested
+
+    Holds on to the smoothed curve and peak indices produced by smoothPeaks(),
+    which are a small fraction of the size of the recording, and renders them
+    with renderPlot() the first time encoded() is called. The render at the
+    default size is kept so later calls are free, and so are the renders at
+    the PLOT_SIZES_KEPT most recently requested other sizes, so that clients
+    asking for many sizes cannot make a plot grow without limit.
+
+    :param X_: numpy array of smoothed time values
+    :param Y_: numpy array of smoothed flow values
+    :param peaks: numpy array of the indices of the peaks
+    """
+
+    def __init__(self, X_, Y_, peaks):
+        self.X_ = X_
+        self.Y_ = Y_
+        self.peaks = peaks
+        self._encoded = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def rendered(self):
+        """True once the plot has been rendered at any size"""
+        return bool(self._encoded)
+
+    def encoded(self, size=None):
+        """Returns the base64 encoded PNG, rendering it if needed
+
+        :param size: Optional (width, height) of the image in pixels
+        """
+        key = None if size is None else tuple(size)
+        with self._lock:
+            if key in self._encoded:
+                self._encoded.move_to_end(key)
+                return self._encoded[key]
+
+        encoded = renderPlot(self.X_, self.Y_, self.peaks, size)
+        with self._lock:
+            self._encoded[key] = encoded
+            sized = [other for other in self._encoded if other is not None]
+            for other in sized[:-PLOT_SIZES_KEPT]:
+                del self._encoded[other]
+        return encoded
 
 
 def breathAnalysis(t_breaths, tRecorded):
@@ -224,11 +825,10 @@ def breathAnalysis(t_breaths, tRecorded):
     The number of breaths is calculated by taking the length of the t_breaths
     array. The breaths per minute is calculated by dividing the number of
     breaths by the total recording time which is taken in as a parameter and
-    coverted to minutes. To calculate the number of apnea events, there is a
-    for loop that iterates every element in the t_breaths array to detect if
-    the time between breaths is >10 seconds. If it is, the apnea counter is
-    incremented. The number of breaths, breath per minute, and number of apnea
-    events are returned.
+    coverted to minutes. To calculate the number of apnea events, the
+    intervals between consecutive breaths are computed with np.diff and the
+    intervals longer than APNEA_GAP (10 seconds) are counted. The number of
+    breaths, breath per minute, and number of apnea events are returned.
 
     :param t_breaths: Array of times where a breath occured
     :param tRecorded: The total length of time of the breading test recording
@@ -243,17 +843,129 @@ def breathAnalysis(t_breaths, tRecorded):
 
     bpm = numBreaths / tRecorded_min
 
-    apnea_ctr = 0
+    intervals = np.diff(np.asarray(t_breaths, dtype=float))
+    apnea_ctr = int(np.count_nonzero(intervals > APNEA_GAP))
 
-    for i in range(len(t_breaths) - 1):
+    return numBreaths, bpm, apnea_ctr
 
-        j = i + 1
 
-        if t_breaths[j] > t_breaths[i] + 10:
+def breathStatistics(t_breaths, tRecorded, percentiles=INTERVAL_PERCENTILES):
+    """Obtains inter-breath interval and apnea event statistics
 
-            apnea_ctr = apnea_ctr + 1
+    The inter-breath intervals are the differences between consecutive breath
+    times. Every interval longer than APNEA_GAP is an apnea event starting at
+    the breath before the gap and ending at the breath after it, the rule
+    used by breathAnalysis(). The apnea index is the number of apnea events
+    per hour of recording, in the manner of the apnea-hypopnea index. All of
+    it is computed with array operations in a single pass over the breaths.
 
-    return numBreaths, bpm, apnea_ctr
+    :param t_breaths: Array of times where a breath occured
+    :param tRecorded: The total length of time of the breading test recording
+    :param percentiles: Percentiles of the intervals to report
+
+    :returns: Dictionary containing intervals (numpy array of inter-breath
+    intervals in seconds), apnea_start, apnea_end and apnea_duration (numpy
+    arrays with one value per apnea event), apnea_index (events per hour) and
+    interval_percentiles (dictionary keyed by "p<percentile>", values None
+    when there are fewer than two breaths)
+    """
+
+    t_breaths = np.asarray(t_breaths, dtype=float)
+    intervals = np.diff(t_breaths)
+    apneas = np.flatnonzero(intervals > APNEA_GAP)
+
+    if len(intervals):
+        values = np.percentile(intervals, percentiles).tolist()
+    else:
+        values = [None] * len(percentiles)
+
+    return {"intervals": intervals,
+            "apnea_start": t_breaths[apneas],
+            "apnea_end": t_breaths[apneas + 1],
+            "apnea_duration": intervals[apneas],
+            "apnea_index": len(apneas) / (tRecorded / 3600),
+            "interval_percentiles": {f"p{p:g}": value for p, value
+                                     in zip(percentiles, values)}}
+
+
+def apneaEvents(statistics):
+    """Lists the apnea events of breathStatistics() as dictionaries
+
+    :param statistics: Dictionary returned by breathStatistics()
+
+    :returns: List of dictionaries with start, end and duration in seconds
+    """
+
+    return [{"start": start, "end": end, "duration": duration}
+            for start, end, duration in zip(
+                statistics["apnea_start"].tolist(),
+                statistics["apnea_end"].tolist(),
+                statistics["apnea_duration"].tolist())]
+
+
+def epochMetrics(t, f, t_breaths, epoch=30.0):
+    """Computes breath, apnea and leakage metrics per fixed time window
+
+    The recording is cut into consecutive epochs of epoch seconds starting at
+    its first sample, the last one being cut short by the end of the
+    recording. Breaths are assigned to the epoch they occur in, and apnea
+    events, as defined by breathAnalysis(), to the epoch in which they start.
+    The leakage of an epoch is the trapezoid integral of the flow over the
+    sample intervals starting in it, so the epochs add up to calc_leakage().
+    Every metric is computed for all epochs at once with np.bincount, in one
+    pass over the samples and one over the breaths.
+
+    :param t: numpy array of time values in seconds
+    :param f: numpy array of flow values in L/sec
+    :param t_breaths: Array of times where a breath occured
+    :param epoch: Length of an epoch in seconds, at least MIN_EPOCH
+
+    :returns: Dictionary containing epoch (the epoch length) and the numpy
+    arrays start, breaths, breath_rate_bpm, apnea_count and leakage with one
+    value per epoch
+
+    :raises ValueError: if epoch is shorter than MIN_EPOCH, which would
+    allocate arrays of one value per epoch out of proportion to the recording
+    """
+
+    if not epoch >= MIN_EPOCH:
+        raise ValueError("epoch must be at least {} seconds, not {}"
+                         .format(MIN_EPOCH, epoch))
+
+    t = np.asarray(t, dtype=float)
+    f = np.asarray(f, dtype=float)
+    t_breaths = np.asarray(t_breaths, dtype=float)
+
+    tStart = t.min()
+    tEnd = t.max()
+    numEpochs = max(int(np.ceil((tEnd - tStart) / epoch)), 1)
+
+    def epochIndex(times):
+        index = ((times - tStart) // epoch).astype(int)
+        return np.clip(index, 0, numEpochs - 1)
+
+    start = tStart + epoch * np.arange(numEpochs)
+    length = np.minimum(start + epoch, tEnd) - start
+
+    breaths = np.bincount(epochIndex(t_breaths), minlength=numEpochs)
+
+    intervals = np.diff(t_breaths)
+    apneaStart = t_breaths[:-1][intervals > APNEA_GAP]
+    apneas = np.bincount(epochIndex(apneaStart), minlength=numEpochs)
+
+    areas = np.diff(t) * (f[1:] + f[:-1]) / 2
+    leakage = np.bincount(epochIndex(t[:-1]), weights=areas,
+                          minlength=numEpochs)
+
+    bpm = np.divide(breaths, length / 60, out=np.zeros(numEpochs),
+                    where=length > 0)
+
+    return {"epoch": epoch,
+            "start": start,
+            "breaths": breaths,
+            "breath_rate_bpm": bpm,
+            "apnea_count": apneas,
+            "leakage": leakage}
 
 
 def calc_leakage(t, f):
@@ -269,8 +981,8 @@ def calc_leakage(t, f):
 
     :returns: Leakage in Liters
     """
-    t_arr = np.array(t)
-    f_arr = np.array(f)
+    t_arr = np.asarray(t)
+    f_arr = np.asarray(f)
 
     leakage = np.trapz(f_arr, t_arr)
 
@@ -280,7 +992,223 @@ def calc_leakage(t, f):
     return leakage
 
 
-def obtainMetrics(file):
+def venturiMetrics(t, q, engine="spline", t_breaths=None):
+    """Collects the breath and leakage metrics of one venturi
+
+    :param t: numpy array of time values in seconds
+    :param q: numpy array of flow values of the venturi in L/sec
+    :param engine: Name of the smoothing engine, see SMOOTHING_ENGINES
+    :param t_breaths: Breath times if already known, otherwise they are
+    found with findPeaks()
+
+    :returns: Dictionary containing breaths, breath_rate_bpm, apnea_count,
+    apnea_index and leakage
+    """
+
+    if t_breaths is None:
+        t_breaths, noPlot = findPeaks(t, q, plot=None, engine=engine)
+
+    duration = t.max() - t.min()
+    numBreaths, bpm, apnea_ctr = breathAnalysis(t_breaths, duration)
+    statistics = breathStatistics(t_breaths, duration)
+
+    return {"breaths": numBreaths,
+            "breath_rate_bpm": bpm,
+            "apnea_count": apnea_ctr,
+            "apnea_index": statistics["apnea_index"],
+            "leakage": calc_leakage(t, q)}
+
+
+class _Tracing:
+    """Shares tracemalloc between the stages measured at the same time
+
+    tracemalloc is global to the process, so the stages of analyses running
+    in other threads must not stop it while a stage is still measuring.
+    Each stage acquires a token before reading the traced memory and
+    releases it after, and tracing is only stopped when the last token is
+    released, and only if it was started here. A token is marked shared
+    when another stage measured during its lifetime, as its memory then
+    includes the other stage's allocations.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = []
+        self.started = False
+
+    def acquire(self):
+        """Starts tracing if needed and returns the token of a stage
+
+        The token records whether tracing was started for this stage, if it
+        was shared and the traced memory when it was acquired.
+        """
+
+        with self.lock:
+            if not self.tokens and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started = True
+            token = {"started": len(self.tokens) == 0 and self.started,
+                     "shared": bool(self.tokens)}
+            for other in self.tokens:
+                other["shared"] = True
+            self.tokens.append(token)
+            token["before"] = tracemalloc.get_traced_memory()[0]
+            return token
+
+    def release(self, token):
+        """Releases a token, stopping tracing after the last one
+
+        :returns: current and peak traced memory when the token was released
+        """
+
+        with self.lock:
+            current, peak = tracemalloc.get_traced_memory()
+            self.tokens.remove(token)
+            if not self.tokens and self.started:
+                tracemalloc.stop()
+                self.started = False
+            return current, peak
+
+
+_tracing = _Tracing()
+
+
+class StageProfile:
+    """Per-stage timings, row counts and memory deltas of an analysis
+
+    Each stage of obtainMetrics() runs inside stage(), which records the
+    stage name, the seconds it took and the number of rows it produced. With
+    memory set, tracemalloc also measures memory_bytes, the memory the stage
+    allocated and kept, and peak_bytes, its highest allocation. Tracing slows
+    the stages down, so it is off by default. Tracing is shared with the
+    stages of analyses profiled at the same time in other threads and with
+    whoever else started it, and peak_bytes is only set when tracing was
+    started for the stage alone. Records are kept in stages and passed to
+    the callback as each stage completes.
+
+    :param callback: Optional function called with each record dictionary
+    :param memory: True to measure memory with tracemalloc
+    """
+
+    def __init__(self, callback=None, memory=False):
+        self.callback = callback
+        self.memory = memory
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager timing one stage
+
+        The record dictionary is yielded so that the stage can fill in rows.
+        """
+
+        record = {"stage": name, "seconds": None, "rows": None,
+                  "memory_bytes": None, "peak_bytes": None}
+
+        token = _tracing.acquire() if self.memory else None
+
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            if token is not None:
+                current, peak = _tracing.release(token)
+                record["memory_bytes"] = current - token["before"]
+                if token["started"] and not token["shared"]:
+                    record["peak_bytes"] = peak - token["before"]
+            self.stages.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
+
+def profileStage(profile, name):
+    """Times a stage with profile, or does nothing when profile is None
+
+    :param profile: StageProfile or None
+    :param name: Name of the stage
+
+    :returns: Context manager yielding the record dictionary of the stage
+    """
+
+    if profile is None:
+        return contextlib.nullcontext({})
+    return profile.stage(name)
+
+
+def logStage(record):
+    """StageProfile callback logging each stage record at info level
+
+    :param record: Record dictionary of a completed stage
+    """
+
+    logging.info("Stage {stage}: {seconds:.4f} s, {rows} rows, "
+                 "{memory_bytes} bytes".format(**record))
+
+
+def recordingFlows(file, profile=None, report=None, channels=False):
+    """Loads a recording in either format and computes its flow series
+
+    Binary recordings written by cpap_binary are memory mapped, and their ADC
+    columns are converted to pressure and flow directly, with no parsing.
+    Any other file is read as a txt recording by importData(). Only the first
+    venturi is computed unless channels is True.
+
+    :param file: filename of a txt or binary recording
+    :param profile: Optional StageProfile
+    :param report: Optional ValidationReport of the dropped lines
+    :param channels: True for the flow of every venturi
+
+    :returns t: numpy array of time values in seconds
+    :returns q: numpy array of flow values in L/sec, or with channels a
+    (C, N) array with one row per venturi
+    """
+
+    from cpap_binary import isBinaryRecording, binaryFlows
+
+    if isBinaryRecording(file):
+        logging.info(f"Starting Analysis of: {file}")
+        with profileStage(profile, "binary") as record:
+            t, q = binaryFlows(file, channels)
+            record["rows"] = len(t)
+        if report is not None:
+            report.rows += len(t)
+        return t, q
+
+    with profileStage(profile, "parse") as record:
+        adc = importData(file, report)
+        record["rows"] = len(adc)
+
+    with profileStage(profile, "pressure") as record:
+        pressures = pressureArray(adc, inplace=True)
+        record["rows"] = len(pressures)
+
+    with profileStage(profile, "flow") as record:
+        if channels:
+            t, q = channelFlows(pressures)
+        else:
+            t, q = flowArrays(pressures)
+        record["rows"] = len(t)
+
+    return t, q
+
+
+def adcColumnToPressure(adc):
+    """Converts one column of ADC values to pressures in cm-h20
+
+    Uses the formula of adcToPressure(). Integer columns are converted to
+    float before the offset is subtracted.
+
+    :param adc: numpy array of adc values
+
+    :returns: float numpy array of pressures
+    """
+
+    return _ADC_SCALE * (np.asarray(adc, dtype=float) - _ADC_OFFSET)
+
+
+def obtainMetrics(file, plot="png", engine="spline", epoch=None,
+                  profile=None, channels=False):
     """Computes Patient Name and Collects CPAP Metrics
 
     This function is essentially a driver function. The patient name is
@@ -291,35 +1219,104 @@ def obtainMetrics(file):
     computed. The findPeaks algorithm then takes in the time and flow array to
     identify peaks and return the times of peak occurences. The breath analysis
     code returns the number of breaths, breaths per minute, and number of apnea
-    events given the t array of peak occurences and the recording time range.
+    events given the t array of peak occurences and the recording time range,
+    and breathStatistics() adds the apnea events, the apnea index and the
+    inter-breath interval percentiles.
     The leakage is calculated with the time and flow data. All these metrics
     are compiled and stored in a dictionary variable called metrics. The
-    patient name, and metrics dictionary is returned
+    patient name, and metrics dictionary is returned. The file may also be a
+    binary recording written by cpap_binary, see recordingFlows().
+
+    The plot argument is passed on to findPeaks(). When it is "deferred" the
+    DeferredPlot is stored under the plot key and encoded_plot is None, so
+    callers that only need the numbers never pay for rendering. The engine
+    argument selects the smoothing engine of findPeaks(). When an epoch length
+    is given, the metrics of every epoch computed by epochMetrics() are added
+    under the epochs key as lists. The lines dropped while reading the file
+    are summarised by a ValidationReport under the validation key. With
+    channels set, the flow of every venturi is computed and the metrics of
+    each, see venturiMetrics(), are listed under the venturis key. All other
+    metrics describe the first venturi.
+
+    The profile argument turns on per-stage profiling. It may be True, a
+    callback such as logStage() that receives every stage record, or a
+    StageProfile. The stage records are then added under the profile key.
+    When it is None, profiling costs a few empty context managers.
 
     :param file: filename of data that needs to be analyzed
+    :param plot: "png", "deferred" or None
+    :param engine: Name of the smoothing engine, see SMOOTHING_ENGINES
+    :param epoch: Optional epoch length in seconds
+    :param profile: None, True, a callback or a StageProfile
+    :param channels: True to add the metrics of every venturi
 
     :returns patient_file_results: Results Output File Path for Patient
     :returns metrics: Dictionary of CPAP measurements for patient. Includes
-    duration, breaths, breath_rate_bp, breath_times, apnea_count, and leakage
+    duration, breaths, breath_rate_bp, breath_times, apnea_count,
+    apnea_events, apnea_index, interval_percentiles, leakage, validation,
+    encoded_plot and, for deferred plots, plot and, with an epoch length,
+    epochs and, when profiling, profile and, with channels, venturis
     """
 
     patient_file_results = ""
 
-    adc = importData(file)
-    pressures = adcToPressure(adc)
-    t, f, range = flowTimeSeries(pressures)
-    tPeaks, encodedPlot = findPeaks(t, f)
-    numBreaths, bpm, apnea_ctr = breathAnalysis(tPeaks, range)
-    leakage = calc_leakage(t, f)
+    if profile is True:
+        profile = StageProfile()
+    elif profile is False:
+        profile = None
+    elif callable(profile):
+        profile = StageProfile(profile)
+
+    report = ValidationReport()
+    t, f = recordingFlows(file, profile, report, channels)
+    if channels:
+        flows, f = f, f[0]
+    range = t.max() - t.min()
+    tPeaks, encodedPlot = findPeaks(t, f, plot=plot, engine=engine,
+                                    profile=profile)
+
+    with profileStage(profile, "breaths") as record:
+        numBreaths, bpm, apnea_ctr = breathAnalysis(tPeaks, range)
+        statistics = breathStatistics(tPeaks, range)
+        record["rows"] = numBreaths
+
+    with profileStage(profile, "leakage") as record:
+        leakage = calc_leakage(t, f)
+        record["rows"] = len(t)
 
     metrics = {"duration": range,
                "breaths": numBreaths,
                "breath_rate_bpm": bpm,
                "breath_times": tPeaks.tolist(),
                "apnea_count": apnea_ctr,
+               "apnea_events": apneaEvents(statistics),
+               "apnea_index": statistics["apnea_index"],
+               "interval_percentiles": statistics["interval_percentiles"],
                "leakage": leakage,
+               "validation": report.summary(),
                "encoded_plot": encodedPlot}
 
+    if epoch is not None:
+        with profileStage(profile, "epochs") as record:
+            epochs = epochMetrics(t, f, tPeaks, epoch)
+            record["rows"] = len(epochs["start"])
+        metrics["epochs"] = {key: np.asarray(value).tolist()
+                             for key, value in epochs.items()}
+
+    if channels:
+        with profileStage(profile, "venturis") as record:
+            metrics["venturis"] = [venturiMetrics(t, f, engine, tPeaks)]
+            metrics["venturis"] += [venturiMetrics(t, q, engine)
+                                    for q in flows[1:]]
+            record["rows"] = len(flows)
+
+    if profile is not None:
+        metrics["profile"] = profile.stages
+
+    if plot == "deferred":
+        metrics["plot"] = encodedPlot
+        metrics["encoded_plot"] = None
+
     return patient_file_results, metrics
 
 
@@ -0,0 +1,236 @@
+"""
+Batch analysis of a folder of CPAP recordings
+
+Recordings are analyzed with cpap_analyze.obtainMetrics in a pool of worker
+processes. Example, writing one JSON file per recording plus a summary CSV:
+
+    python3 cpap_batch.py sample_data --output results --combined results.csv
+"""
+
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from cpap_analyze import obtainMetrics, outputResults
+from cpap_binary import BINARY_SUFFIX
+
+RECORDING_PATTERNS = ("*.txt", "*" + BINARY_SUFFIX)
+SUMMARY_FIELDS = ("file", "ok", "seconds", "duration", "breaths",
+                  "breath_rate_bpm", "apnea_count", "leakage", "error")
+
+
+def findRecordings(paths, patterns=RECORDING_PATTERNS):
+    """
+    Expands directories and glob patterns into a list of recording files
+
+    Directories contribute every file matching one of patterns, by default
+    txt and binary recordings, glob patterns every file they match, and
+    plain file paths are kept as they are. Duplicates are removed and the
+    list is sorted. A txt recording converted by cpap_binary is left out
+    when its binary twin, with the same name and the BINARY_SUFFIX
+    extension, is also found, so that the recording is analyzed once and
+    only one <recording name>.json is written for it.
+
+    Args:
+        paths (list): directories, glob patterns or file paths
+        patterns (tuple): file patterns used inside directories
+
+    Returns:
+        list: sorted recording file paths
+    """
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in patterns:
+                files.update(glob.glob(os.path.join(path, pattern)))
+        elif glob.has_magic(path):
+            files.update(glob.glob(path))
+        else:
+            files.add(path)
+    converted = {os.path.splitext(file)[0] for file in files
+                 if file.endswith(BINARY_SUFFIX)}
+    return sorted(file for file in files
+                  if not (file.endswith(".txt") and
+                          os.path.splitext(file)[0] in converted))
+
+
+def analyzeFile(file, output_dir=None, plot=False, engine="spline"):
+    """
+    Analyzes one recording and reports how long it took
+
+    This function runs in the worker processes. Any exception raised by the
+    analysis is caught and reported in the returned summary so that one bad
+    recording does not stop the batch. If output_dir is given, the metrics
+    are also written to <output_dir>/<recording name>.json by outputResults.
+
+    Args:
+        file (str): recording file path
+        output_dir (str/None): directory for the per-file JSON results
+        plot (bool): True to render and keep the encoded plot
+        engine (str): smoothing engine passed to obtainMetrics
+
+    Returns:
+        dict: summary with the file, ok, seconds and error keys, plus the
+              metrics when the analysis succeeded
+    """
+    start = time.perf_counter()
+    try:
+        placeholder, metrics = obtainMetrics(file,
+                                             plot="png" if plot else None,
+                                             engine=engine)
+    except Exception as e:
+        return {"file": file, "ok": False,
+                "seconds": time.perf_counter() - start,
+                "error": f"{type(e).__name__}: {e}"}
+
+    if output_dir:
+        name = os.path.splitext(os.path.basename(file))[0] + ".json"
+        outputResults(os.path.join(output_dir, name), metrics)
+
+    return {"file": file, "ok": True,
+            "seconds": time.perf_counter() - start,
+            "error": None, "metrics": metrics}
+
+
+def batchAnalyze(files, workers=None, output_dir=None, plot=False,
+                 engine="spline", progress=None):
+    """
+    Analyzes recordings in parallel worker processes
+
+    Every file is submitted to a ProcessPoolExecutor as a separate task so
+    the pool stays busy when recordings differ in length. Results are
+    returned in the order of files.
+
+    Args:
+        files (list): recording file paths
+        workers (int/None): number of processes, defaults to the CPU count
+        output_dir (str/None): directory for the per-file JSON results
+        plot (bool): True to render and keep the encoded plots
+        engine (str): smoothing engine passed to obtainMetrics
+        progress (callable/None): called with each summary as it completes
+
+    Returns:
+        list: one summary dictionary per file, see analyzeFile
+    """
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(analyzeFile, file, output_dir, plot,
+                               engine): file for file in files}
+        for future in as_completed(futures):
+            summary = future.result()
+            results[futures[future]] = summary
+            if progress is not None:
+                progress(summary)
+
+    return [results[file] for file in files]
+
+
+def summaryRow(summary):
+    """
+    Flattens a summary into one row of SUMMARY_FIELDS values
+
+    Args:
+        summary (dict): summary returned by analyzeFile
+
+    Returns:
+        dict: values keyed by SUMMARY_FIELDS
+    """
+    row = {key: summary.get(key) for key in ("file", "ok", "seconds",
+                                             "error")}
+    metrics = summary.get("metrics", {})
+    for key in SUMMARY_FIELDS:
+        if key not in row:
+            row[key] = metrics.get(key)
+    return row
+
+
+def writeCombined(results, output_file):
+    """
+    Writes the summaries of a batch to a single JSON or CSV file
+
+    The format is chosen from the file extension. The CSV holds one row of
+    SUMMARY_FIELDS per recording, while the JSON holds the full summaries
+    including the metrics.
+
+    Args:
+        results (list): summaries returned by batchAnalyze
+        output_file (str): path ending in .json or .csv
+
+    Returns:
+        None
+    """
+    if output_file.lower().endswith(".csv"):
+        with open(output_file, "w", newline="") as out_file:
+            writer = csv.DictWriter(out_file, fieldnames=SUMMARY_FIELDS)
+            writer.writeheader()
+            for summary in results:
+                writer.writerow(summaryRow(summary))
+    else:
+        with open(output_file, "w") as out_file:
+            json.dump(results, out_file, indent=2)
+
+
+def main(argv=None):
+    """
+    Command line entry point for batch analysis
+
+    Prints the time taken by every recording as it completes, followed by
+    the failures and the total time.
+
+    Args:
+        argv (list/None): command line arguments, defaults to sys.argv
+
+    Returns:
+        int: 0 if every recording was analyzed, 1 otherwise
+    """
+    parser = argparse.ArgumentParser(
+        description="Analyze a folder of CPAP recordings in parallel")
+    parser.add_argument("paths", nargs="+",
+                        help="recording files, directories or glob patterns")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of worker processes (default: CPUs)")
+    parser.add_argument("-o", "--output", default=None,
+                        help="directory for one JSON result per recording")
+    parser.add_argument("-c", "--combined", default=None,
+                        help="single .json or .csv file for all results")
+    parser.add_argument("--plot", action="store_true",
+                        help="render the flow plot of every recording")
+    parser.add_argument("--engine", default="spline",
+                        help="smoothing engine used to find breaths")
+    args = parser.parse_args(argv)
+
+    files = findRecordings(args.paths)
+    if not files:
+        print("No recordings found")
+        return 1
+
+    def report(summary):
+        status = "ok" if summary["ok"] else "FAILED"
+        print(f"{summary['seconds']:8.2f} s  {status:6}  {summary['file']}")
+
+    start = time.perf_counter()
+    results = batchAnalyze(files, args.workers, args.output, args.plot,
+                           args.engine, progress=report)
+    elapsed = time.perf_counter() - start
+
+    if args.combined:
+        writeCombined(results, args.combined)
+
+    failures = [summary for summary in results if not summary["ok"]]
+    for summary in failures:
+        print(f"{summary['file']}: {summary['error']}")
+    print(f"{len(files) - len(failures)}/{len(files)} recordings analyzed "
+          f"in {elapsed:.2f} s")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,497 @@
+"""
+Benchmarks of the CPAP analysis pipeline on synthetic recordings
+
+Recordings of the requested durations are generated in the 7-column ADC text
+format of the CPAP machine, and every stage of obtainMetrics is timed on
+them. Peak memory of each stage is measured in a separate pass under
+tracemalloc so that tracing does not distort the timings. Results are written
+as JSON and can be compared against an earlier run, for example:
+
+    python3 cpap_bench.py --sizes 1m 10m 1h --output bench_new.json \\
+        --compare bench_old.json
+
+With --startup the cold start of the server and the GUI clients is timed
+too, each imported in fresh interpreters.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import scipy
+import cpap_analyze
+from cpap_analyze import (loadRecording, pressureArray, flowArrays,
+                          smoothPeaks, DeferredPlot, breathAnalysis,
+                          breathStatistics, calc_leakage, obtainMetrics)
+
+SAMPLE_RATE = 100  # rows per second written by the CPAP machine
+HEADER = "Time,p2,ins,exp,p2b,insb,expb"
+SIZES = ("1m", "10m", "1h")
+STARTUP_MODULES = ("cpap_server", "patient_client",
+                   "monitoring_station_client")
+REGRESSION = 1.25  # slowdown ratio reported as a regression
+NOISE_FLOOR = 0.002  # seconds of slowdown too small to report
+
+_PRESSURE_ADC = 5000  # constriction pressure of about 8 cm-h20
+_BLOCK_SECONDS = 600
+_UNITS = {"s": 1, "m": 60, "h": 3600}
+
+
+def parseDuration(text):
+    """
+    Converts a duration such as 90s, 10m or 12h into seconds
+
+    Args:
+        text (str): number followed by s, m or h, or a plain number of seconds
+
+    Returns:
+        float: duration in seconds
+    """
+    text = str(text).strip().lower()
+    if text and text[-1] in _UNITS:
+        return float(text[:-1]) * _UNITS[text[-1]]
+    return float(text)
+
+
+def apneaIntervals(duration, apneaRate, rng, length=(12, 25)):
+    """
+    Chooses non-overlapping apnea intervals for a synthetic recording
+
+    Args:
+        duration (float): recording length in seconds
+        apneaRate (float): apnea events per hour
+        rng (numpy.random.Generator): random number source
+        length (tuple): shortest and longest apnea in seconds
+
+    Returns:
+        list: sorted (start, end) tuples in seconds
+    """
+    count = int(round(apneaRate * duration / 3600))
+    intervals = []
+    for attempt in range(100 * count):
+        if len(intervals) == count:
+            break
+        start = rng.uniform(0, max(duration - length[1], 0))
+        end = start + rng.uniform(*length)
+        if all(end + 5 < other[0] or start > other[1] + 5
+               for other in intervals):
+            intervals.append((start, end))
+    return sorted(intervals)
+
+
+def syntheticRows(t, bpm, apneas, amplitude, rng):
+    """
+    Builds the integer ADC columns of a block of a synthetic recording
+
+    The flow follows a sine wave at bpm breaths per minute with a little
+    jitter in its phase and amplitude, and is zero during apneas. The
+    pressure difference over the venturi is placed on the inspiratory or the
+    expiratory column depending on the direction of the flow, expiration
+    being a little weaker to give the positive leakage of a mask. The second
+    venturi sees the same breathing at a slightly different gain.
+
+    Args:
+        t (numpy.ndarray): sample times in seconds
+        bpm (float): breaths per minute
+        apneas (list): (start, end) apnea intervals in seconds
+        amplitude (float): peak pressure difference in ADC counts
+        rng (numpy.random.Generator): random number source
+
+    Returns:
+        numpy.ndarray: (N, 6) integer array of ADC values
+    """
+    phase = 2 * np.pi * bpm / 60 * t + 0.2 * np.sin(2 * np.pi * t / 97)
+    s = np.sin(phase) * (1 + 0.1 * np.sin(2 * np.pi * t / 41))
+    for start, end in apneas:
+        s[(t >= start) & (t < end)] = 0
+
+    rows = np.empty((len(t), 6), dtype=np.int64)
+    for offset, gain in ((0, 1.0), (3, 0.9)):
+        dp = gain * amplitude * s ** 2 + rng.normal(0, 0.3, len(t))
+        rows[:, offset] = _PRESSURE_ADC
+        rows[:, offset + 1] = np.rint(_PRESSURE_ADC +
+                                      np.where(s > 0, dp, 0))
+        rows[:, offset + 2] = np.rint(_PRESSURE_ADC +
+                                      np.where(s < 0, 0.8 * dp, 0))
+    return rows
+
+
+def generateRecording(file, duration=600, bpm=15, apneaRate=5,
+                      corruption=0.0, amplitude=36, seed=0):
+    """
+    Writes a synthetic recording in the CPAP machine's text format
+
+    The file has a header line followed by one line per sample at
+    SAMPLE_RATE rows per second: the time with two decimals and six integer
+    ADC values. A fraction corruption of the lines is damaged, half of them
+    losing their last value and half getting a non-numerical entry, so that
+    importData() drops them. The recording is written in blocks so memory
+    stays small for long durations.
+
+    Args:
+        file (str): path of the recording to write
+        duration (float): recording length in seconds
+        bpm (float): breaths per minute
+        apneaRate (float): apnea events per hour
+        corruption (float): fraction of damaged lines between 0 and 1
+        amplitude (float): peak pressure difference in ADC counts
+        seed (int): seed of the random number generator
+
+    Returns:
+        dict: the rows written and the numbers of damaged lines, keyed like
+              the dropped line counts of loadRecording(), plus the apnea
+              intervals
+    """
+    rng = np.random.default_rng(seed)
+    apneas = apneaIntervals(duration, apneaRate, rng)
+    numRows = int(round(duration * SAMPLE_RATE))
+    summary = {"rows": numRows, "missing_data": 0, "non_numerical": 0,
+               "apneas": apneas}
+
+    with open(file, "w") as out_file:
+        out_file.write(HEADER + "\n")
+        blockRows = _BLOCK_SECONDS * SAMPLE_RATE
+        for first in range(0, numRows, blockRows):
+            index = np.arange(first, min(first + blockRows, numRows))
+            t = index / SAMPLE_RATE
+            rows = syntheticRows(t, bpm, apneas, amplitude, rng)
+            lines = ["{:.2f},{},{},{},{},{},{}".format(time, *row)
+                     for time, row in zip(t, rows.tolist())]
+            damaged = np.flatnonzero(rng.random(len(lines)) < corruption)
+            for i in damaged:
+                if rng.random() < 0.5:
+                    lines[i] = lines[i].rsplit(",", 1)[0]
+                    summary["missing_data"] += 1
+                else:
+                    lines[i] = lines[i].replace(",", ",x", 1)
+                    summary["non_numerical"] += 1
+            out_file.write("\n".join(lines) + "\n")
+
+    return summary
+
+
+def _stages(file, engine):
+    """
+    Yields the pipeline stages of obtainMetrics as (name, callable) pairs
+
+    Each callable runs one stage on the output of the previous ones, so the
+    stages can be timed separately. The last stage is the whole of
+    obtainMetrics for reference.
+    """
+    state = {}
+
+    def load():
+        state["data"], state["dropped"] = loadRecording(file)
+
+    def pressure():
+        state["pressures"] = pressureArray(state["data"])
+
+    def flow():
+        state["t"], state["q"] = flowArrays(state["pressures"])
+
+    def peaks():
+        state["smoothed"] = smoothPeaks(state["t"], state["q"], engine)
+
+    def render():
+        DeferredPlot(*state["smoothed"]).encoded()
+
+    def breaths():
+        X_, Y_, peaks = state["smoothed"]
+        t = state["t"]
+        breathAnalysis(X_[peaks], t.max() - t.min())
+        breathStatistics(X_[peaks], t.max() - t.min())
+
+    def leakage():
+        calc_leakage(state["t"], state["q"])
+
+    def metrics():
+        obtainMetrics(file, plot="png", engine=engine)
+
+    yield from (("loadRecording", load), ("pressureArray", pressure),
+                ("flowArrays", flow), ("smoothPeaks", peaks),
+                ("renderPlot", render), ("breathAnalysis", breaths),
+                ("calc_leakage", leakage), ("obtainMetrics", metrics))
+
+
+def benchmarkFile(file, repeat=3, engine="spline", memory=True):
+    """
+    Times every stage of the pipeline on one recording
+
+    All stages are run once untimed, so that imports and the plot template
+    are set up, then each stage is run repeat times and the fastest run is
+    kept. When memory is True the stages are run once more under tracemalloc
+    to record the peak memory allocated by each of them, numpy arrays
+    included.
+
+    Args:
+        file (str): recording file path
+        repeat (int): number of timed runs per stage
+        engine (str): smoothing engine passed to the peak finder
+        memory (bool): False to skip the memory pass
+
+    Returns:
+        dict: per stage dictionaries with seconds and peak_bytes
+    """
+    for name, stage in _stages(file, engine):
+        stage()
+
+    stages = {}
+    for run in range(repeat):
+        for name, stage in _stages(file, engine):
+            start = time.perf_counter()
+            stage()
+            seconds = time.perf_counter() - start
+            best = stages.setdefault(name, {"seconds": seconds,
+                                            "peak_bytes": None})
+            best["seconds"] = min(best["seconds"], seconds)
+
+    if memory:
+        for name, stage in _stages(file, engine):
+            tracemalloc.start()
+            try:
+                stage()
+                stages[name]["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+    return stages
+
+
+def startupTimes(modules=STARTUP_MODULES, repeat=5):
+    """
+    Measures the cold start of the server and the clients
+
+    Each module is imported in a fresh interpreter repeat times, so nothing
+    is shared with this process or between runs. The time includes starting
+    the interpreter, which is measured separately as "python".
+
+    Args:
+        modules (iterable): names of the modules to import
+        repeat (int): number of fresh interpreters per module
+
+    Returns:
+        dict: per module dictionaries with the fastest seconds, the median
+              seconds and the error output of a failed import
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for module in ("python",) + tuple(modules):
+        code = "pass" if module == "python" else f"import {module}"
+        times = []
+        error = None
+        for run in range(repeat):
+            start = time.perf_counter()
+            process = subprocess.run([sys.executable, "-c", code], cwd=here,
+                                     capture_output=True, text=True)
+            times.append(time.perf_counter() - start)
+            if process.returncode:
+                error = [line for line in process.stderr.splitlines()
+                         if line and not line[0].isspace()][-1]
+                break
+        results[module] = {"seconds": min(times),
+                           "median": statistics.median(times),
+                           "error": error}
+    return results
+
+
+def environment():
+    """
+    Describes the machine and library versions a benchmark ran on
+
+    Returns:
+        dict: python, numpy, scipy, platform and processor descriptions
+    """
+    return {"python": platform.python_version(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+            "cpus": os.cpu_count()}
+
+
+def runBenchmarks(sizes=SIZES, repeat=3, engine="spline", memory=True,
+                  directory=None, progress=None, **recording):
+    """
+    Generates a recording of every size and benchmarks the pipeline on it
+
+    Args:
+        sizes (iterable): durations understood by parseDuration
+        repeat (int): number of timed runs per stage
+        engine (str): smoothing engine passed to the peak finder
+        memory (bool): False to skip the memory pass
+        directory (str/None): where the recordings are written, defaults to
+                              a temporary directory removed afterwards
+        progress (callable/None): called with each result as it completes
+        recording: further generateRecording options, such as bpm,
+                   apneaRate and corruption
+
+    Returns:
+        dict: environment, parameters and one result per size
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as temp:
+        for size in sizes:
+            duration = parseDuration(size)
+            file = os.path.join(directory or temp, f"synthetic_{size}.txt")
+            summary = generateRecording(file, duration, **recording)
+            result = {"size": size,
+                      "duration": duration,
+                      "rows": summary["rows"],
+                      "file_bytes": os.path.getsize(file),
+                      "stages": benchmarkFile(file, repeat, engine, memory)}
+            results.append(result)
+            if progress is not None:
+                progress(result)
+
+    parameters = dict(recording, repeat=repeat, engine=engine,
+                      resample_rate=cpap_analyze.RESAMPLE_RATE)
+    return {"created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "environment": environment(),
+            "parameters": parameters,
+            "results": results}
+
+
+def compareResults(new, old, threshold=REGRESSION, floor=NOISE_FLOOR):
+    """
+    Compares two benchmark runs stage by stage
+
+    Only sizes and stages present in both runs are compared, the startup
+    times of the modules being compared as the stages of size "startup" when
+    both runs measured them. A stage counts
+    as a regression when it is more than threshold times slower and the
+    slowdown is more than floor seconds, so that timer noise on the fastest
+    stages is not reported.
+
+    Args:
+        new (dict): benchmark run returned by runBenchmarks
+        old (dict): earlier benchmark run
+        threshold (float): slowdown ratio counted as a regression
+        floor (float): smallest slowdown in seconds counted as a regression
+
+    Returns:
+        list: dictionaries with size, stage, old and new seconds, ratio and
+              regression for every common stage
+    """
+    previous = {result["size"]: result["stages"] for result in old["results"]}
+    newResults = list(new["results"])
+    if "startup" in new and "startup" in old:
+        previous["startup"] = old["startup"]
+        newResults.append({"size": "startup", "stages": new["startup"]})
+
+    comparison = []
+    for result in newResults:
+        stages = previous.get(result["size"], {})
+        for stage, timing in result["stages"].items():
+            if stage not in stages:
+                continue
+            oldSeconds = stages[stage]["seconds"]
+            ratio = timing["seconds"] / oldSeconds if oldSeconds else np.inf
+            comparison.append({"size": result["size"], "stage": stage,
+                               "old": oldSeconds, "new": timing["seconds"],
+                               "ratio": ratio,
+                               "regression": (ratio > threshold and
+                                              timing["seconds"] - oldSeconds
+                                              > floor)})
+    return comparison
+
+
+def formatResult(result):
+    """
+    Formats the stages of one benchmark result as a text table
+
+    Args:
+        result (dict): one entry of the results of runBenchmarks
+
+    Returns:
+        str: table with one line per stage
+    """
+    lines = [f"{result['size']} ({result['rows']} rows, "
+             f"{result['file_bytes'] / 2 ** 20:.1f} MiB)"]
+    for stage, timing in result["stages"].items():
+        peak = timing["peak_bytes"]
+        peak = "" if peak is None else f"{peak / 2 ** 20:10.1f} MiB"
+        lines.append(f"  {stage:16} {timing['seconds']:10.4f} s {peak}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    """
+    Command line entry point for the benchmarks
+
+    Args:
+        argv (list/None): command line arguments, defaults to sys.argv
+
+    Returns:
+        int: 1 if a comparison found a regression, 0 otherwise
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the CPAP analysis pipeline")
+    parser.add_argument("--sizes", nargs="*", default=list(SIZES),
+                        help="recording durations such as 90s, 10m or 12h")
+    parser.add_argument("--startup", action="store_true",
+                        help="also time the cold start of server and clients")
+    parser.add_argument("--bpm", type=float, default=15,
+                        help="breaths per minute")
+    parser.add_argument("--apnea-rate", type=float, default=5,
+                        help="apnea events per hour")
+    parser.add_argument("--corruption", type=float, default=0.001,
+                        help="fraction of damaged lines")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timed runs per stage, the fastest is kept")
+    parser.add_argument("--engine", default="spline",
+                        help="smoothing engine used to find breaths")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the tracemalloc peak memory pass")
+    parser.add_argument("--keep", default=None,
+                        help="directory in which to keep the recordings")
+    parser.add_argument("-o", "--output", default=None,
+                        help="JSON file for the results")
+    parser.add_argument("--compare", default=None,
+                        help="earlier JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=REGRESSION,
+                        help="slowdown ratio reported as a regression")
+    args = parser.parse_args(argv)
+
+    if args.keep:
+        os.makedirs(args.keep, exist_ok=True)
+
+    run = runBenchmarks(args.sizes, args.repeat, args.engine,
+                        not args.no_memory, args.keep,
+                        progress=lambda result: print(formatResult(result)),
+                        bpm=args.bpm, apneaRate=args.apnea_rate,
+                        corruption=args.corruption)
+
+    if args.startup:
+        run["startup"] = startupTimes(repeat=args.repeat)
+        for module, timing in run["startup"].items():
+            status = timing["error"] or ""
+            print(f"  {module:26} {timing['seconds']:10.4f} s {status}")
+
+    if args.output:
+        with open(args.output, "w") as out_file:
+            json.dump(run, out_file, indent=2)
+
+    if not args.compare:
+        return 0
+
+    with open(args.compare, "r") as in_file:
+        old = json.load(in_file)
+
+    comparison = compareResults(run, old, args.threshold)
+    for row in comparison:
+        flag = "REGRESSION" if row["regression"] else ""
+        print(f"{row['size']:>6} {row['stage']:16} {row['old']:10.4f} s -> "
+              f"{row['new']:10.4f} s  x{row['ratio']:5.2f} {flag}")
+
+    return 1 if any(row["regression"] for row in comparison) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+"""
+Compact binary columnar format for CPAP recordings
+
+Layout, all little endian:
+
+    header   magic b"CPAPCOL1", version <u2, number of columns <u2,
+             4 reserved bytes, number of rows <u8
+    columns  one entry per column: numpy dtype string S8, byte offset <u8
+    data     each column stored contiguously at its offset, 64 byte aligned
+
+The time column is stored as float64. ADC columns holding only whole numbers
+between 0 and 65535 are stored as uint16, any other column as float64. A
+recording converted from txt is therefore about 1.8 times smaller, 2.0 kB
+instead of 3.7 kB per second of a 100 Hz recording, and loading it is a
+memory map with no parsing. Convert a recording with:
+
+    python3 cpap_binary.py sample_data/patient_01.txt
+"""
+
+import sys
+import os
+import numpy as np
+from cpap_analyze import (loadRecording, adcColumnToPressure, venturiFlow,
+                          VENTURI_COLUMNS)
+
+MAGIC = b"CPAPCOL1"
+VERSION = 1
+BINARY_SUFFIX = ".cpap"
+
+_HEADER = np.dtype([("magic", "S8"), ("version", "<u2"),
+                    ("columns", "<u2"), ("reserved", "<u4"),
+                    ("rows", "<u8")])
+_COLUMN = np.dtype([("dtype", "S8"), ("offset", "<u8")])
+_ALIGN = 64
+
+
+def isBinaryRecording(file):
+    """Checks whether a file starts with the binary recording magic
+
+    :param file: filepath of a recording
+
+    :returns: True for binary recordings, False otherwise
+    """
+
+    try:
+        with open(file, "rb") as in_file:
+            return in_file.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def columnDtype(values, time=False):
+    """Chooses the narrowest lossless storage type for a column
+
+    :param values: float numpy array of column values
+    :param time: True for the time column, which is always float64
+
+    :returns: numpy dtype
+    """
+
+    if (not time and len(values)
+            and np.all(values == np.round(values))
+            and values.min() >= 0 and values.max() <= 65535):
+        return np.dtype("<u2")
+    return np.dtype("<f8")
+
+
+def writeBinary(data, file):
+    """Writes an (N, 7) array of adc values as a binary recording
+
+    :param data: (N, C) float numpy array, the first column being time
+    :param file: filepath of the binary recording to write
+
+    :returns: None
+    """
+
+    rows, columns = data.shape
+    dtypes = [columnDtype(data[:, i], i == 0) for i in range(columns)]
+
+    offset = _HEADER.itemsize + columns * _COLUMN.itemsize
+    table = np.zeros(columns, dtype=_COLUMN)
+    for i, dtype in enumerate(dtypes):
+        offset += -offset % _ALIGN
+        table[i] = (dtype.str.encode("ascii"), offset)
+        offset += rows * dtype.itemsize
+
+    header = np.array([(MAGIC, VERSION, columns, 0, rows)], dtype=_HEADER)
+
+    with open(file, "wb") as out_file:
+        out_file.write(header.tobytes())
+        out_file.write(table.tobytes())
+        for i, dtype in enumerate(dtypes):
+            out_file.write(b"\0" * (int(table[i]["offset"]) -
+                                    out_file.tell()))
+            out_file.write(data[:, i].astype(dtype).tobytes())
+
+
+def convertRecording(txtFile, binFile=None):
+    """Converts a txt recording into a binary recording
+
+    The txt file is read with loadRecording(), so invalid lines are dropped
+    exactly as in importData().
+
+    :param txtFile: filepath of the txt recording
+    :param binFile: filepath of the binary recording, defaults to the txt
+    filepath with the BINARY_SUFFIX extension
+
+    :returns binFile: filepath of the binary recording
+    :returns dropped: Dictionary counting the dropped lines by reason
+    """
+
+    if binFile is None:
+        binFile = os.path.splitext(txtFile)[0] + BINARY_SUFFIX
+
+    data, dropped = loadRecording(txtFile)
+    writeBinary(data, binFile)
+
+    return binFile, dropped
+
+
+def loadBinary(file):
+    """Memory maps the columns of a binary recording
+
+    No data is read or copied, pages are loaded by the operating system as
+    the columns are used.
+
+    :param file: filepath of the binary recording
+
+    :returns: List of read-only numpy memmaps, one per column
+    """
+
+    header = np.fromfile(file, dtype=_HEADER, count=1)[0]
+    if header["magic"] != MAGIC:
+        raise ValueError(f"{file} is not a binary CPAP recording")
+    if header["version"] != VERSION:
+        raise ValueError(f"{file} has unsupported version "
+                         f"{header['version']}")
+
+    rows = int(header["rows"])
+    table = np.fromfile(file, dtype=_COLUMN, count=int(header["columns"]),
+                        offset=_HEADER.itemsize)
+
+    return [np.memmap(file, dtype=np.dtype(entry["dtype"].decode("ascii")),
+                      mode="r", offset=int(entry["offset"]), shape=(rows,))
+            for entry in table]
+
+
+def binaryToArray(file):
+    """Loads a binary recording as the (N, 7) array importData() returns
+
+    :param file: filepath of the binary recording
+
+    :returns: (N, 7) float numpy array of adc values
+    """
+
+    return np.column_stack(loadBinary(file)).astype(float)
+
+
+def binaryFlows(file, channels=False):
+    """Computes the flow series of a binary recording
+
+    The time column is used in place and only the three columns of the
+    first venturi are converted to pressure, giving the same values as
+    flowArrays() gives for the txt recording. With channels, the columns of
+    every venturi are converted and their flows computed in one pass, as
+    channelFlows() does.
+
+    :param file: filepath of the binary recording
+    :param channels: True for the flow of every venturi
+
+    :returns t: numpy array of time values in seconds
+    :returns q: numpy array of flow values in L/sec, or with channels a
+    (C, N) array with one row per venturi
+    """
+
+    columns = loadBinary(file)
+    t = np.asarray(columns[0])
+
+    if channels:
+        p = np.array([[adcColumnToPressure(columns[i]) for i in venturi]
+                      for venturi in VENTURI_COLUMNS])
+        return t, venturiFlow(p[:, 0], p[:, 1], p[:, 2])
+
+    p2, ins, exp = (adcColumnToPressure(column) for column in columns[1:4])
+
+    return t, venturiFlow(p2, ins, exp)
+
+
+if __name__ == "__main__":
+
+    for txtFile in sys.argv[1:]:
+        binFile, dropped = convertRecording(txtFile)
+        print(f"{txtFile} -> {binFile} ({os.path.getsize(txtFile)} -> "
+              f"{os.path.getsize(binFile)} bytes, dropped {dropped})")
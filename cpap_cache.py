@@ -0,0 +1,219 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import cpap_analyze
+
+CACHE_DIR = os.environ.get(
+    "CPAP_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "cpap_analyze"))
+CACHE_BYTES = int(os.environ.get("CPAP_CACHE_BYTES", 256 * 2 ** 20))
+
+_READ_SIZE = 2 ** 20
+_FORMAT = 3  # bumped whenever the keys of the metrics dictionary change
+
+
+def fileDigest(file):
+    """Computes the SHA-256 digest of a file's contents
+
+    :param file: filepath of the file to hash
+
+    :returns: hexadecimal digest string
+    """
+
+    digest = hashlib.sha256()
+
+    with open(file, "rb") as in_file:
+        for block in iter(lambda: in_file.read(_READ_SIZE), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def analysisParameters(plot, engine, epoch=None, channels=False):
+    """Collects everything besides the file contents that shapes the result
+
+    The peak detection constants of cpap_analyze are included so that
+    changing them invalidates earlier results.
+
+    :param plot: True if the encoded plot is part of the result
+    :param engine: Name of the smoothing engine
+    :param epoch: Epoch length in seconds, or None
+    :param channels: True if every venturi is analyzed
+
+    :returns: Dictionary of the analysis parameters
+    """
+
+    return {"format": _FORMAT,
+            "plot": bool(plot),
+            "engine": engine,
+            "epoch": epoch,
+            "channels": bool(channels),
+            "resample_rate": cpap_analyze.RESAMPLE_RATE,
+            "peak_height": cpap_analyze.PEAK_HEIGHT,
+            "peak_prominence": cpap_analyze.PEAK_PROMINENCE,
+            "apnea_gap": cpap_analyze.APNEA_GAP}
+
+
+class ResultCache:
+    """On disk cache of obtainMetrics() results keyed by file content
+
+    Each result, including its encoded plot, is stored as a JSON file named
+    after the SHA-256 of the recording's contents combined with the analysis
+    parameters. Re-analyzing an unchanged file therefore only costs hashing
+    it, whatever its name or location, while a change to the file or to any
+    parameter misses the cache. Reading an entry refreshes its modification
+    time, and when the entries exceed maxBytes the least recently used ones
+    are deleted first. Entries are written to a temporary file and renamed,
+    so concurrent processes can share a directory.
+
+    :param directory: Cache directory, defaults to CACHE_DIR
+    :param maxBytes: Size limit of the cache, defaults to CACHE_BYTES
+    """
+
+    def __init__(self, directory=None, maxBytes=None):
+        self.directory = directory or CACHE_DIR
+        self.maxBytes = CACHE_BYTES if maxBytes is None else maxBytes
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, file, plot=True, engine="spline", epoch=None,
+            channels=False):
+        """Builds the cache key of a recording and analysis parameters
+
+        :param file: filepath of the recording
+        :param plot: True if the encoded plot is part of the result
+        :param engine: Name of the smoothing engine
+        :param epoch: Epoch length in seconds, or None
+        :param channels: True if every venturi is analyzed
+
+        :returns: hexadecimal key string
+        """
+
+        parameters = json.dumps(
+            analysisParameters(plot, engine, epoch, channels), sort_keys=True)
+        material = fileDigest(file) + parameters
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        """Path of the entry stored under key"""
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        """Returns the metrics stored under key, or None on a miss
+
+        The entry is marked as recently used once read. If another process
+        evicts it in between, the metrics already read are still returned.
+        """
+
+        path = self.path(key)
+        try:
+            with open(path, "r") as in_file:
+                metrics = json.load(in_file)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return metrics
+
+    def put(self, key, metrics):
+        """Stores metrics under key and evicts old entries if needed"""
+
+        handle, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(handle, "w") as out_file:
+            json.dump(metrics, out_file)
+        os.replace(temp, self.path(key))
+        self.evict()
+
+    def evict(self):
+        """Deletes least recently used entries until under maxBytes"""
+
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for mtime, size, path in entries)
+            for mtime, size, path in sorted(entries):
+                if total <= self.maxBytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+
+    def obtainMetrics(self, file, plot="png", engine="spline", epoch=None,
+                      profile=None, channels=False):
+        """Cached version of cpap_analyze.obtainMetrics()
+
+        Only immediate ("png") or absent (None) plots can be cached. Deferred
+        plots, and profiled analyses whose timings would be meaningless on a
+        hit, are passed straight through to cpap_analyze.obtainMetrics().
+
+        :param file: filename of data that needs to be analyzed
+        :param plot: "png", "deferred" or None
+        :param engine: Name of the smoothing engine
+        :param epoch: Optional epoch length in seconds
+        :param profile: Optional profile, see cpap_analyze.obtainMetrics()
+        :param channels: True to add the metrics of every venturi
+
+        :returns patient_file_results: Results Output File Path for Patient
+        :returns metrics: Dictionary of CPAP measurements for patient
+        """
+
+        if plot == "deferred" or profile not in (None, False):
+            return cpap_analyze.obtainMetrics(file, plot, engine, epoch,
+                                              profile, channels)
+
+        key = self.key(file, plot is not None, engine, epoch, channels)
+        metrics = self.get(key)
+
+        if metrics is not None:
+            logging.info(f"Cached Analysis of: {file}")
+            return "", metrics
+
+        patient_file_results, metrics = cpap_analyze.obtainMetrics(
+            file, plot, engine, epoch, channels=channels)
+        self.put(key, metrics)
+
+        return patient_file_results, metrics
+
+
+_defaultCache = None
+
+
+def defaultCache():
+    """Returns the process wide ResultCache, creating it on first use"""
+
+    global _defaultCache
+
+    if _defaultCache is None:
+        _defaultCache = ResultCache()
+
+    return _defaultCache
+
+
+def cachedMetrics(file, plot="png", engine="spline", epoch=None,
+                  profile=None, channels=False):
+    """obtainMetrics() through the process wide ResultCache
+
+    :param file: filename of data that needs to be analyzed
+    :param plot: "png", "deferred" or None
+    :param engine: Name of the smoothing engine
+    :param epoch: Optional epoch length in seconds
+    :param profile: Optional profile, see cpap_analyze.obtainMetrics()
+    :param channels: True to add the metrics of every venturi
+
+    :returns patient_file_results: Results Output File Path for Patient
+    :returns metrics: Dictionary of CPAP measurements for patient
+    """
+
+    return defaultCache().obtainMetrics(file, plot, engine, epoch, profile,
+                                        channels)
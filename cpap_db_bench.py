@@ -0,0 +1,293 @@
+"""
+Benchmark of the /pt_info_fromRoom lookup against patient history length
+
+Patients with histories of the requested lengths are added to the database
+through the server's own functions, and get_infofromroom_driver() is timed
+on each. The bytes MongoDB returns per call are counted with a pymongo
+command listener. For comparison the same histories are stored the way
+results used to be stored, embedded in the patient document with base64
+images, and read the way the route used to read them, with the patient
+document fetched by room, then again by mrn, twice when it had no results.
+Everything the benchmark adds is removed afterwards. For example, against a
+local mongod:
+
+    python3 cpap_db_bench.py --uri mongodb://localhost:27017/cpapBench \\
+        --history 0 10 100 1000 --output db_bench.json
+"""
+
+import argparse
+import base64
+import json
+import statistics
+import sys
+import time
+from datetime import datetime
+import numpy as np
+import bson
+from pymongo import monitoring
+from health_db_patient import Patient, CPAP_Record, FlowImage
+from cpap_server import (add_patient_to_database, add_test_to_patient,
+                         get_infofromroom_driver, ensure_db, load_config)
+
+HISTORY = (0, 10, 100, 1000)
+IMAGE_BYTES = 40000  # about the size of a flow plot png
+MAX_DOCUMENT_BYTES = 16 * 2 ** 20  # MongoDB document size limit
+MRN_BASE = 990000000
+ROOM_BASE = 990000
+
+
+class ReplyBytes(monitoring.CommandListener):
+    """Counts the commands sent to MongoDB and the bytes of their replies"""
+
+    def __init__(self):
+        self.commands = 0
+        self.bytes = 0
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.commands += 1
+        self.bytes += len(bson.encode(event.reply))
+
+    def failed(self, event):
+        self.commands += 1
+
+
+def populate(mrn, roomNum, history, imageBytes, rng):
+    """
+    Adds a patient with history results as /add_test would
+
+    Args:
+        mrn (int): Medical Record Number of the patient
+        roomNum (int): room of the patient
+        history (int): number of results
+        imageBytes (int): size of the random image of each result
+        rng (numpy.random.Generator): random number source
+
+    Returns:
+        None
+    """
+    add_patient_to_database({"mrn": mrn, "roomNum": roomNum,
+                             "name": "Bench", "pressure": 10})
+    for i in range(history):
+        image = base64.b64encode(rng.bytes(imageBytes)).decode()
+        add_test_to_patient({"mrn": mrn, "breathingRate": 15.0,
+                             "apneaCount": i % 3, "image": image})
+
+
+def populateLegacy(mrn, roomNum, history, imageBytes, rng):
+    """
+    Adds a patient with history results embedded in its document
+
+    Args:
+        mrn (int): Medical Record Number of the patient
+        roomNum (int): room of the patient
+        history (int): number of results
+        imageBytes (int): size of the random image of each result
+        rng (numpy.random.Generator): random number source
+
+    Returns:
+        bool: False if the document would exceed the MongoDB size limit, in
+              which case nothing is added
+    """
+    if history * imageBytes * 4 / 3 > MAX_DOCUMENT_BYTES:
+        return False
+    results = [{"timeStamp": datetime.now(), "breathingRate": 15.0,
+                "apneaCount": i % 3,
+                "flowImg": base64.b64encode(rng.bytes(imageBytes)).decode()}
+               for i in range(history)]
+    Patient._mongometa.collection.insert_one(
+        {"_id": mrn, "roomNum": roomNum, "name": "Bench", "pressure": 10,
+         "registered_timeStamp": datetime.now(), "results": results})
+    return True
+
+
+def legacyLookup(roomNum):
+    """
+    Reads a patient the way /pt_info_fromRoom did with embedded results
+
+    Args:
+        roomNum (int): room of the patient
+
+    Returns:
+        dict: the latest embedded result, or None
+    """
+    collection = Patient._mongometa.collection
+    pt = collection.find_one({"roomNum": roomNum},
+                             sort=[("registered_timeStamp", -1)])
+    # do_results_exist() read the patient again, and once more in the elif
+    # when the first call found no results
+    for check in range(1 if pt["results"] else 2):
+        collection.find_one({"_id": pt["_id"]})
+    return pt["results"][-1] if pt["results"] else None
+
+
+def measure(call, repeat, listener):
+    """
+    Times a lookup and counts the bytes it reads
+
+    Args:
+        call (callable): the lookup, called without arguments
+        repeat (int): number of timed calls, after one untimed call
+        listener (ReplyBytes): listener registered before connecting
+
+    Returns:
+        dict: fastest and median seconds, commands and bytes per call, the
+              last two None when the client reports no commands
+    """
+    call()
+    commands, replyBytes = listener.commands, listener.bytes
+    times = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - start)
+    commands = listener.commands - commands
+    replyBytes = listener.bytes - replyBytes
+    return {"seconds": min(times),
+            "median": statistics.median(times),
+            "commands": commands / repeat if commands else None,
+            "bytes": replyBytes / repeat if commands else None}
+
+
+def cleanup(mrns):
+    """
+    Removes the benchmark patients with their results and images
+
+    Args:
+        mrns (list): Medical Record Numbers added by the benchmark
+
+    Returns:
+        None
+    """
+    query = {"mrn": {"$in": mrns}}
+    images = [record.flowImg
+              for record in CPAP_Record.objects.raw(query).only("flowImg")]
+    Patient.objects.raw({"_id": {"$in": mrns}}).delete()
+    FlowImage.objects.raw({"_id": {"$in": images}}).delete()
+
+
+def runBenchmark(history=HISTORY, repeat=20, imageBytes=IMAGE_BYTES,
+                 legacy=True, listener=None, progress=None, seed=0):
+    """
+    Benchmarks the room lookup for every history length
+
+    Args:
+        history (iterable): numbers of results per patient
+        repeat (int): number of timed calls per lookup
+        imageBytes (int): size of the image of each result
+        legacy (bool): False to skip the embedded results comparison
+        listener (ReplyBytes/None): listener registered before connecting
+        progress (callable/None): called with each result as it completes
+        seed (int): seed of the random number generator
+
+    Returns:
+        dict: parameters and one result per history length
+    """
+    listener = listener or ReplyBytes()
+    rng = np.random.default_rng(seed)
+    mrns = []
+    results = []
+    try:
+        for i, length in enumerate(history):
+            mrn, roomNum = MRN_BASE + 2 * i, ROOM_BASE + 2 * i
+            mrns.append(mrn)
+            populate(mrn, roomNum, length, imageBytes, rng)
+            result = {"history": length,
+                      "lookup": measure(
+                          lambda: get_infofromroom_driver(roomNum),
+                          repeat, listener),
+                      "legacy": None}
+            if legacy:
+                mrns.append(mrn + 1)
+                if populateLegacy(mrn + 1, roomNum + 1, length, imageBytes,
+                                  rng):
+                    result["legacy"] = measure(
+                        lambda: legacyLookup(roomNum + 1), repeat, listener)
+            results.append(result)
+            if progress is not None:
+                progress(result)
+    finally:
+        cleanup(mrns)
+
+    return {"created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "parameters": {"repeat": repeat, "image_bytes": imageBytes,
+                           "seed": seed},
+            "results": results}
+
+
+def formatResult(result):
+    """
+    Formats the lookups of one history length as a text line
+
+    Args:
+        result (dict): one entry of the results of runBenchmark
+
+    Returns:
+        str: history length, then seconds and bytes of each lookup
+    """
+    def describe(timing):
+        if timing is None:
+            return f"{'too large':>26}"
+        size = timing["bytes"]
+        size = "?" if size is None else f"{size / 1024:.1f} KiB"
+        return f"{timing['seconds'] * 1000:9.3f} ms {size:>13}"
+
+    return (f"{result['history']:8}  {describe(result['lookup'])}   "
+            f"{describe(result['legacy'])}")
+
+
+def main(argv=None):
+    """
+    Command line entry point for the lookup benchmark
+
+    Args:
+        argv (list/None): command line arguments, defaults to sys.argv
+
+    Returns:
+        int: 0
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark /pt_info_fromRoom against history length")
+    parser.add_argument("--uri", default=None,
+                        help="MongoDB connection string with the database")
+    parser.add_argument("--mock", action="store_true",
+                        help="use an in-process mongomock database")
+    parser.add_argument("--history", type=int, nargs="+",
+                        default=list(HISTORY),
+                        help="numbers of results per patient")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="timed calls per lookup")
+    parser.add_argument("--image-kb", type=float,
+                        default=IMAGE_BYTES / 1000,
+                        help="size of the image of each result in kB")
+    parser.add_argument("--no-legacy", action="store_true",
+                        help="skip the embedded results comparison")
+    parser.add_argument("-o", "--output", default=None,
+                        help="JSON file for the results")
+    args = parser.parse_args(argv)
+
+    overrides = {}
+    if args.uri:
+        overrides["MONGO_URI"] = args.uri
+    if args.mock:
+        overrides["MONGO_MOCK"] = True
+        overrides.setdefault("MONGO_URI", "mongodb://localhost/cpapBench")
+    listener = ReplyBytes()
+    monitoring.register(listener)
+    ensure_db(load_config(overrides))
+
+    print(f"{'history':>8}  {'lookup':>26}   {'embedded results':>26}")
+    run = runBenchmark(args.history, args.repeat,
+                       int(args.image_kb * 1000), not args.no_legacy,
+                       listener, progress=lambda r: print(formatResult(r)))
+
+    if args.output:
+        with open(args.output, "w") as out_file:
+            json.dump(run, out_file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
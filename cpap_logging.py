@@ -0,0 +1,68 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+
+LOG_FILE = "cpapAnalyis.log"
+LOG_FORMAT = "%(asctime)s %(levelname)s:%(name)s:%(message)s"
+
+_listener = None
+_queueHandler = None
+
+
+def configureLogging(filename=LOG_FILE, level=logging.INFO, handlers=None):
+    """Sends the log records of the process through a queue to a log file
+
+    Meant to be called once by the host process, the server or a GUI client,
+    before any analysis runs. The root logger gets a QueueHandler, so logging
+    from an analysis only puts the record on an in-memory queue, and a
+    QueueListener thread writes the records to the handlers. The log file is
+    appended to, never truncated. Later calls return the running listener.
+
+    :param filename: Log file used when no handlers are given
+    :param level: Level of the root logger
+    :param handlers: Optional list of handlers to write the records to
+
+    :returns: The running QueueListener
+    """
+
+    global _listener, _queueHandler
+
+    if _listener is not None:
+        return _listener
+
+    if handlers is None:
+        handlers = [logging.FileHandler(filename, mode="a")]
+    for handler in handlers:
+        if handler.formatter is None:
+            handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    records = queue.SimpleQueue()
+    _queueHandler = logging.handlers.QueueHandler(records)
+    root = logging.getLogger()
+    root.addHandler(_queueHandler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, *handlers,
+                                               respect_handler_level=True)
+    _listener.start()
+    atexit.register(stopLogging)
+
+    return _listener
+
+
+def stopLogging():
+    """Writes out the queued records and removes the queue handler"""
+
+    global _listener, _queueHandler
+
+    if _listener is None:
+        return
+
+    logging.getLogger().removeHandler(_queueHandler)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+
+    _listener = None
+    _queueHandler = None
@@ -3,24 +3,221 @@ Database is stored in MongoDB using health_db_patient.Patient as
 the MongoModel class
 """
 
-from flask import Flask, request, jsonify
+from flask import (Flask, Blueprint, Response, current_app, request,
+                   jsonify)
 from pymodm import connect
 from pymodm import errors as pymodm_errors
-from health_db_patient import Patient, CPAP_Result
-from cpap_analyze import obtainMetrics
+from pymodm.connection import (_CONNECTIONS, ConnectionInfo,
+                               DEFAULT_CONNECTION_ALIAS)
+from pymongo import uri_parser
+from bson import ObjectId
+from health_db_patient import Patient, CPAP_Record, CPAP_Latest, FlowImage
+from cpap_logging import configureLogging
 import ssl
+import base64
+import binascii
+import hashlib
+import re
 import os
 from typing import Optional
 import ast
 from datetime import datetime
+from collections import OrderedDict
+import threading
+import uuid
 
 date_format = "%Y-%m-%d %H:%M:%S"
 
-connect("mongodb+srv://pradneshkolluru:bukbat-toqfum-nyVpi9"
-        "@cluster0.gh4mcsl.mongodb.net/finalProjectDB"
-        "?retryWrites=true&w=majority", ssl_cert_reqs=ssl.CERT_NONE)
+MAX_DEFERRED_PLOTS = 32
+MAX_PLOT_SIZE = 4000  # pixels, largest width or height of a deferred plot
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+IMAGE_ID_PATTERN = re.compile("[0-9a-f]{64}")
+deferred_plots = OrderedDict()
+deferred_plots_lock = threading.Lock()
+
+DEFAULT_CONFIG = {
+    "MONGO_URI": "mongodb+srv://pradneshkolluru:bukbat-toqfum-nyVpi9"
+                 "@cluster0.gh4mcsl.mongodb.net/finalProjectDB"
+                 "?retryWrites=true&w=majority",
+    "MONGO_MAX_POOL_SIZE": 100,
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": 5000,
+    "MONGO_CONNECT_TIMEOUT_MS": 5000,
+    "MONGO_SOCKET_TIMEOUT_MS": None,
+    "MONGO_TLS_INSECURE": None,
+    "MONGO_CLIENT_FACTORY": None,
+    "MONGO_MOCK": False,
+    "PREWARM": True,
+}
+CONFIG_ENV_PREFIX = "CPAP_"
+MOCK_MONGO_URI = "mongodb://localhost:27017/finalProjectDB"
+
+db_lock = threading.Lock()
+
+routes = Blueprint("cpap", __name__)
+
+
+def load_config(overrides=None):
+    """
+    Builds the server configuration
+
+    Every key of DEFAULT_CONFIG can be set through an environment variable
+    of the same name prefixed with CPAP_, e.g. CPAP_MONGO_URI or
+    CPAP_MONGO_MAX_POOL_SIZE, and the overrides are applied last. Numbers
+    are converted to int, "none" or an empty value gives None and true/false
+    or 1/0 give booleans. MONGO_CLIENT_FACTORY can only be given as an
+    override, as a callable taking the URI and the client keyword arguments.
+    CPAP_MONGO_MOCK=1 selects mongomock.MongoClient as the factory, an
+    in-process stand-in for MongoDB, with the MOCK_MONGO_URI database unless
+    a URI is given.
+
+    Args:
+        overrides (dict/None): configuration values taking precedence
+
+    Returns:
+        dict: the configuration
+    """
+    config = dict(DEFAULT_CONFIG)
+    for key in config:
+        value = os.environ.get(CONFIG_ENV_PREFIX + key)
+        if value is None or key == "MONGO_CLIENT_FACTORY":
+            continue
+        if value.strip().lower() in ("", "none"):
+            config[key] = None
+        elif value.strip().lower() in ("true", "false"):
+            config[key] = value.strip().lower() == "true"
+        elif key.endswith("_MS") or key.endswith("_SIZE"):
+            config[key] = int(value)
+        elif key in ("PREWARM", "MONGO_TLS_INSECURE", "MONGO_MOCK"):
+            config[key] = value.strip() != "0"
+        else:
+            config[key] = value
+    config.update(overrides or {})
+    if config["MONGO_MOCK"] and config["MONGO_CLIENT_FACTORY"] is None:
+        import mongomock
+        config["MONGO_CLIENT_FACTORY"] = mongomock.MongoClient
+        if config["MONGO_URI"] == DEFAULT_CONFIG["MONGO_URI"]:
+            config["MONGO_URI"] = MOCK_MONGO_URI
+    return config
+
+
+def client_options(config):
+    """
+    Translates the configuration into MongoClient keyword arguments
+
+    Unset (None) values are left to the pymongo defaults. Certificate checks
+    are skipped for mongodb+srv URIs unless MONGO_TLS_INSECURE is False, as
+    the server has always done for its Atlas cluster.
+
+    Args:
+        config (dict): server configuration from load_config()
+
+    Returns:
+        dict: keyword arguments for MongoClient
+    """
+    options = {
+        "maxPoolSize": config["MONGO_MAX_POOL_SIZE"],
+        "serverSelectionTimeoutMS":
+            config["MONGO_SERVER_SELECTION_TIMEOUT_MS"],
+        "connectTimeoutMS": config["MONGO_CONNECT_TIMEOUT_MS"],
+        "socketTimeoutMS": config["MONGO_SOCKET_TIMEOUT_MS"],
+    }
+    insecure = config["MONGO_TLS_INSECURE"]
+    if insecure is None:
+        insecure = config["MONGO_URI"].startswith("mongodb+srv://")
+    if insecure:
+        options["ssl_cert_reqs"] = ssl.CERT_NONE
+    return {key: value for key, value in options.items()
+            if value is not None}
+
+
+def connect_db(config):
+    """
+    Registers the MongoDB connection used by the Patient model
+
+    With no MONGO_CLIENT_FACTORY this is pymodm's connect(). A factory is
+    called with the URI and client options instead, and the database it
+    returns is registered under pymodm's default alias, so the models can run
+    against an in-process stand-in.
+
+    Args:
+        config (dict): server configuration from load_config()
+
+    Returns:
+        None
+    """
+    uri = config["MONGO_URI"]
+    options = client_options(config)
+    factory = config["MONGO_CLIENT_FACTORY"]
+    if factory is None:
+        connect(uri, **options)
+        return
+    parsed_uri = uri_parser.parse_uri(uri)
+    if not parsed_uri.get("database"):
+        raise ValueError("Connection must specify a database.")
+    client = factory(uri, **options)
+    _CONNECTIONS[DEFAULT_CONNECTION_ALIAS] = ConnectionInfo(
+        parsed_uri=parsed_uri, conn_string=uri,
+        database=client[parsed_uri["database"]])
+
+
+def ensure_db(config=None):
+    """
+    Connects to MongoDB unless a connection is already registered
+
+    Called before every request, so the server connects on its first
+    request rather than on import, and by scripts and tests using the
+    database outside of a request.
+
+    Args:
+        config (dict/None): server configuration, load_config() if None
+
+    Returns:
+        bool: True if a new connection was made
+    """
+    if DEFAULT_CONNECTION_ALIAS in _CONNECTIONS:
+        return False
+    with db_lock:
+        if DEFAULT_CONNECTION_ALIAS in _CONNECTIONS:
+            return False
+        connect_db(config if config is not None else load_config())
+    return True
 
-app = Flask(__name__)
+
+def close_db():
+    """
+    Closes the registered MongoDB client and forgets the connection
+
+    Returns:
+        None
+    """
+    with db_lock:
+        info = _CONNECTIONS.pop(DEFAULT_CONNECTION_ALIAS, None)
+    if info is not None:
+        info.database.client.close()
+
+
+@routes.before_app_request
+def connect_on_first_request():
+    ensure_db(current_app.config)
+
+
+def create_app(config=None):
+    """
+    Creates the Flask application of the server
+
+    No connection to MongoDB is made here, it is made on the first request
+    with the MONGO_* settings of the configuration.
+
+    Args:
+        config (dict/None): configuration overrides, see load_config()
+
+    Returns:
+        Flask: the application
+    """
+    app = Flask(__name__)
+    app.config.update(load_config(config))
+    app.register_blueprint(routes)
+    return app
 
 
 def generic_post_route_input_verification(in_dict, expected_keys,
@@ -95,7 +292,7 @@ def generic_post_route_input_verification(in_dict, expected_keys,
     return True
 
 
-@app.route("/new_patient", methods=["POST"])
+@routes.route("/new_patient", methods=["POST"])
 def post_new_patient():
     """
     POST route to receive a new patient
@@ -187,7 +384,7 @@ def add_patient_to_database(in_dict):
     return
 
 
-@app.route("/calcResults", methods=["POST"])
+@routes.route("/calcResults", methods=["POST"])
 def calcMetrics():
     """
     POST route to receive a calculate results from CPAP data
@@ -196,10 +393,24 @@ def calcMetrics():
     should receive the following dictionary as a JSON string:
         {
             "fileName": <string containing filepath of raw CPAP data>,
+            "plot": <optional bool, False to skip rendering the plot>,
+            "epoch": <optional number of seconds per epoch, at least 1>,
+            "profile": <optional bool, True to time the analysis stages>,
+            "profile_memory": <optional bool, True to also measure memory>,
+            "channels": <optional bool, True to analyze both venturis>
         }
     The function then sends this dictionary to obtainMetrics function to
     implement the route and receives back an answer and status code to return
-    to the requestor.
+    to the requestor. The answer includes the "validation" report of the
+    lines dropped from the file. When "plot" is False the answer contains a
+    "plot_id" instead of the encoded plot, which can be fetched later from
+    the "/calcResults/plot/<plot_id>" GET route. When "epoch" is given the
+    answer also contains an "epochs" dictionary of per-epoch arrays, and when
+    "profile" is True a "profile" list with the timing and row count of
+    every analysis stage. Their memory change is only measured when
+    "profile_memory" is also True, as tracing memory slows the stages down.
+    When "channels" is True a "venturis" list holds the breath and leakage
+    metrics of each venturi.
 
     Returns:
         dictionary: The Metrics obtained by cpap_analyze code
@@ -224,7 +435,19 @@ def calc_Metrics_driver(in_data):
     as tuples of expected keys and expected types.  If the verification is not
     successful, a message and 400 status code are returned to the driver
     function. If verification is successful, a function is called to add obtain
-    the result and a 200 code is returned.
+    the result and a 200 code is returned. Rendered results come from the
+    on-disk result cache, so re-posting an unchanged file is nearly free. If
+    the optional "plot" key is
+    False, the plot is not rendered. Instead a DeferredPlot is stored with
+    store_deferred_plot() and its id is returned in place of the plot. The
+    optional "epoch" key adds the per-epoch metrics to the answer. The
+    optional "profile" key runs the analysis uncached with a StageProfile
+    that logs every stage and adds the stage records to the answer. Memory
+    is only traced when the optional "profile_memory" key is also True, so
+    that the timings of a plain profile are not slowed down by tracemalloc.
+    The optional "channels" key adds the metrics of every venturi. The analysis
+    modules are imported here, on first use, so that routes that never
+    analyze do not load numpy, scipy and matplotlib.
 
     Args:
         in_data (dict/any): the input data received by the POST request, which
@@ -248,16 +471,141 @@ def calc_Metrics_driver(in_data):
     if not exists:
         return f"{in_data['fileName']} does not exist", 400
 
-    placeholder, result = obtainMetrics(in_data['fileName'])
+    render = in_data.get("plot", True)
+    if type(render) is not bool:
+        return "plot key should be of type bool", 400
+
+    profile = in_data.get("profile", False)
+    if type(profile) is not bool:
+        return "profile key should be of type bool", 400
+    memory = in_data.get("profile_memory", False)
+    if type(memory) is not bool:
+        return "profile_memory key should be of type bool", 400
+    from cpap_analyze import obtainMetrics, StageProfile, logStage, MIN_EPOCH
+    from cpap_cache import cachedMetrics
+
+    epoch = in_data.get("epoch")
+    if epoch is not None and (type(epoch) not in (int, float) or
+                              not epoch >= MIN_EPOCH):
+        return f"epoch key should be a number of at least {MIN_EPOCH:g} " \
+            "seconds", 400
+
+    profile = StageProfile(logStage, memory=memory) if profile else None
+
+    channels = in_data.get("channels", False)
+    if type(channels) is not bool:
+        return "channels key should be of type bool", 400
+
+    if render:
+        placeholder, result = cachedMetrics(in_data['fileName'], epoch=epoch,
+                                            profile=profile,
+                                            channels=channels)
+    else:
+        placeholder, result = obtainMetrics(in_data['fileName'],
+                                            plot="deferred", epoch=epoch,
+                                            profile=profile,
+                                            channels=channels)
 
     processedResult = {"breath_rate_bpm": result['breath_rate_bpm'],
                        "apnea_count": result['apnea_count'],
-                       "encoded_plot": result['encoded_plot']}
+                       "encoded_plot": result['encoded_plot'],
+                       "validation": result['validation']}
+
+    if epoch is not None:
+        processedResult["epochs"] = result["epochs"]
+
+    if profile is not None:
+        processedResult["profile"] = result["profile"]
+
+    if channels:
+        processedResult["venturis"] = result["venturis"]
+
+    if not render:
+        processedResult["plot_id"] = store_deferred_plot(result['plot'])
 
     return processedResult, 200
 
 
-@app.route("/add_test", methods=["POST"])
+def store_deferred_plot(plot):
+    """
+    Keeps a DeferredPlot so that it can be rendered on request
+
+    The plot is stored under a new random id in the deferred_plots dictionary.
+    Only the MAX_DEFERRED_PLOTS most recent plots are kept, the oldest being
+    discarded first.
+
+    Args:
+        plot (DeferredPlot): plot returned by obtainMetrics
+
+    Returns:
+        string: id under which the plot can be requested
+    """
+    plot_id = uuid.uuid4().hex
+    with deferred_plots_lock:
+        deferred_plots[plot_id] = plot
+        while len(deferred_plots) > MAX_DEFERRED_PLOTS:
+            deferred_plots.popitem(last=False)
+    return plot_id
+
+
+@routes.route("/calcResults/plot/<plot_id>", methods=["GET"])
+def get_deferred_plot(plot_id):
+    """
+    GET route for rendering the plot of an earlier /calcResults request
+
+    The optional "width" and "height" query parameters give the image size in
+    pixels, e.g. /calcResults/plot/<plot_id>?width=475&height=350 for a
+    thumbnail, each at most MAX_PLOT_SIZE. Calls driver function below
+
+    Returns:
+        dictionary: the encoded plot
+        int: status code of the request
+    """
+    width = request.args.get("width", type=int)
+    height = request.args.get("height", type=int)
+    size = (width, height) if width and height else None
+    answer, status = get_deferred_plot_driver(plot_id, size)
+    if status == 200:
+        return jsonify(answer), status
+    return answer, status
+
+
+def get_deferred_plot_driver(plot_id, size=None):
+    """
+    Renders a stored DeferredPlot
+
+    The plot is looked up by the id returned from the /calcResults route and
+    rendered, the renders at the default size and at the few most recently
+    requested other sizes being kept by the DeferredPlot. Sizes outside 1 to
+    MAX_PLOT_SIZE pixels are refused with a 400 status code, so that a
+    request cannot force a render of any size. If the id is unknown, or the
+    plot has already been discarded, a message and 404 status code are
+    returned.
+
+    Args:
+        plot_id (str): id returned by the /calcResults route
+        size (tuple/None): (width, height) of the image in pixels, or None
+                           for the default size
+
+    Returns:
+        dictionary: {"encoded_plot": <base64 encoded png string>}
+        int: status code of the request: 400 if the size is out of range, 404
+             if the plot is not found, 200 otherwise
+    """
+    if size is not None and not all(1 <= side <= MAX_PLOT_SIZE
+                                    for side in size):
+        return ("width and height should be between 1 and "
+                f"{MAX_PLOT_SIZE} pixels"), 400
+    with deferred_plots_lock:
+        plot = deferred_plots.get(plot_id)
+        if plot is not None:
+            deferred_plots.move_to_end(plot_id)
+    if plot is None:
+        return f"Plot {plot_id} not found", 404
+    return {"encoded_plot": plot.encoded(size)}, 200
+
+
+@routes.route("/add_test", methods=["POST"])
 def post_add_test():
     """
     POST route for adding a test result to an existing patient
@@ -298,7 +646,8 @@ def add_test_driver(in_data):
     received exists in the database.  If not, a message and 400 status code
     are returned to the driver function.  If verification is successful, a
     function is called to add the result to the patient and a 200 status code
-    is then returned.
+    is then returned.  An image that is not valid base64 gives a message and
+    400 status code.
 
     Args:
         in_data (dict/any): the input data received by the POST request, which
@@ -322,7 +671,10 @@ def add_test_driver(in_data):
     if exists is False:
         return ("Patient mrn {} does not exist in database"
                 .format(in_data["mrn"])), 400
-    result, status_code = add_test_to_patient(in_data)
+    try:
+        result, status_code = add_test_to_patient(in_data)
+    except binascii.Error:
+        return "image key should be a base64 encoded png", 400
     return result, status_code
 
 
@@ -362,12 +714,11 @@ def add_test_to_patient(in_data):
     This function receives a dictionary as input.  This dictionary will contain
     the "mrn" key with a value containing the id of the patient for which to
     add the test, and various CPAP test result metrics
-    The "id" value is used in a MongoDB query through the "Patient" class,
-    asking for the record with a primary key matching the given "mrn" value.
-    This record is known to exist as the test for its existence was previously
-    done.  The test results are put into a tuple that is then
-    appended to the test results list of the patient entry.  The patient entry
-    is then resaved to the MongoDB database using the `.save()` method.
+    The patient is known to exist as the test for its existence was previously
+    done.  The base64 image is decoded and saved with save_image(), and the
+    metrics are saved as a CPAP_Record document holding the image id, so the
+    patient document itself is not read or rewritten, only its summary of the
+    latest result is set by set_latest().
     A message and status code of 200 are returned.
 
     Args:
@@ -376,20 +727,100 @@ def add_test_to_patient(in_data):
     Returns:
         string, int:  A success message and status code
 
+    Raises:
+        binascii.Error: if the image is not valid base64
     """
-    patient = Patient.objects.raw({"_id": in_data["mrn"]}).first()
-    newResult = CPAP_Result(timeStamp=datetime.now(),
-                            breathingRate=in_data['breathingRate'],
-                            apneaCount=in_data['apneaCount'],
-                            flowImg=in_data['image'])
+    png = base64.b64decode(in_data["image"], validate=True)
+    now = datetime.now()  # kept to the milliseconds MongoDB stores
+    record = CPAP_Record(mrn=in_data["mrn"],
+                         timeStamp=now.replace(
+                             microsecond=now.microsecond // 1000 * 1000),
+                         breathingRate=in_data['breathingRate'],
+                         apneaCount=in_data['apneaCount'],
+                         flowImg=save_image(png)).save()
+    set_latest(in_data["mrn"], record)
+    return "Test successfully added", 200
 
-    patient.results.append(newResult)
 
-    patient.save()
-    return "Test successfully added", 200
+def set_latest(mrn, record):
+    """
+    Stores a result as the latest result of a patient
+
+    The CPAP_Latest summary of the patient is replaced with a single $set,
+    on the condition that it is not newer than the result, so a slower
+    concurrent request cannot put an older result back.
+
+    Args:
+        mrn (int): Medical Record Number of the patient
+        record (CPAP_Record): the new result
+
+    Returns:
+        bool: True if the summary was replaced
+    """
+    latest = CPAP_Latest(timeStamp=record.timeStamp,
+                         breathingRate=record.breathingRate,
+                         apneaCount=record.apneaCount,
+                         flowImg=record.flowImg)
+    older = {"_id": mrn,
+             "$or": [{"latest": None},
+                     {"latest.timeStamp": {"$lte": record.timeStamp}}]}
+    return Patient.objects.raw(older).update(
+        {"$set": {"latest": latest.to_son()}}) == 1
+
+
+def save_image(png):
+    """
+    Stores a png in the image collection
+
+    The image id is the sha256 hex digest of the png, so storing the same
+    png again rewrites the identical document and an id always names the
+    same bytes.
+
+    Args:
+        png (bytes): the image
+
+    Returns:
+        str: the image id
+    """
+    image_id = hashlib.sha256(png).hexdigest()
+    FlowImage(image_id=image_id, data=png).save()
+    return image_id
+
+
+def patient_results(mrn):
+    """
+    Query of the results of a patient, oldest first
+
+    The query is served by the ("mrn", "timeStamp") index of the results
+    collection.
+
+    Args:
+        mrn (int): Medical Record Number of the patient
+
+    Returns:
+        QuerySet: CPAP_Record objects of the patient
+    """
+    return CPAP_Record.objects.raw({"mrn": mrn}).order_by([("timeStamp", 1)])
+
+
+def latest_result(mrn):
+    """
+    Finds the most recent result of a patient
+
+    Args:
+        mrn (int): Medical Record Number of the patient
+
+    Returns:
+        CPAP_Record/None: the latest result, or None if the patient has none
+    """
+    query = CPAP_Record.objects.raw({"mrn": mrn})
+    try:
+        return query.order_by([("timeStamp", -1)]).first()
+    except pymodm_errors.DoesNotExist:
+        return None
 
 
-@app.route("/updateInfo", methods=["POST"])
+@routes.route("/updateInfo", methods=["POST"])
 def post_updateInfo():
     """
     POST route for Updating Existing Patient INformation
@@ -456,6 +887,25 @@ def updateInfo_driver(in_data):
     return result, 200
 
 
+def pressure_value(pressure):
+    """
+    Converts the pressure sent to /updateInfo to the value to store
+
+    The patient GUI sends an empty string when the pressure field is left
+    blank. Like None, it clears the pressure. Any other value is stored as
+    an integer, 0 and "0" included.
+
+    Args:
+        pressure (str/int/None): verified pressure from the request
+
+    Returns:
+        int/None: the pressure, or None for no pressure
+    """
+    if pressure is None or pressure == "":
+        return None
+    return int(pressure)
+
+
 def updateInfo(in_data):
     """
     Update Information of specific patient MRN
@@ -464,12 +914,12 @@ def updateInfo(in_data):
     the "id" key with a value containing the mrn of the patient for which to
     update information, the "pressure" key with a int value with the new
     updated pressure, and the "name" key with the updated name string.
-    The "id" value is used in a MongoDB query through the "Patient" class,
-    asking for the record with a primary key matching the given "mrn" value.
     This record is known to exist as the test for its existence was previously
-    done.  The test name and test results are put into a tuple that is then
-    appended to the test results list of the patient entry.  The patient entry
-    is then resaved to the MongoDB database using the `.save()` method.
+    done.  The new values are written with a single atomic update of the
+    patient document, $set for given values and $unset for None or a blank
+    pressure, see pressure_value(), as the `.save()` method would store them,
+    so the rest of the document is neither read nor rewritten and concurrent
+    updates of other fields are kept.
     A message and status code of 200 are returned.
 
     Args:
@@ -479,13 +929,16 @@ def updateInfo(in_data):
         string, int:  A success message and status code
 
     """
-
-    patient = Patient.objects.raw({"_id": in_data["mrn"]}).first()
-
-    patient.pressure = in_data["pressure"]
-    patient.name = in_data.get("name")
-
-    patient.save()
+    values = {"pressure": pressure_value(in_data["pressure"]),
+              "name": in_data.get("name")}
+    update = {}
+    for key, value in values.items():
+        if value is None:
+            update.setdefault("$unset", {})[key] = ""
+        else:
+            update.setdefault("$set", {})[key] = value
+
+    Patient.objects.raw({"_id": in_data["mrn"]}).update(update)
     return f"Patient MRN {in_data['mrn']} Succesfully Updated", 200
 
 
@@ -493,7 +946,8 @@ def clear_db():
     """
     Resets Entire Database
 
-    This function deletes all the Patient objects in the database
+    This function deletes all the Patient objects in the database, their
+    results and the stored images
 
     Args:
         None
@@ -504,6 +958,7 @@ def clear_db():
     x = Patient.objects.all()
 
     x.delete()
+    FlowImage.objects.all().delete()
 
 
 def initializeDB():
@@ -543,18 +998,18 @@ def initializeDB():
     add_patient_to_database(p4)
 
     result1 = {"mrn": 1030324, "breathingRate": 27.3, "apneaCount": 8,
-               "image": "lkhlkjhlkj"}
+               "image": "lkhlkjhlkj=="}
     result2 = {"mrn": 1030324, "breathingRate": 22.3, "apneaCount": 2,
-               "image": "fdafa"}
+               "image": "fdafaf=="}
     result3 = {"mrn": 13042342, "breathingRate": 29.3, "apneaCount": 0,
-               "image": "fdasadffa"}
+               "image": "fdasadff"}
 
     add_test_to_patient(result1)
     add_test_to_patient(result2)
     add_test_to_patient(result3)
 
 
-@app.route("/room_nums", methods=["GET"])
+@routes.route("/room_nums", methods=["GET"])
 def get_used_rooms():
     return get_used_rooms_driver()
 
@@ -563,28 +1018,23 @@ def get_used_rooms_driver():
     """
     Get all room numbers that have been/are used by patients
 
-    This function receives all the room numbers present in the list of pts in
-    the MongoDB. This is done by first getting all the patients in the database
-    and appending only the roomNum fields into a list called 'rooms'. This list
-    is then condensed by removing duplicates. This is done by converting to a
-    dictionary, which cannot have duplicate keys, and then converting back to
-    a string.
+    This function returns the distinct room numbers of the patients in the
+    MongoDB. The distinct values are read from the ("roomNum",
+    "registered_timeStamp") index of the patient collection, so no patient
+    document is loaded and the cost does not depend on how many results
+    and images the patients have.
 
     Args:
         None
 
     Returns:
-        tuple, int: all room numbers
+        list: all room numbers, in increasing order
     """
-    rooms = []
-    patientdb = Patient.objects.raw({})
-    for item in patientdb:
-        rooms.append(int(item.roomNum))
-    rooms_condensed = list(dict.fromkeys(rooms))
-    return rooms_condensed
+    rooms = Patient._mongometa.collection.distinct("roomNum")
+    return sorted(int(room) for room in rooms if room is not None)
 
 
-@app.route("/pt_info_fromRoom/<roomNum>", methods=["GET"])
+@routes.route("/pt_info_fromRoom/<roomNum>", methods=["GET"])
 def get_infofromroom(roomNum):
     patient_info_dict = get_infofromroom_driver(int(roomNum))
     return patient_info_dict
@@ -597,7 +1047,12 @@ def get_infofromroom_driver(roomNum):
     This function takes a room number that the user selected as an input
     and returns all the information needed from the most recent pt in a
     dictionary format caleld ptinfo. This includes patient mrn, name, time of
-    the latest test, breathing rate, apnea count, and an ecoded image string.
+    the latest test, breathing rate, apnea count, and the id of the image,
+    which is served by the /image route.
+
+    The patient is found on the ("roomNum", "registered_timeStamp") index and
+    only its name, pressure and summary of the latest result are read, in a
+    single query.
 
     Args:
         int: Room Number
@@ -605,18 +1060,18 @@ def get_infofromroom_driver(roomNum):
         dict: dictionary of all the relevant patient values
     """
     rs = "registered_timeStamp"
-    pt = Patient.objects.raw({"roomNum": roomNum}).order_by([(rs, -1)]).first()
+    pt = (Patient.objects.raw({"roomNum": roomNum}).order_by([(rs, -1)])
+          .only("name", "pressure", "latest").first())
     ptMRN = pt.mrn
     ptName = pt.name
     ptPressure = pt.pressure
-    if do_results_exist(ptMRN) is True:
-        ptResults = pt.results
-        ResultRecent = ptResults[-1]
+    ResultRecent = pt.latest
+    if ResultRecent is not None:
         test_time = ResultRecent.timeStamp
         test_breathingrate = ResultRecent.breathingRate
         test_apneas = ResultRecent.apneaCount
         ImageText = ResultRecent.flowImg
-    elif do_results_exist(ptMRN) is False:
+    else:
         test_time = "N/A"
         test_breathingrate = "N/A"
         test_apneas = "N/A"
@@ -635,24 +1090,18 @@ def do_results_exist(mrn):
     """
     This function checks whether the patient has results
 
-    The function returns True if able to index a test result using basic try
-    except methodology. The function returns False if there is an IndexError.
+    The function returns True if the results collection holds a result for
+    the patient, and False otherwise.
 
     Args:
         int: Medical Record Number
     Returns:
         bool: True or False
     """
-    pt = Patient.objects.raw({"_id": mrn}).first()
-    try:
-        ptResults = pt.results
-        ResultRecent = ptResults[-1]
-        return True
-    except IndexError:
-        return False
+    return latest_result(mrn) is not None
 
 
-@app.route("/pressure_query/<mrn>", methods=["GET"])
+@routes.route("/pressure_query/<mrn>", methods=["GET"])
 def get_pressure_from_mrn(mrn):
     """
     GET route for retrieving pressure information of a patient by MRN
@@ -720,22 +1169,21 @@ def get_pressure_val(mrn):
     return pressure
 
 
-@app.route("/old_test_dates/<mrn>", methods=["GET"])
+@routes.route("/old_test_dates/<mrn>", methods=["GET"])
 def get_test_dates(mrn):
     """
-    Get a list of previous test dates for a patient identified by their MRN
+    Get a list of previous tests for a patient identified by their MRN
     (Medical Record Number).
 
-    This route retrieves the patient with the specified MRN from the MongoDB.
-    It then extracts the timestamp information for all the previous test
-    results associated with the patient, excluding the most recent one. The
-    extracted test dates are returned as a list.
+    This route retrieves the ids and timestamps of all the previous test
+    results associated with the patient with the specified MRN, excluding the
+    most recent one. The id of a test is what /get_old_img expects.
 
     Args:
         mrn (int): The Medical Record Number of the patient.
 
     Returns:
-        tuple: A tuple containing a list of previous test dates and status code
+        tuple: A tuple containing a list of previous tests and status code
     """
     mrn = int(mrn)
     prev_tests = get_test_dates_driver(mrn)
@@ -744,78 +1192,126 @@ def get_test_dates(mrn):
 
 def get_test_dates_driver(mrn):
     """
-    Get a list of previous test dates for a patient identified by their MRN
+    Get a list of previous tests for a patient identified by their MRN
     (Medical Record Number).
 
-    This driver retrieves the patient with the specified MRN from the MongoDB.
-    It then extracts the timestamp information for all the previous test
-    results associated with the patient, excluding the most recent one. The
-    extracted test dates are returned as a list.
+    This driver reads the ids and timestamps of the results of the patient
+    with the specified MRN from the results collection, oldest first and
+    excluding the most recent one. Only the timestamps and ids are
+    transferred.
 
     Args:
         mrn (int): The Medical Record Number of the patient.
 
     Returns:
-        tuple: A tuple containing a list of previous test dates and status code
+        list: one dictionary per previous test with its "id" string and
+              "timeStamp"
     """
-    prev_tests_list = []
-    pt = Patient.objects.raw({"_id": mrn}).first()
-    ptResults = pt.results
-    if len(ptResults) == 1:
-        return prev_tests_list
-    oldResults = ptResults[:-1]  # Ignore most recent test
-    for items in oldResults:
-        prev_tests_list.append(items.timeStamp)
-    return (prev_tests_list)
+    results = patient_results(mrn).only("timeStamp")
+    prev_tests_list = [{"id": str(items.pk), "timeStamp": items.timeStamp}
+                       for items in results]
+    return prev_tests_list[:-1]  # Ignore most recent test
 
 
-@app.route("/get_old_img/<mrn>/<dateval>", methods=["GET"])
-def get_old_img(mrn, dateval):
+@routes.route("/get_old_img/<mrn>/<result_id>", methods=["GET"])
+def get_old_img(mrn, result_id):
     """
-    GET route for retrieving the image of a patient's old test by MRN and date
+    GET route for retrieving the image of a patient's old test by MRN and id
 
     Calls driver function below
 
     Returns:
-        string: image associated with the specified date for the given patient
+        string: id of the image of the specified test for the given patient,
+                served by the /image route
+        int: status code of the request
     """
-    return get_old_img_driver(mrn, dateval)
+    return get_old_img_driver(mrn, result_id)
 
 
-def get_old_img_driver(mrn, dateval):
+def get_old_img_driver(mrn, result_id):
     """
     Receive Image of old test driver function
 
-    This route accepts a patient's Medical Record Number (MRN) and the date of
-    the old test as parameters. It retrieves and returns the image associated
-    with the specified date for the given patient if a match is found in the
-    database. If no match is found, a 404 status code and an error message are
-    returned.
+    This route accepts a patient's Medical Record Number (MRN) and the id of
+    the old test, as listed by /old_test_dates, as parameters. The test is
+    fetched by its id, so the cost does not depend on the length of the
+    patient's history. It returns the id of the image of the test if the test
+    belongs to the given patient. If not, a 404 status code and an error
+    message are returned.
 
     Args:
         mrn (str): Medical Record Number of the patient
-        dateval (str): Date of the old test in the format 'Wed, 06 Dec 2023
-                       22:28:27 GMT'
+        result_id (str): id of the old test
 
     Returns:
-        string: image associated with the specified date for the given patient
+        string: id of the image of the specified test for the given patient,
+                or an error message
+        int: status code of the request: 404 if no test matches, 200
+             otherwise
     """
-    mrn = int(mrn)
-    print("dateval:", dateval)
-    pt = Patient.objects.raw({"_id": mrn}).first()
-    ptResults = pt.results
+    missing = "No matching image found for the given test.", 404
+    if not ObjectId.is_valid(result_id):
+        return missing
+    query = {"_id": ObjectId(result_id), "mrn": int(mrn)}
+    try:
+        result = CPAP_Record.objects.raw(query).only("flowImg").first()
+    except pymodm_errors.DoesNotExist:
+        return missing
+    return result.flowImg, 200
+
+
+@routes.route("/image/<image_id>", methods=["GET"])
+def get_image(image_id):
+    """
+    GET route serving a stored plot as a png
+
+    Images are immutable, so the response carries the image id as a strong
+    ETag and may be cached for a year. A request whose If-None-Match holds
+    the id is answered with 304 without reading the database.
+
+    Returns:
+        Response: the png, or an error message and status code
+    """
+    if image_id in request.if_none_match:
+        response = Response(status=304)
+    else:
+        answer, status = get_image_driver(image_id)
+        if status != 200:
+            return answer, status
+        response = Response(answer, mimetype="image/png")
+    response.set_etag(image_id)
+    response.headers["Cache-Control"] = IMAGE_CACHE_CONTROL
+    return response
+
+
+def get_image_driver(image_id):
+    """
+    Reads a stored png by its image id
+
+    Args:
+        image_id (str): sha256 hex digest returned by save_image()
+
+    Returns:
+        bytes/string: the png, or an error message
+        int: status code of the request: 404 if the image is not found, 200
+             otherwise
+    """
+    if not IMAGE_ID_PATTERN.fullmatch(image_id):
+        return f"Image {image_id} not found", 404
+    try:
+        image = FlowImage.objects.raw({"_id": image_id}).first()
+    except pymodm_errors.DoesNotExist:
+        return f"Image {image_id} not found", 404
+    return bytes(image.data), 200
 
-    for items in ptResults:
-        idate = datetime.strptime(str(items.timeStamp), '%Y-%m-%d %H:%M:%S.%f')
-        odate = idate.strftime('%a, %d %b %Y %H:%M:%S GMT')
-        print("odate:", odate)
-        if odate == dateval:
-            return items.flowImg
 
-    print("No match found for date:", dateval)
-    return "No matching image found for the given date."
+app = create_app()
 
 
 if __name__ == "__main__":
 
+    configureLogging()
+    if app.config["PREWARM"]:
+        from cpap_analyze import prewarm
+        prewarm()
     app.run(host="0.0.0.0")
@@ -0,0 +1,384 @@
+import logging
+from itertools import islice
+import numpy as np
+from scipy.signal import find_peaks
+from cpap_analyze import (parseLines, pressureArray, flowArrays,
+                          ValidationReport, RESAMPLE_RATE, PEAK_HEIGHT,
+                          PEAK_PROMINENCE, APNEA_GAP, SMOOTHING_ENGINES)
+
+CHUNK_ROWS = 8192
+
+
+def iterRecording(file, chunkRows=CHUNK_ROWS, report=None):
+    """Reads a Patient CPAP txt file in fixed size chunks
+
+    The header line is skipped and the file is then read chunkRows lines at a
+    time. Each chunk is converted by parseLines(), so the same lines are
+    dropped as in loadRecording(). Only one chunk is held in memory at once.
+
+    :param file: filepath for Patient CPAP txt data file
+    :param chunkRows: Number of lines read per chunk
+    :param report: Optional ValidationReport covering the whole file, which
+    counts the dropped lines of every chunk
+
+    :returns: Generator of (n, 7) float numpy arrays of adc values
+    """
+
+    with open(file, "r") as in_file:
+
+        in_file.readline()
+        firstLine = 2
+
+        if report is None:
+            report = ValidationReport()
+
+        while True:
+
+            block = list(islice(in_file, chunkRows))
+            if not block:
+                return
+
+            lines = "".join(block).split("\n")
+            if lines[-1] == "":
+                lines.pop()
+
+            data, counts = parseLines(lines, report, firstLine)
+            firstLine += len(lines)
+
+            if len(data):
+                yield data
+
+
+def iterFlows(chunks):
+    """Converts chunks of adc values into time and flow arrays
+
+    :param chunks: Iterable of (n, 7) float numpy arrays of adc values
+
+    :returns: Generator of (t, q) numpy array pairs, one per chunk
+    """
+
+    for adc in chunks:
+        yield flowArrays(pressureArray(adc, inplace=True))
+
+
+class BreathTracker:
+    """Incremental breath detection over a flow signal received in pieces
+
+    The flow signal is smoothed with a sectioned interpolating spline. Every
+    fit covers the newly received samples plus an overlap of samples carried
+    over from the previous fit, and is only evaluated away from the edges of
+    its section. As the influence of a sample on a cubic interpolating spline
+    decays by a factor of about 0.27 per sample, the smoothed values match the
+    global spline of findPeaks() to within floating point precision.
+
+    The smoothed signal is sampled on a fixed time grid. The spacing defaults
+    to the median sample interval divided by RESAMPLE_RATE, which is the
+    spacing findPeaks() uses for a uniformly sampled recording. Peaks are
+    found on a buffer of the smoothed signal with the criteria of findPeaks()
+    and are only committed once guard seconds of signal follow them. The
+    buffer keeps history seconds of signal before the committed region, so
+    memory stays constant however long the recording is.
+
+    Committed breath count and apnea count agree with obtainMetrics() for
+    regular breathing, and breath times agree to within one grid step. Any of
+    the SMOOTHING_ENGINES can be used for the sections, as long as its reach
+    is within the overlap.
+
+    :param step: Time between smoothed points in seconds, or None to derive
+    it from the first samples received
+    :param overlap: Number of raw samples shared between spline sections
+    :param guard: Seconds of signal required after a peak to commit it
+    :param history: Seconds of signal kept before the committed region
+    :param engine: Name of the smoothing engine, see SMOOTHING_ENGINES
+    """
+
+    def __init__(self, step=None, overlap=64, guard=10.0, history=30.0,
+                 engine="spline"):
+        self.step = step
+        self.engine = engine
+        self.overlap = overlap
+        self.guard = guard
+        self.history = history
+
+        self.numSamples = 0
+        self.tStart = None
+        self.tEnd = None
+        self.leakage = 0.0
+        self.numBreaths = 0
+        self.apneaCount = 0
+        self.lastBreath = None
+
+        self._qLast = None
+        self._tRaw = np.empty(0)
+        self._qRaw = np.empty(0)
+        self._gridIndex = 0
+        self._X = np.empty(0)
+        self._Y = np.empty(0)
+        self._committedTo = -np.inf
+
+    @property
+    def duration(self):
+        """Time spanned by the samples received so far in seconds"""
+        if self.tStart is None:
+            return 0.0
+        return self.tEnd - self.tStart
+
+    @property
+    def committedTo(self):
+        """Time up to which every breath has been committed in seconds
+
+        Breaths are committed guard seconds, plus the smoothing overlap,
+        after the last sample received, so no breath can be committed later
+        before this time. It is -inf until the first commit.
+        """
+        return self._committedTo
+
+    def feed(self, t, q):
+        """Adds samples to the tracker and returns newly committed breaths
+
+        The duration and the running trapezoid integral of the flow are
+        updated, the new samples are smoothed together with the carried over
+        section of the previous batch, and the peaks that now have enough
+        signal after them are committed.
+
+        :param t: numpy array of increasing time values in seconds
+        :param q: numpy array of flow values in L/sec
+
+        :returns: numpy array of the times of newly committed breaths
+        """
+
+        t = np.asarray(t, dtype=float)
+        q = np.asarray(q, dtype=float)
+        if len(t) == 0:
+            return np.empty(0)
+
+        self._integrate(t, q)
+        self._tRaw = np.concatenate((self._tRaw, t))
+        self._qRaw = np.concatenate((self._qRaw, q))
+
+        if len(self._tRaw) <= 2 * self.overlap:
+            return np.empty(0)
+
+        self._smooth(self._tRaw[-self.overlap - 1])
+
+        if not len(self._X):
+            return np.empty(0)
+
+        return self._commit(self._X[-1] - self.guard)
+
+    def finish(self):
+        """Smooths the remaining samples and commits every remaining breath
+
+        :returns: numpy array of the times of newly committed breaths
+        """
+
+        if self.tStart is None:
+            return np.empty(0)
+
+        self._smooth(self.tEnd, inclusive=True)
+
+        return self._commit(np.inf)
+
+    def metrics(self):
+        """Summarises the breaths committed so far
+
+        :returns: Dictionary containing duration, breaths, breath_rate_bpm,
+        apnea_count and leakage
+        """
+
+        duration = self.duration
+        bpm = self.numBreaths / (duration / 60) if duration else 0.0
+
+        return {"duration": duration,
+                "breaths": self.numBreaths,
+                "breath_rate_bpm": bpm,
+                "apnea_count": self.apneaCount,
+                "leakage": self.leakage}
+
+    def _integrate(self, t, q):
+        """Updates duration and leakage with a batch of samples"""
+
+        if self.tStart is None:
+            self.tStart = t[0]
+        else:
+            self.leakage += (t[0] - self.tEnd) * (q[0] + self._qLast) / 2
+
+        self.leakage += np.trapz(q, t)
+        self.tEnd = t[-1]
+        self._qLast = q[-1]
+        self.numSamples += len(t)
+
+    def _smooth(self, limit, inclusive=False):
+        """Evaluates the smoothed section on the grid points up to limit
+
+        After evaluation only the raw samples needed as left context for the
+        next section are kept.
+        """
+
+        if self.step is None:
+            self.step = np.median(np.diff(self._tRaw)) / RESAMPLE_RATE
+
+        last = (limit - self.tStart) / self.step
+        stop = int(np.floor(last)) + 1 if inclusive else int(np.ceil(last))
+
+        if stop > self._gridIndex:
+            X = self.tStart + self.step * np.arange(self._gridIndex, stop)
+            Y = SMOOTHING_ENGINES[self.engine](self._tRaw, self._qRaw, X)
+            self._X = np.concatenate((self._X, X))
+            self._Y = np.concatenate((self._Y, Y))
+            self._gridIndex = stop
+
+        nextX = self.tStart + self.step * self._gridIndex
+        keep = max(np.searchsorted(self._tRaw, nextX) - self.overlap, 0)
+        self._tRaw = self._tRaw[keep:]
+        self._qRaw = self._qRaw[keep:]
+
+    def _commit(self, limit):
+        """Commits the peaks of the smoothed buffer found before limit
+
+        :returns: numpy array of the newly committed peak times
+        """
+
+        peaks, _ = find_peaks(self._Y, PEAK_HEIGHT,
+                              prominence=PEAK_PROMINENCE)
+        tPeaks = self._X[peaks]
+        tPeaks = tPeaks[(tPeaks > self._committedTo) & (tPeaks <= limit)]
+
+        for tPeak in tPeaks:
+            if (self.lastBreath is not None
+                    and tPeak > self.lastBreath + APNEA_GAP):
+                self.apneaCount += 1
+            self.lastBreath = tPeak
+        self.numBreaths += len(tPeaks)
+
+        if len(self._X):
+            self._committedTo = min(limit, self._X[-1])
+            start = np.searchsorted(self._X,
+                                    self._committedTo - self.history)
+            self._X = self._X[start:]
+            self._Y = self._Y[start:]
+
+        return tPeaks
+
+
+def streamMetrics(file, chunkRows=CHUNK_ROWS, tracker=None):
+    """Computes CPAP Metrics while reading the file in chunks
+
+    The streaming counterpart of obtainMetrics() for long recordings. The file
+    is read in chunks by iterRecording(), converted to flow by iterFlows() and
+    passed through a BreathTracker, so peak memory depends on the chunk size
+    rather than on the length of the recording. No plot is produced and the
+    individual breath times are not kept.
+
+    :param file: filename of data that needs to be analyzed
+    :param chunkRows: Number of lines read per chunk
+    :param tracker: Optional pre-configured BreathTracker
+
+    :returns: Dictionary of CPAP measurements for patient. Includes duration,
+    breaths, breath_rate_bpm, apnea_count, leakage and validation
+    """
+
+    logging.info(f"Starting Streaming Analysis of: {file}")
+
+    if tracker is None:
+        tracker = BreathTracker()
+
+    report = ValidationReport()
+
+    for t, q in iterFlows(iterRecording(file, chunkRows, report)):
+        tracker.feed(t, q)
+    tracker.finish()
+
+    metrics = tracker.metrics()
+    metrics["validation"] = report.summary()
+
+    if metrics["leakage"] < 0:
+        logging.warning("Negative Leakage")
+
+    return metrics
+
+
+class LiveBreathDetector:
+    """Live breath and apnea detection for samples arriving at the bedside
+
+    Batches of raw ADC rows, as produced by the CPAP machine, are converted to
+    flow and passed to a BreathTracker. Every call returns the events that
+    became final with that batch, so the work done per batch is proportional
+    to the batch size and never to the length of the recording. A breath is
+    reported guard seconds after it happens. An apnea is reported, with the
+    rule of breathAnalysis(), when the breath ending a gap of more than
+    APNEA_GAP seconds is committed.
+
+    :param guard: Seconds of signal required after a breath to report it
+    :param tracker_kwargs: Further BreathTracker options
+    """
+
+    def __init__(self, guard=4.0, **tracker_kwargs):
+        self.tracker = BreathTracker(guard=guard, **tracker_kwargs)
+
+    def addSamples(self, adc):
+        """Processes a batch of raw ADC rows
+
+        :param adc: (n, 7) array of adc values, the first column being time
+
+        :returns: List of new event dictionaries in time order
+        """
+
+        adc = np.asarray(adc, dtype=float).reshape(-1, 7)
+        return self.addFlows(*flowArrays(pressureArray(adc)))
+
+    def addFlows(self, t, q):
+        """Processes a batch of already computed flow values
+
+        :param t: numpy array of increasing time values in seconds
+        :param q: numpy array of flow values in L/sec
+
+        :returns: List of new event dictionaries in time order
+        """
+
+        previous = self.tracker.lastBreath
+        return self._events(previous, self.tracker.feed(t, q))
+
+    def finish(self):
+        """Reports the breaths still waiting for their guard period
+
+        :returns: List of new event dictionaries in time order
+        """
+
+        previous = self.tracker.lastBreath
+        return self._events(previous, self.tracker.finish())
+
+    def status(self):
+        """Current running metrics for display
+
+        :returns: Dictionary containing duration, breaths, breath_rate_bpm,
+        apnea_count, leakage, last_breath and in_apnea, the latter being True
+        when no breath has been committed for more than APNEA_GAP seconds
+        after the last one. The gap is measured up to the committed horizon
+        of the tracker rather than to the last sample, as breaths between the
+        two are not committed yet, so an apnea is flagged about guard seconds
+        late but slow breathing is never flagged.
+        """
+
+        status = self.tracker.metrics()
+        lastBreath = self.tracker.lastBreath
+        status["last_breath"] = lastBreath
+        status["in_apnea"] = (lastBreath is not None and
+                              self.tracker.committedTo >
+                              lastBreath + APNEA_GAP)
+        return status
+
+    @staticmethod
+    def _events(previous, tBreaths):
+        """Builds breath and apnea events from newly committed breaths"""
+
+        events = []
+        for tBreath in tBreaths:
+            if previous is not None and tBreath > previous + APNEA_GAP:
+                events.append({"event": "apnea",
+                               "start": previous,
+                               "end": tBreath,
+                               "duration": tBreath - previous})
+            events.append({"event": "breath", "time": tBreath})
+            previous = tBreath
+        return events
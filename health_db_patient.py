@@ -1,4 +1,5 @@
 from pymodm import MongoModel, fields, EmbeddedMongoModel
+from pymongo import IndexModel, ASCENDING, DESCENDING
 
 
 class CPAP_Result(EmbeddedMongoModel):
@@ -14,6 +15,10 @@ class CPAP_Result(EmbeddedMongoModel):
     CharField to hold its content. The "apneaCount" field is an IntegerField to
     whold its content. Finally, "flowImg" is set up as a ImageField to hold its
     content.
+
+    New results are stored as CPAP_Record documents. CPAP_Result only
+    describes the results embedded in patients registered before that, until
+    migrate_results.py moves them out.
     """
 
     timeStamp = fields.DateTimeField()
@@ -22,6 +27,22 @@ class CPAP_Result(EmbeddedMongoModel):
     flowImg = fields.CharField()
 
 
+class CPAP_Latest(EmbeddedMongoModel):
+    """ Summary of the most recent CPAP result of a patient
+
+    This class inherits from EmbeddedMongoModel class of pymodm and copies
+    the "timeStamp", "breathingRate" and "apneaCount" fields of the latest
+    CPAP_Record of a patient, with "flowImg" holding the image_id of its
+    FlowImage, so that the monitoring station reads them together with the
+    patient in one query.
+    """
+
+    timeStamp = fields.DateTimeField()
+    breathingRate = fields.FloatField()
+    apneaCount = fields.IntegerField()
+    flowImg = fields.CharField(blank=True)
+
+
 class Patient(MongoModel):
     """ Database record for a patient
 
@@ -34,6 +55,12 @@ class Patient(MongoModel):
     field is IntegerField to contain its content. The "pressure"
     field is FloatField to contain its content. Finally, "results" is set up
     as a EmbeddedDocumentListField to hold a list of the CPAP_Result objects
+
+    The "results" list is only kept for documents that have not been migrated
+    yet, the results of a patient are CPAP_Record documents. The "latest"
+    field is an EmbeddedDocumentField holding the CPAP_Latest summary of the
+    most recent of them. Patients are indexed by ("roomNum",
+    "registered_timeStamp") to find the latest patient of a room.
     """
 
     mrn = fields.IntegerField(primary_key=True)
@@ -42,3 +69,51 @@ class Patient(MongoModel):
     pressure = fields.IntegerField(blank=True)
     results = fields.EmbeddedDocumentListField(CPAP_Result)
     registered_timeStamp = fields.DateTimeField()
+    latest = fields.EmbeddedDocumentField(CPAP_Latest, blank=True)
+
+    class Meta:
+        indexes = [IndexModel([("roomNum", ASCENDING),
+                               ("registered_timeStamp", DESCENDING)])]
+
+
+class FlowImage(MongoModel):
+    """ Database record for the flow plot of a CPAP result
+
+    Plots are kept apart from the results so that listing or reading results
+    does not transfer the images. They are stored content addressed: the
+    "image_id" primary key is the sha256 hex digest of the png, so an image
+    never changes once stored and saving the same png twice keeps one copy.
+    The "data" field is a BinaryField holding the png bytes.
+    """
+
+    image_id = fields.CharField(primary_key=True)
+    data = fields.BinaryField()
+
+    class Meta:
+        collection_name = "flow_images"
+        final = True
+
+
+class CPAP_Record(MongoModel):
+    """ Database record for a CPAP result of a patient
+
+    Each result is its own document in the "cpap_results" collection,
+    indexed by ("mrn", "timeStamp") so that the latest or older results of a
+    patient are found without reading the others. The "mrn" field references
+    the patient, and the result is deleted together with the patient. The
+    "timeStamp", "breathingRate" and "apneaCount" fields are as in
+    CPAP_Result, and "flowImg" holds the image_id of the FlowImage of the
+    result.
+    """
+
+    mrn = fields.ReferenceField(Patient,
+                                on_delete=fields.ReferenceField.CASCADE)
+    timeStamp = fields.DateTimeField()
+    breathingRate = fields.FloatField()
+    apneaCount = fields.IntegerField()
+    flowImg = fields.CharField(blank=True)
+
+    class Meta:
+        collection_name = "cpap_results"
+        final = True
+        indexes = [IndexModel([("mrn", ASCENDING), ("timeStamp", ASCENDING)])]
@@ -0,0 +1,167 @@
+"""
+Moves the CPAP results embedded in patient documents into their own
+collections
+
+Patients registered before results were stored as CPAP_Record documents keep
+every result, image included, in their "results" list. This copies each of
+those results into the "cpap_results" collection with its image decoded into
+the "flow_images" collection, then removes the list from the patient
+document. Every patient without a summary of its latest result gets one.
+Results already copied, for example by an interrupted earlier run, are not
+copied twice, so the migration can be run again safely:
+
+    python3 migrate_results.py --dry-run
+    python3 migrate_results.py --uri mongodb://localhost:27017/finalProjectDB
+"""
+
+import argparse
+import base64
+import binascii
+import sys
+from pymodm import errors as pymodm_errors
+from health_db_patient import Patient, CPAP_Record
+from cpap_server import (save_image, set_latest, latest_result, ensure_db,
+                         load_config)
+
+
+def is_migrated(mrn, timeStamp):
+    """
+    Checks whether a result has already been copied to the results collection
+
+    Args:
+        mrn (int): Medical Record Number of the patient
+        timeStamp (datetime): time stamp of the embedded result
+
+    Returns:
+        bool: True if a CPAP_Record with the same mrn and time stamp exists
+    """
+    try:
+        CPAP_Record.objects.raw({"mrn": mrn,
+                                 "timeStamp": timeStamp}).only("_id").first()
+    except pymodm_errors.DoesNotExist:
+        return False
+    return True
+
+
+def decode_image(encoded):
+    """
+    Decodes the base64 image of an embedded result
+
+    Args:
+        encoded (str): base64 encoded png
+
+    Returns:
+        bytes: the png, or the encoded text if it is not valid base64
+    """
+    try:
+        return base64.b64decode(encoded, validate=True)
+    except binascii.Error:
+        return encoded.encode()
+
+
+def migrate_patient(patient, dry_run=False):
+    """
+    Moves the embedded results of one patient into the results collection
+
+    Each result is saved as a CPAP_Record with its image stored by
+    save_image(), unless a record with the same time stamp exists already.
+    Images that are not valid base64 are stored as the bytes of their text,
+    so nothing is lost. The "results" list is then removed from the patient
+    document with an $unset, leaving the other fields untouched.
+
+    Args:
+        patient (Patient): patient with embedded results
+        dry_run (bool): count the results without writing anything
+
+    Returns:
+        int, int: number of results copied and of results already present
+    """
+    copied = skipped = 0
+    for result in patient.results:
+        if is_migrated(patient.mrn, result.timeStamp):
+            skipped += 1
+            continue
+        copied += 1
+        if dry_run:
+            continue
+        CPAP_Record(mrn=patient.mrn,
+                    timeStamp=result.timeStamp,
+                    breathingRate=result.breathingRate,
+                    apneaCount=result.apneaCount,
+                    flowImg=save_image(decode_image(result.flowImg))).save()
+    if not dry_run:
+        Patient._mongometa.collection.update_one(
+            {"_id": patient.mrn}, {"$unset": {"results": ""}})
+    return copied, skipped
+
+
+def migrate_results(dry_run=False, progress=None):
+    """
+    Migrates every patient that still has embedded results
+
+    Patients that have results but no "latest" summary, migrated ones
+    included, then get the summary of their most recent result.
+
+    Args:
+        dry_run (bool): count the results without writing anything
+        progress (callable/None): called with the mrn, the number of results
+                                  copied and the number skipped per patient
+
+    Returns:
+        dict: numbers of patients, copied results, skipped results and
+              summaries set
+    """
+    summary = {"patients": 0, "copied": 0, "skipped": 0, "latest": 0}
+    legacy = Patient.objects.raw({"results": {"$exists": True, "$ne": []}})
+    for patient in legacy:
+        copied, skipped = migrate_patient(patient, dry_run)
+        summary["patients"] += 1
+        summary["copied"] += copied
+        summary["skipped"] += skipped
+        if progress is not None:
+            progress(patient.mrn, copied, skipped)
+    for patient in Patient.objects.raw({"latest": None}).only("_id"):
+        record = latest_result(patient.mrn)
+        if record is not None and (dry_run or
+                                   set_latest(patient.mrn, record)):
+            summary["latest"] += 1
+    return summary
+
+
+def main(argv=None):
+    """
+    Command line entry point of the migration
+
+    The database is the one the server uses, see cpap_server.load_config(),
+    unless --uri is given.
+
+    Args:
+        argv (list/None): command line arguments, defaults to sys.argv
+
+    Returns:
+        int: 0
+    """
+    parser = argparse.ArgumentParser(
+        description="Move embedded CPAP results into their own collection")
+    parser.add_argument("--uri", default=None,
+                        help="MongoDB connection string with the database")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="count the results to move without writing")
+    args = parser.parse_args(argv)
+
+    ensure_db(load_config({"MONGO_URI": args.uri} if args.uri else None))
+
+    def report(mrn, copied, skipped):
+        print(f"patient {mrn}: {copied} results moved, {skipped} already "
+              f"present")
+
+    summary = migrate_results(args.dry_run, progress=report)
+    action = "would be moved" if args.dry_run else "moved"
+    print(f"{summary['copied']} results of {summary['patients']} patients "
+          f"{action}, {summary['skipped']} already present, "
+          f"{summary['latest']} latest results set")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,24 +1,22 @@
 import tkinter as tk
 from tkinter import ttk
 from PIL import Image, ImageTk
-import glob
 import requests
-import base64
-import io
-import matplotlib.image as mpimg
-from matplotlib import pyplot as plt
-from cpap_analyze import obtainMetrics
 from tkinter import filedialog
 import os
+import io
 import ast
-import json
-from gui_helperFuncs import decodeImg, dangerApnea, valPressureInput
+from collections import OrderedDict
+from gui_helperFuncs import dangerApnea, valPressureInput
 
 
 # server = "http://127.0.0.1:5000"
 server = "http://vcm-35156.vm.duke.edu:5000"
 imageSize = (475, 350)
 current_mrn = ""
+old_tests = OrderedDict()
+IMAGE_CACHE_SIZE = 32
+image_cache = OrderedDict()
 
 
 def get_roomlist():
@@ -37,40 +35,101 @@ def get_roomlist():
 
 def get_oldtests(mrn):
     """
-    Retrieves the list of old test dates for a patient MRN from the server.
+    Retrieves the old tests of a patient MRN from the server.
 
-    This function simply calls the /old_test_dates get route to return the test
-    dates that aren't the most recent. It then evaluates these test dates as a
-    tuple and uses the ast.literal_eval to format these dates in a easy-to-read
-    way
+    This function simply calls the /old_test_dates get route to return the
+    tests that aren't the most recent, with the ast.literal_eval used to read
+    them. Each test is labelled with its date in an easy-to-read way, and a
+    number is added to the labels of tests uploaded in the same second.
 
     Args:
         mrn (int): Patient MRN (Medical Record Number).
 
     Returns:
-        tuple: Tuple containing old test dates.
+        OrderedDict: test ids of the old tests by label, oldest first
     """
     oldtests_list = requests.get(server + "/old_test_dates/" + str(mrn))
-    return tuple(ast.literal_eval(oldtests_list.text))
-
-
-def get_oldimg(mrn, dateval):
+    oldtests = OrderedDict()
+    for test in ast.literal_eval(oldtests_list.text):
+        label = test["timeStamp"]
+        count = 1
+        while label in oldtests:
+            count += 1
+            label = "{} ({})".format(test["timeStamp"], count)
+        oldtests[label] = test["id"]
+    return oldtests
+
+
+def get_oldimg(mrn, test_id):
     """
     Get Old Image Function
 
-    Retrieves the encoded image text for a historical test for a given patient
-    MRN and date from the server. inputs the mrn and dateval provided from the
-    text label field and dropdown to send to the /get_old_img/ route
+    Retrieves the image id of a historical test for a given patient MRN and
+    test id from the server. inputs the mrn from the text label field and the
+    id of the test chosen in the dropdown to send to the /get_old_img/ route
 
     Args:
         mrn (str): Patient MRN (Medical Record Number).
-        dateval (str): Date value of the historical test.
+        test_id (str/None): id of the historical test from get_oldtests
+
+    Returns:
+        str/None: Image id, or None if the server has no such test
+    """
+    if test_id is None:
+        return None
+    oldimg = requests.get(server + "/get_old_img/" + mrn + "/" + test_id)
+    if oldimg.status_code != 200:
+        return None
+    return oldimg.text
+
+
+def get_image(image_id):
+    """
+    Retrieves a stored plot from the /image route by its image id
+
+    An image id always names the same png, so the most recently shown images
+    are kept in memory and the one-second refresh of a patient does not
+    download the plot again.
+
+    Args:
+        image_id (str): Image id returned by the server
+
+    Returns:
+        io.BytesIO/None: png buffer, or None if the server has no such image
+    """
+    if image_id in image_cache:
+        image_cache.move_to_end(image_id)
+    else:
+        r = requests.get(server + "/image/" + image_id)
+        if r.status_code != 200:
+            return None
+        image_cache[image_id] = r.content
+        while len(image_cache) > IMAGE_CACHE_SIZE:
+            image_cache.popitem(last=False)
+    return io.BytesIO(image_cache[image_id])
+
+
+def open_image(image_id):
+    """
+    Opens a stored plot as a thumbnail for the GUI
+
+    Args:
+        image_id (str/None): Image id returned by the server
 
     Returns:
-        str: Encoded image text.
+        PIL.Image.Image/None: the thumbnail, or None if there is no valid plot
     """
-    oldimg_text = requests.get(server + "/get_old_img/" + mrn + "/" + dateval)
-    return oldimg_text.text
+    if image_id is None:
+        return None
+    buffer = get_image(image_id)
+    if buffer is None:
+        return None
+    try:
+        image_obj = Image.open(buffer)
+        image_obj.thumbnail(imageSize)
+    except (OSError, ValueError):  # removes error when running test data
+        return None
+    return image_obj
 
 
 def get_patient_info(roomNum):
@@ -80,7 +139,7 @@ def get_patient_info(roomNum):
     This function simply takes in a room number and returns a list of all the
     necessary information and test results (most recent) to be displayed on the
     left side of the gui. These results include patient MRN, name, pressure,
-    test time, breathing rate, apnea count, and encoded image text
+    test time, breathing rate, apnea count, and image id
 
     Args:
         roomNum (int): Room number.
@@ -97,7 +156,7 @@ def get_patient_info(roomNum):
     t = pt['time']  # Test Time
     br = pt['br']  # Breathing Rate
     ac = pt['ac']  # Apnea Count
-    img = pt['img']  # Encoded Image Text
+    img = pt['img']  # Image Id
     return mrn, name, press, t, br, ac, img
 
 
@@ -253,12 +312,12 @@ def main_window():
         display_all_patient_info(*get_patient_info(int(selected_room)))
 
     def display_all_patient_info(mrn, name, pressure, test_time, breath_rate,
-                                 apnea_count, image_text):
+                                 apnea_count, image_id):
         """
         Display all patient information on the GUI.
 
         This function takes patient information as input and updates the GUI
-        labels and values accordingly. It also decodes and displays the
+        labels and values accordingly. It also loads and displays the
         patient's image, updates the apnea count label color, and manages the
         state of various buttons and dropdowns.
 
@@ -269,12 +328,12 @@ def main_window():
             test_time (str): Date of the test
             breath_rate (str): Breathing rate
             apnea_count (str): Apnea count
-            image_text (str): Encoded image text
+            image_id (str): Image id, or "N/A" if there is no result
 
         Returns:
             None
         """
-        global current_mrn
+        global current_mrn, old_tests
         current_mrn = mrn
 
         add_pressure_button.config(state=tk.NORMAL)
@@ -287,8 +346,8 @@ def main_window():
         test_time_var.set(test_time)
         apnea_count_display.configure(foreground=default_foreground_color)
 
-        # Decode Image and Add Image to GUI
-        if image_text == "N/A":  # Check if there is a result
+        # Load Image and Add Image to GUI
+        if image_id == "N/A":  # Check if there is a result
             print("No plot to display")
             historic_dropdown['state'] = 'disabled'
             historic_var.set("No Historical Tests")
@@ -298,12 +357,14 @@ def main_window():
             clearimg()
         else:
             update_apnea_label_color(apnea_count)
-            newtestvals = get_oldtests(mrn)  # fills dropdown w old tests
+            old_tests = get_oldtests(mrn)  # fills dropdown w old tests
+            newtestvals = tuple(old_tests)
             update_hist_button.config(state=tk.NORMAL)
             historic_dropdown['state'] = 'enabled'
             historic_dropdown['values'] = newtestvals
 
-            if len(image_text) < 50:  # removes error when running test data
+            image_obj = open_image(image_id)
+            if image_obj is None:
                 print("plot not valid")
                 clearimg()
 
@@ -312,9 +373,6 @@ def main_window():
                     historic_var.set("No Historical Tests")
                     clearimg2()
             else:
-                buffer = decodeImg(image_text)
-                image_obj = Image.open(buffer)
-                image_obj.thumbnail(imageSize)
                 pil_image = ImageTk.PhotoImage(image_obj)
                 image_label.pil_image = image_obj
                 image_label.config(image=pil_image)
@@ -354,7 +412,7 @@ def main_window():
         """
         Display the historical CPAP data image on the GUI.
 
-        This function retrieves the selected MRN and date value, gets the
+        This function retrieves the selected MRN and old test, gets the
         historical image using get_oldimg, and displays it on the GUI.
 
         Returns:
@@ -362,16 +420,13 @@ def main_window():
         """
         clearimg2()
         mrn = patient_mrn_var.get()
-        dateval = historic_var.get()
-        img_text = get_oldimg(mrn, dateval)
+        test_id = old_tests.get(historic_var.get())
+        image2_obj = open_image(get_oldimg(mrn, test_id))
 
-        if len(img_text) < 50:
+        if image2_obj is None:
             print("plot not valid")
             clearimg()
         else:
-            buffer = decodeImg(img_text)
-            image2_obj = Image.open(buffer)
-            image2_obj.thumbnail(imageSize)
             pil2_image = ImageTk.PhotoImage(image2_obj)
             image2_label.pil2_image = image2_obj
             image2_label.config(image=pil2_image)
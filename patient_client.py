@@ -1,11 +1,8 @@
 import tkinter as tk
 from tkinter import ttk
 from PIL import Image, ImageTk
-import glob
 import requests
-import matplotlib.image as mpimg
-from matplotlib import pyplot as plt
-from cpap_analyze import obtainMetrics
+from cpap_logging import configureLogging
 from tkinter import filedialog
 import os
 from gui_helperFuncs import dangerApnea, decodeImg, valPressureInput
@@ -21,7 +18,9 @@ def calcHealthMetrics(filename):
     Calculate CPAP Metrics given a filename/
 
     This function processes a CPAP data file to obtain metrics and an image of
-    flow vs. time plot
+    flow vs. time plot. Results are cached by file content, so calculating
+    the metrics of the same file again returns immediately. The analysis
+    modules are imported on first use to keep the GUI start fast.
 
     Args:
         filename (str): The path to the file containing relevant data.
@@ -33,7 +32,9 @@ def calcHealthMetrics(filename):
             - apnea_count (int): The count of apnea occurrences.
             - encoded_plot (str): The encoded plot of health metrics.
     """
-    placeholder, r = obtainMetrics(filename)
+    from cpap_cache import cachedMetrics
+
+    placeholder, r = cachedMetrics(filename)
 
     return r['breath_rate_bpm'], r['apnea_count'], r['encoded_plot']
 
@@ -260,6 +261,8 @@ def main_window():
                                               title="Select a File",
                                               filetypes=(("Text files",
                                                           "*.txt"),
+                                                         ("Binary recordings",
+                                                          "*.cpap"),
                                                          ("All files", "*.*")))
         # Change label contents
 
@@ -532,8 +535,11 @@ def main_window():
     clear_button.grid(row=11, column=0, pady=10, columnspan=3)
 
     pressureQueryResponse()
+    from cpap_analyze import prewarm
+    prewarm()
     root.mainloop()
 
 
 if __name__ == "__main__":
+    configureLogging()
     main_window()
@@ -3,6 +3,34 @@ import numpy as np
 import copy
 from testfixtures import LogCapture
 import os
+import subprocess
+import sys
+
+
+@pytest.mark.parametrize("module", [
+    "cpap_analyze", "cpap_server", "patient_client",
+    "monitoring_station_client"])
+def test_lazy_scientific_imports(module):
+
+    code = (f"import sys, {module}\n"
+            "print(sorted(m for m in ('scipy', 'matplotlib', 'cpap_analyze')"
+            " if m in sys.modules))")
+    output = subprocess.run([sys.executable, "-c", code], check=True,
+                            capture_output=True, text=True).stdout
+
+    expected = ["cpap_analyze"] if module == "cpap_analyze" else []
+    assert output.strip() == str(expected)
+
+
+def test_prewarm():
+
+    from cpap_analyze import prewarm
+
+    prewarm().join()
+
+    assert "cpap_cache" in sys.modules
+    assert "scipy.interpolate" in sys.modules
+    assert "matplotlib.backends.backend_agg" in sys.modules
 
 
 @pytest.mark.parametrize("testFile, numLines, checkLogging", [
@@ -26,6 +54,77 @@ def test_importData(testFile, numLines, checkLogging):
         assert len(i) == 7
 
 
+@pytest.mark.parametrize("lines, numRows, dropped", [
+    (["1,2,3,4,5,6,7", "2,2,3,4,5,6,7"], 2,
+     {"missing_data": 0, "non_numerical": 0}),
+    (["1,2,3,4,5,6,7", "2,2,3,4,5,6", ""], 1,
+     {"missing_data": 2, "non_numerical": 0}),
+    (["1,2,3,4,5,6,7", "2,A,3,4,5,6,7", "3,2,NaN,4,5,6,7"], 1,
+     {"missing_data": 0, "non_numerical": 2}),
+    (["1,2,3,4,5,6", "2,2,3,4,,6,7", "3,2,3,4,5,6,7"], 1,
+     {"missing_data": 1, "non_numerical": 1}),
+    ([], 0, {"missing_data": 0, "non_numerical": 0})])
+def test_parseLines(lines, numRows, dropped):
+
+    from cpap_analyze import parseLines
+
+    with LogCapture() as log_c:
+        data, answer = parseLines(lines)
+
+    assert data.shape == (numRows, 7)
+    assert data.dtype == np.dtype("float")
+    assert answer == dropped
+    assert len(log_c.records) == sum(dropped.values())
+
+
+def test_loadRecording(tmp_path):
+
+    from cpap_analyze import loadRecording, ValidationReport
+
+    testFile = tmp_path / "recording.txt"
+    testFile.write_text("Time,p2,ins,exp,a,b,c\n"
+                        "0.00,5018,1638,5039,5276,5276,1638\n"
+                        "0.01,5020,NaN,5039,5276,5276,1638\n"
+                        "0.02,5024,1638,5041,5276,5276,1638\n")
+
+    report = ValidationReport()
+    with LogCapture() as log_c:
+        data, dropped = loadRecording(str(testFile), report)
+
+    log_c.check(("root", "ERROR", "Non-Numerical Entry on line 3"))
+    assert np.array_equal(data[:, 0], [0.0, 0.02])
+    assert data[1, 3] == 5041
+    assert dropped == {"missing_data": 0, "non_numerical": 1}
+    assert report.summary() == {
+        "rows": 3, "valid": 2,
+        "dropped": {"missing_data": 0, "non_numerical": 1},
+        "sample_lines": {"missing_data": [], "non_numerical": [3]}}
+
+
+def test_ValidationReport():
+
+    from cpap_analyze import parseLines, ValidationReport
+
+    lines = ["1,2,3,4,5,6,7", "1,2", "1,a,3,4,5,6,7"]
+    report = ValidationReport(sampleLimit=3, logLimit=2)
+
+    with LogCapture() as log_c:
+        parseLines(lines, report, firstLine=2)
+        parseLines(lines[1:] + lines[1:2], report, firstLine=5)
+        parseLines(lines[1:] + lines[1:2], report, firstLine=8)
+
+    log_c.check(
+        ("root", "ERROR", "Missing Data on line 3"),
+        ("root", "ERROR", "Non-Numerical Entry on line 4"),
+        ("root", "WARNING",
+         "Further dropped lines are only counted in the validation report"))
+    assert report.summary() == {
+        "rows": 9, "valid": 1,
+        "dropped": {"missing_data": 5, "non_numerical": 3},
+        "sample_lines": {"missing_data": [3, 5, 7],
+                         "non_numerical": [4, 6, 9]}}
+
+
 @pytest.mark.parametrize("arr, errorMsg, expected", [
     (np.array([1, "A", 6, 7, 8, 9, 10]),
      "Non-Numerical Entry", False),
@@ -72,6 +171,23 @@ def test_adcToPressure():
         assert np.allclose(answer[i], groundTruth[i])
 
 
+@pytest.mark.parametrize("inplace", [True, False])
+def test_pressureArray(inplace):
+
+    from cpap_analyze import pressureArray
+
+    adc = np.array([[2.685, 5018, 1638, 5039, 5276, 5276, 1638],
+                    [2.695, 5065, 5070, 1638, 5224, 5224, 1638]])
+    original = adc.copy()
+
+    answer = pressureArray(adc, inplace=inplace)
+
+    assert np.allclose(answer[0], [2.685, 6.55008774, 0, 6.59078355,
+                                   7.05006485, 7.05006485, 0])
+    assert (answer is adc) == inplace
+    assert np.array_equal(adc, original) != inplace
+
+
 def test_calcFlows():
 
     from cpap_analyze import calcFlows
@@ -109,6 +225,37 @@ def test_flowTimeSeries():
     assert np.isclose(0.01, span)
 
 
+def test_flowArrays():
+
+    from cpap_analyze import flowArrays, calcFlows
+
+    testInput = np.array([[2.685, 6.55008774, 0, 6.59078355, 0, 0, 0],
+                          [2.695, 6.6140383, 6.65279622, 0, 0, 0, 0],
+                          [2.705, 3.0, 10.0, 10.0, 0, 0, 0]])
+
+    t, q = flowArrays(testInput)
+
+    assert np.array_equal(t, [2.685, 2.695, 2.705])
+    assert q.tolist() == [-0.379769245383582, 0.37061686159445306,
+                          calcFlows(10.0, 3.0)]
+
+
+def test_channelFlows():
+
+    from cpap_analyze import channelFlows, flowArrays
+
+    testInput = np.array([[2.685, 6.55008774, 0, 6.59078355, 3, 10, 10],
+                          [2.695, 6.6140383, 6.65279622, 0, 0, 0, 0],
+                          [2.705, 3.0, 10.0, 10.0, 6, 6.1, 6.3]])
+
+    t, q = channelFlows(testInput)
+
+    assert np.array_equal(t, testInput[:, 0])
+    assert q.shape == (2, 3)
+    assert np.array_equal(q[0], flowArrays(testInput)[1])
+    assert np.array_equal(q[1], flowArrays(testInput[:, [0, 4, 5, 6]])[1])
+
+
 def test_findPeaks():
 
     from cpap_analyze import findPeaks
@@ -121,6 +268,121 @@ def test_findPeaks():
     assert len(peak_x) == 4
 
 
+def test_findPeaks_plot_modes():
+
+    from cpap_analyze import findPeaks, DeferredPlot
+
+    x = np.linspace(0, 8 * np.pi, 10000)
+    y = np.sin(x)
+
+    peak_x, encodedPlot = findPeaks(x, y)
+    none_x, noPlot = findPeaks(x, y, plot=None)
+    deferred_x, deferred = findPeaks(x, y, plot="deferred")
+
+    assert noPlot is None
+    assert np.array_equal(none_x, peak_x)
+    assert np.array_equal(deferred_x, peak_x)
+    assert isinstance(deferred, DeferredPlot)
+    assert not deferred.rendered
+    assert deferred.encoded() == encodedPlot
+    assert deferred.rendered
+
+
+def test_DeferredPlot_sizes_kept():
+
+    from cpap_analyze import findPeaks, PLOT_SIZES_KEPT
+
+    x = np.linspace(0, 8 * np.pi, 2000)
+    deferred_x, deferred = findPeaks(x, np.sin(x), plot="deferred")
+
+    default = deferred.encoded()
+    for width in range(40, 60):
+        deferred.encoded((width, 40))
+    latest = deferred.encoded((59, 40))
+
+    assert len(deferred._encoded) == PLOT_SIZES_KEPT + 1
+    assert deferred.encoded() is default
+    assert deferred.encoded((59, 40)) is latest
+
+
+@pytest.mark.parametrize("engine", ["spline", "sectioned", "savgol"])
+def test_smoothPeaks_engines(engine):
+
+    from cpap_analyze import smoothPeaks
+
+    x = np.linspace(0, 80 * np.pi, 40000)
+    y = np.sin(x) + 0.02 * np.random.default_rng(0).standard_normal(len(x))
+
+    X_, Y_, expected = smoothPeaks(x, y)
+    engine_X, engine_Y, peaks = smoothPeaks(x, y, engine)
+
+    assert np.array_equal(engine_X, X_)
+    assert len(peaks) == len(expected) == 40
+    assert np.abs(X_[peaks] - X_[expected]).max() <= 1.01 * (X_[1] - X_[0])
+    if engine == "sectioned":
+        assert np.allclose(engine_Y, Y_, rtol=0, atol=1e-12)
+
+
+def test_smoothPeaks_step():
+
+    from cpap_analyze import smoothPeaks
+
+    x = np.linspace(0, 8 * np.pi, 10000)
+
+    X_, Y_, peaks = smoothPeaks(x, np.sin(x), step=0.5)
+
+    assert np.allclose(np.diff(X_), 0.5)
+    assert len(peaks) == 4
+
+
+def test_renderPlot_threads():
+
+    from concurrent.futures import ThreadPoolExecutor
+    from cpap_analyze import smoothPeaks, renderPlot
+
+    curves = [smoothPeaks(np.linspace(0, n * np.pi, 10000),
+                          np.sin(np.linspace(0, n * np.pi, 10000)))
+              for n in (4, 8, 12, 16)]
+    expected = [renderPlot(*curve) for curve in curves]
+
+    with ThreadPoolExecutor(4) as pool:
+        answer = list(pool.map(lambda curve: renderPlot(*curve),
+                               curves * 3))
+
+    assert answer == expected * 3
+
+
+@pytest.mark.parametrize("y, width, keep, expected", [
+    (np.arange(6), 4, (), [0, 1, 2, 3, 4, 5]),
+    (np.array([0, 5, 1, 2, 9, 3, 4, 8, 6, 7]), 2, (), [0, 4, 5, 7, 9]),
+    (np.array([0, 5, 1, 2, 9, 3, 4, 8, 6, 7]), 2, (2,), [0, 2, 4, 5, 7, 9]),
+    (np.array([3, 1, 2, 0, 4, 6, 5, 2, 1, 3, 9]), 3,
+     (), [0, 3, 5, 7, 8, 10])])
+def test_envelope(y, width, keep, expected):
+
+    from cpap_analyze import envelope
+
+    answer = envelope(y, width, keep)
+
+    assert answer.tolist() == expected
+
+
+def test_renderPlot_size():
+
+    from PIL import Image
+    from gui_helperFuncs import decodeImg
+    from cpap_analyze import smoothPeaks, renderPlot
+
+    x = np.linspace(0, 200 * np.pi, 200000)
+    curve = smoothPeaks(x, np.sin(x))
+
+    thumbnail = Image.open(decodeImg(renderPlot(*curve, size=(475, 350))))
+    full = Image.open(decodeImg(renderPlot(*curve)))
+
+    assert thumbnail.size == (475, 350)
+    assert full.size == (640, 480)
+
+
 def test_breathAnalysis():
 
     from cpap_analyze import breathAnalysis
@@ -132,6 +394,157 @@ def test_breathAnalysis():
     assert apnea_ctr == 2
 
 
+def test_breathStatistics():
+
+    from cpap_analyze import breathStatistics, apneaEvents
+
+    statistics = breathStatistics([10, 15, 16, 27, 28, 30, 42], 80)
+
+    assert np.array_equal(statistics["intervals"], [5, 1, 11, 1, 2, 12])
+    assert np.array_equal(statistics["apnea_start"], [16, 30])
+    assert np.array_equal(statistics["apnea_end"], [27, 42])
+    assert np.array_equal(statistics["apnea_duration"], [11, 12])
+    assert statistics["apnea_index"] == 90
+    assert statistics["interval_percentiles"]["p50"] == 3.5
+    assert statistics["interval_percentiles"]["p95"] == 11.75
+    assert apneaEvents(statistics) == [
+        {"start": 16, "end": 27, "duration": 11},
+        {"start": 30, "end": 42, "duration": 12}]
+
+    statistics = breathStatistics([10], 80)
+    assert statistics["apnea_index"] == 0
+    assert statistics["interval_percentiles"]["p5"] is None
+
+
+def test_epochMetrics():
+
+    from cpap_analyze import epochMetrics
+
+    t = np.arange(0, 70.5, 0.5)
+    f = np.ones(len(t))
+    epochs = epochMetrics(t, f, [1, 5, 12, 29, 31, 45, 59, 62], epoch=30)
+
+    assert np.array_equal(epochs["start"], [0, 30, 60])
+    assert np.array_equal(epochs["breaths"], [4, 3, 1])
+    assert np.array_equal(epochs["breath_rate_bpm"], [8, 6, 6])
+    assert np.array_equal(epochs["apnea_count"], [1, 2, 0])
+    assert np.array_equal(epochs["leakage"], [30, 30, 10])
+    with pytest.raises(ValueError):
+        epochMetrics(t, f, [1, 5], epoch=1e-9)
+
+
+def test_obtainMetrics_epochs(tmp_path):
+
+    from cpap_analyze import obtainMetrics
+    from test_cpap_stream import write_recording
+
+    testFile = str(tmp_path / "recording.txt")
+    write_recording(testFile)
+
+    with LogCapture():
+        patient, metrics = obtainMetrics(testFile, plot=None, epoch=30)
+
+    epochs = metrics["epochs"]
+    assert epochs["epoch"] == 30
+    assert epochs["start"] == [0, 30, 60, 90]
+    assert sum(epochs["breaths"]) == metrics["breaths"]
+    assert sum(epochs["apnea_count"]) == metrics["apnea_count"] == 1
+    assert epochs["apnea_count"][1] == 1
+    assert np.isclose(sum(epochs["leakage"]), metrics["leakage"])
+
+
+def test_obtainMetrics_profile(tmp_path):
+
+    from cpap_analyze import obtainMetrics, StageProfile
+    from test_cpap_stream import write_recording
+
+    testFile = str(tmp_path / "recording.txt")
+    write_recording(testFile, seconds=60)
+
+    records = []
+    with LogCapture():
+        patient, plain = obtainMetrics(testFile, plot=None)
+        patient, metrics = obtainMetrics(testFile, profile=records.append)
+        patient, traced = obtainMetrics(
+            testFile, plot=None, profile=StageProfile(memory=True))
+
+    assert "profile" not in plain
+    assert metrics["profile"] == records
+    assert [r["stage"] for r in records] == [
+        "parse", "pressure", "flow", "smoothing", "peaks", "plot",
+        "breaths", "leakage"]
+    assert records[0]["rows"] == 6000
+    assert records[4]["rows"] == metrics["breaths"]
+    assert all(r["seconds"] >= 0 and r["memory_bytes"] is None
+               for r in records)
+    assert all(type(r["memory_bytes"]) is int and r["peak_bytes"] >= 0
+               for r in traced["profile"])
+
+
+def test_StageProfile_overlapping_stages():
+
+    import threading
+    import tracemalloc
+    from cpap_analyze import StageProfile
+
+    first, second = StageProfile(memory=True), StageProfile(memory=True)
+    started, finished = threading.Event(), threading.Event()
+    kept = []
+
+    def other():
+        with second.stage("other"):
+            started.set()
+            finished.wait()
+            kept.append(bytearray(1000000))
+
+    thread = threading.Thread(target=other)
+    with first.stage("first"):
+        thread.start()
+        started.wait()
+    tracing = tracemalloc.is_tracing()
+    finished.set()
+    thread.join()
+
+    assert tracing
+    assert not tracemalloc.is_tracing()
+    assert second.stages[0]["memory_bytes"] > 900000
+    assert first.stages[0]["peak_bytes"] is None
+    assert second.stages[0]["peak_bytes"] is None
+
+    tracemalloc.start()
+    try:
+        with first.stage("traced"):
+            pass
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+    assert first.stages[1]["peak_bytes"] is None
+
+
+def test_obtainMetrics_channels(tmp_path):
+
+    from cpap_analyze import obtainMetrics
+    from cpap_binary import convertRecording
+    from cpap_bench import generateRecording
+
+    testFile = str(tmp_path / "recording.txt")
+    generateRecording(testFile, duration=300, apneaRate=12)
+
+    with LogCapture():
+        patient, metrics = obtainMetrics(testFile, plot=None, channels=True)
+        binFile, dropped = convertRecording(testFile)
+        patient, binary = obtainMetrics(binFile, plot=None, channels=True)
+
+    first, second = metrics["venturis"]
+    assert first["breaths"] == metrics["breaths"]
+    assert first["leakage"] == metrics["leakage"]
+    assert first["apnea_index"] == metrics["apnea_index"]
+    assert second["breaths"] == first["breaths"]
+    assert second["apnea_count"] == first["apnea_count"] == 1
+    assert 0 < second["leakage"] < first["leakage"]
+    assert binary["venturis"] == metrics["venturis"]
+
+
 @pytest.mark.parametrize("t, f, leakageAns, checkLogging", [
     ([0, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6],
      [0, 0, 0, 3, 3, 0, 0, -4, -4, 0, 0], -1, True),
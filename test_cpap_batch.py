@@ -0,0 +1,66 @@
+import pytest
+import csv
+import json
+import os
+from test_cpap_stream import write_recording
+
+
+@pytest.fixture
+def recordings(tmp_path):
+    folder = tmp_path / "recordings"
+    folder.mkdir()
+    for i, bpm in enumerate((12, 15, 18)):
+        write_recording(folder / f"patient_0{i}.txt", seconds=60, bpm=bpm,
+                        apnea=(0, 0))
+    (folder / "patient_09.txt").write_text("Time,p2,ins,exp,a,b,c\n")
+    (folder / "notes.md").write_text("not a recording")
+    return folder
+
+
+def test_findRecordings(recordings):
+
+    from cpap_batch import findRecordings
+    from cpap_binary import convertRecording
+
+    convertRecording(str(recordings / "patient_00.txt"))
+
+    answer = findRecordings([str(recordings),
+                             str(recordings / "patient_0[12].txt")])
+
+    assert [os.path.basename(file) for file in answer] == \
+        ["patient_00.cpap", "patient_01.txt", "patient_02.txt",
+         "patient_09.txt"]
+
+
+def test_batchAnalyze(recordings, tmp_path):
+
+    from cpap_batch import findRecordings, batchAnalyze
+
+    files = findRecordings([str(recordings)])
+    output_dir = tmp_path / "results"
+
+    results = batchAnalyze(files, workers=2, output_dir=str(output_dir))
+
+    assert [summary["file"] for summary in results] == files
+    assert [summary["ok"] for summary in results] == [True] * 3 + [False]
+    assert [summary["metrics"]["breaths"] for summary in results[:3]] == \
+        [12, 15, 18]
+    assert results[3]["error"].startswith("ValueError")
+    with open(output_dir / "patient_01.json") as in_file:
+        assert json.load(in_file)["breaths"] == 15
+
+
+def test_main(recordings, tmp_path, capsys):
+
+    from cpap_batch import main
+
+    combined = tmp_path / "results.csv"
+
+    answer = main([str(recordings), "-j", "2", "-c", str(combined)])
+
+    with open(combined) as in_file:
+        rows = list(csv.DictReader(in_file))
+    assert answer == 1
+    assert [row["ok"] for row in rows] == ["True"] * 3 + ["False"]
+    assert rows[0]["breaths"] == "12"
+    assert "3/4 recordings analyzed" in capsys.readouterr().out
@@ -0,0 +1,87 @@
+import pytest
+from testfixtures import LogCapture
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("90s", 90),
+    ("10m", 600),
+    ("12h", 43200),
+    ("45", 45),
+])
+def test_parseDuration(text, expected):
+
+    from cpap_bench import parseDuration
+
+    assert parseDuration(text) == expected
+
+
+def test_generateRecording(tmp_path):
+
+    from cpap_bench import generateRecording
+    from cpap_analyze import loadRecording, obtainMetrics
+
+    testFile = str(tmp_path / "synthetic.txt")
+    summary = generateRecording(testFile, duration=600, bpm=12,
+                                apneaRate=12, corruption=0.01)
+
+    with LogCapture():
+        data, dropped = loadRecording(testFile)
+        patient, metrics = obtainMetrics(testFile, plot=None)
+
+    assert summary["missing_data"] > 0 and summary["non_numerical"] > 0
+    assert dropped == {"missing_data": summary["missing_data"],
+                       "non_numerical": summary["non_numerical"]}
+    assert len(data) + sum(dropped.values()) == summary["rows"] == 60000
+    assert len(summary["apneas"]) == metrics["apnea_count"] == 2
+    assert abs(metrics["breath_rate_bpm"] - 12) < 1.5
+    assert metrics["leakage"] > 0
+
+
+def test_runBenchmarks():
+
+    from cpap_bench import runBenchmarks
+
+    with LogCapture():
+        run = runBenchmarks(["30s"], repeat=1, corruption=0.01)
+
+    result, = run["results"]
+    assert result["rows"] == 3000
+    assert list(result["stages"]) == [
+        "loadRecording", "pressureArray", "flowArrays", "smoothPeaks",
+        "renderPlot", "breathAnalysis", "calc_leakage", "obtainMetrics"]
+    assert all(stage["seconds"] > 0 and stage["peak_bytes"] > 0
+               for stage in result["stages"].values())
+    assert run["parameters"]["corruption"] == 0.01
+    assert "numpy" in run["environment"]
+
+
+def test_compareResults():
+
+    from cpap_bench import compareResults
+
+    def run(seconds):
+        return {"results": [{"size": "1m", "stages": {
+            stage: {"seconds": value, "peak_bytes": None}
+            for stage, value in seconds.items()}}]}
+
+    old = run({"loadRecording": 0.1, "smoothPeaks": 0.001, "gone": 1})
+    new = run({"loadRecording": 0.2, "smoothPeaks": 0.002, "added": 1})
+    comparison = compareResults(new, old)
+
+    assert [(row["stage"], row["regression"]) for row in comparison] == [
+        ("loadRecording", True), ("smoothPeaks", False)]
+    assert comparison[0]["ratio"] == 2
+
+
+def test_startupTimes():
+
+    from cpap_bench import startupTimes
+
+    startup = startupTimes(["cpap_analyze", "no_such_module"], repeat=2)
+
+    assert list(startup) == ["python", "cpap_analyze", "no_such_module"]
+    assert startup["cpap_analyze"]["error"] is None
+    assert startup["cpap_analyze"]["seconds"] <= \
+        startup["cpap_analyze"]["median"]
+    assert startup["no_such_module"]["error"].startswith(
+        "ModuleNotFoundError")
@@ -0,0 +1,60 @@
+import numpy as np
+from testfixtures import LogCapture
+from test_cpap_stream import write_recording
+
+
+def test_convertRecording(tmp_path):
+
+    from cpap_binary import convertRecording, isBinaryRecording, loadBinary
+    from cpap_analyze import loadRecording
+
+    txtFile = str(tmp_path / "recording.txt")
+    write_recording(txtFile, seconds=10)
+
+    with LogCapture():
+        binFile, dropped = convertRecording(txtFile)
+        expected, expectedDropped = loadRecording(txtFile)
+
+    assert binFile == str(tmp_path / "recording.cpap")
+    assert dropped == expectedDropped == {"missing_data": 1,
+                                          "non_numerical": 0}
+    assert isBinaryRecording(binFile)
+    assert not isBinaryRecording(txtFile)
+
+    columns = loadBinary(binFile)
+    assert [column.dtype.str for column in columns] == [
+        "<f8", "<u2", "<f8", "<f8", "<u2", "<u2", "<u2"]
+    assert all(isinstance(column, np.memmap) for column in columns)
+    assert np.array_equal(np.column_stack(columns), expected)
+
+
+def test_writeBinary_columnDtype(tmp_path):
+
+    from cpap_binary import writeBinary, binaryToArray
+
+    data = np.array([[0.0, 1, 2.5, 70000, -1, 0, 65535],
+                     [0.1, 3, 4.0, 5, 7, 1, 0]])
+    binFile = tmp_path / "recording.cpap"
+    writeBinary(data, binFile)
+
+    assert np.array_equal(binaryToArray(binFile), data)
+
+
+def test_obtainMetrics_binary(tmp_path):
+
+    from cpap_binary import convertRecording
+    from cpap_analyze import obtainMetrics
+
+    txtFile = str(tmp_path / "recording.txt")
+    write_recording(txtFile)
+
+    with LogCapture():
+        binFile, dropped = convertRecording(txtFile)
+        patient, expected = obtainMetrics(txtFile, plot=None)
+        patient, metrics = obtainMetrics(binFile, plot=None)
+
+    validation = metrics.pop("validation")
+    expectedValidation = expected.pop("validation")
+    assert metrics == expected
+    assert validation["rows"] == validation["valid"] == \
+        expectedValidation["valid"]
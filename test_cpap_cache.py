@@ -0,0 +1,105 @@
+import pytest
+import os
+import shutil
+from testfixtures import LogCapture
+from test_cpap_stream import write_recording
+
+
+@pytest.fixture
+def recording(tmp_path):
+    testFile = tmp_path / "patient_01.txt"
+    write_recording(testFile, seconds=60, apnea=(0, 0))
+    return str(testFile)
+
+
+def test_fileDigest(tmp_path):
+
+    import hashlib
+    from cpap_cache import fileDigest
+
+    testFile = tmp_path / "hello.txt"
+    testFile.write_bytes(b"Hello World!!" * 100000)
+
+    answer = fileDigest(testFile)
+
+    assert answer == hashlib.sha256(b"Hello World!!" * 100000).hexdigest()
+
+
+def test_ResultCache_hit(recording, tmp_path):
+
+    from cpap_cache import ResultCache
+    from cpap_analyze import obtainMetrics
+
+    cache = ResultCache(str(tmp_path / "cache"))
+    with LogCapture() as log_c:
+        placeholder, expected = obtainMetrics(recording)
+        placeholder, first = cache.obtainMetrics(recording)
+        copy = shutil.copy(recording, tmp_path / "renamed.txt")
+        placeholder, second = cache.obtainMetrics(str(copy))
+
+    assert first["breaths"] == second["breaths"] == expected["breaths"]
+    assert second["encoded_plot"] == expected["encoded_plot"]
+    assert second["breath_times"] == expected["breath_times"]
+    assert ("root", "INFO", f"Cached Analysis of: {copy}") in \
+        [(r.name, r.levelname, r.getMessage()) for r in log_c.records]
+
+
+def test_ResultCache_profile(recording, tmp_path):
+
+    from cpap_cache import ResultCache
+
+    cache = ResultCache(str(tmp_path / "cache"))
+    with LogCapture():
+        placeholder, first = cache.obtainMetrics(recording)
+        placeholder, profiled = cache.obtainMetrics(recording, profile=True)
+
+    assert "profile" not in first
+    assert profiled["profile"][0]["stage"] == "parse"
+    assert len(os.listdir(cache.directory)) == 1
+
+
+def test_ResultCache_key(recording, tmp_path):
+
+    from cpap_cache import ResultCache
+
+    cache = ResultCache(str(tmp_path / "cache"))
+    key = cache.key(recording)
+
+    assert cache.key(recording) == key
+    assert cache.key(recording, plot=False) != key
+    assert cache.key(recording, engine="savgol") != key
+    with open(recording, "a") as out_file:
+        out_file.write("60.00,5000,5000,5000,5000,5000,5000\n")
+    assert cache.key(recording) != key
+
+
+def test_ResultCache_evict(tmp_path):
+
+    from cpap_cache import ResultCache
+
+    cache = ResultCache(str(tmp_path / "cache"), maxBytes=400)
+    for i, key in enumerate("abc"):
+        cache.put(key, {"encoded_plot": "x" * 100})
+        os.utime(cache.path(key), (i, i))
+    cache.get("a")
+    cache.put("d", {"encoded_plot": "x" * 100})
+
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+    assert cache.get("d") is not None
+
+
+def test_ResultCache_evicted_while_read(tmp_path, monkeypatch):
+
+    from cpap_cache import ResultCache
+
+    cache = ResultCache(str(tmp_path / "cache"))
+    cache.put("a", {"encoded_plot": "x"})
+
+    def evicted(path, *args):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(os, "utime", evicted)
+
+    assert cache.get("a") == {"encoded_plot": "x"}
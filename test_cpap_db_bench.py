@@ -0,0 +1,33 @@
+import pytest
+from health_db_patient import Patient, CPAP_Record
+from test_cpap_server import database
+
+
+@pytest.mark.usefixtures("database")
+def test_runBenchmark():
+
+    from cpap_db_bench import runBenchmark, formatResult, MRN_BASE
+
+    run = runBenchmark([0, 3], repeat=2, imageBytes=300)
+
+    assert [result["history"] for result in run["results"]] == [0, 3]
+    assert all(result["lookup"]["seconds"] > 0 and
+               result["legacy"]["seconds"] > 0
+               for result in run["results"])
+    assert run["parameters"]["image_bytes"] == 300
+    assert formatResult(run["results"][1]).split()[0] == "3"
+    assert list(Patient.objects.raw({"_id": {"$gte": MRN_BASE}})) == []
+    assert list(CPAP_Record.objects.raw({"mrn": {"$gte": MRN_BASE}})) == []
+
+
+def test_formatResult_too_large():
+
+    from cpap_db_bench import formatResult, populateLegacy
+
+    timing = {"seconds": 0.0012, "median": 0.0015, "commands": 1,
+              "bytes": 2048}
+    line = formatResult({"history": 1000, "lookup": timing, "legacy": None})
+
+    assert line.split()[:5] == ["1000", "1.200", "ms", "2.0", "KiB"]
+    assert line.endswith("too large")
+    assert populateLegacy(1, 1, 1000, 40000, None) is False
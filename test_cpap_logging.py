@@ -0,0 +1,25 @@
+import logging
+
+
+def test_configureLogging(tmp_path):
+
+    from cpap_logging import configureLogging, stopLogging
+
+    logFile = tmp_path / "analysis.log"
+    logFile.write_text("previous run\n")
+
+    listener = configureLogging(str(logFile))
+    try:
+        assert configureLogging(str(tmp_path / "other.log")) is listener
+        logging.info("Starting Analysis of: recording.txt")
+        logging.debug("not written")
+    finally:
+        stopLogging()
+
+    lines = logFile.read_text().splitlines()
+    assert lines[0] == "previous run"
+    assert len(lines) == 2
+    assert lines[1].endswith("INFO:root:Starting Analysis of: recording.txt")
+    assert not (tmp_path / "other.log").exists()
+    assert not any(isinstance(handler, logging.handlers.QueueHandler)
+                   for handler in logging.getLogger().handlers)
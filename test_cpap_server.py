@@ -1,7 +1,9 @@
 import sys
+import base64
+import hashlib
 import pytest
 from pymodm import connect
-from health_db_patient import Patient
+from health_db_patient import Patient, CPAP_Record, FlowImage
 from datetime import datetime
 import ssl
 import os
@@ -19,11 +21,30 @@ good_patient5 = {"mrn": 720, "roomNum": 401, "name": "UnitTestz",
 result1 = {"mrn": 804, "breathingRate": 27.3, "apneaCount": 8,
            "image": "abcd"}
 result2 = {"mrn": 804, "breathingRate": 22.3, "apneaCount": 2,
-           "image": "efghij"}
+           "image": "efghijkl"}
 result3 = {"mrn": 120, "breathingRate": 29.3, "apneaCount": 0,
-           "image": "jklmno"}
+           "image": "jklmnopq"}
 result4 = {"mrn": 900, "breathingRate": 97.6, "apneaCount": 8,
-           "image": "pqrstu"}
+           "image": "pqrstuvw"}
+
+
+def image_id(encoded):
+    """Image id the server gives to a base64 encoded image"""
+    return hashlib.sha256(base64.b64decode(encoded)).hexdigest()
+
+
+@pytest.fixture(scope="module")
+def database():
+    """Connects to the configured database for tests using the models
+
+    The database is the one configured by the CPAP_ environment variables,
+    so CPAP_MONGO_MOCK=1 runs these tests against mongomock, without MongoDB.
+    The configuration is returned.
+    """
+    from cpap_server import ensure_db, load_config
+    config = load_config()
+    ensure_db(config)
+    return config
 
 
 @pytest.mark.parametrize("in_dict, expected_keys, expected_types, expected", [
@@ -62,6 +83,7 @@ def test_generic_post_route_input_verification(in_dict, expected_keys,
     assert answer == expected
 
 
+@pytest.mark.usefixtures("database")
 def test_add_patient_to_database():
     # Arrange
     from cpap_server import add_patient_to_database
@@ -79,6 +101,7 @@ def test_add_patient_to_database():
     assert patient.roomNum == good_patient["roomNum"]
 
 
+@pytest.mark.usefixtures("database")
 @pytest.mark.parametrize("in_dict, expected", [
     ({"mrn": 10240, "roomNum": 32,
       "name": "Billy", "pressure": 4}, ("Patient Added", 200)),
@@ -139,6 +162,107 @@ def test_calc_Metrics_driver(in_dict, expected):
         assert status_code == expected[0]
 
 
+def test_calc_Metrics_driver_deferred_plot():
+
+    # Arrange
+    from cpap_server import calc_Metrics_driver, get_deferred_plot_driver
+    in_dict = {"fileName": os.path.join(os.getcwd(),
+                                        "sample_data/patient_01.txt")}
+    # Act
+    answer, status_code = calc_Metrics_driver(in_dict)
+    deferred, deferred_status = calc_Metrics_driver(dict(in_dict,
+                                                         plot=False))
+    plot, plot_status = get_deferred_plot_driver(deferred["plot_id"])
+    # Assert
+    assert status_code == deferred_status == plot_status == 200
+    assert deferred["encoded_plot"] is None
+    assert deferred["breath_rate_bpm"] == answer["breath_rate_bpm"]
+    assert plot["encoded_plot"] == answer["encoded_plot"]
+    assert get_deferred_plot_driver("abc") == ("Plot abc not found", 404)
+    assert calc_Metrics_driver(dict(in_dict, plot="no")) == \
+        ("plot key should be of type bool", 400)
+    assert calc_Metrics_driver(dict(in_dict, epoch=0)) == \
+        ("epoch key should be a number of at least 1 seconds", 400)
+    assert calc_Metrics_driver(dict(in_dict, profile=1)) == \
+        ("profile key should be of type bool", 400)
+    assert calc_Metrics_driver(dict(in_dict, channels="yes")) == \
+        ("channels key should be of type bool", 400)
+
+
+@pytest.mark.parametrize("size, expected", [
+    (None, 200),
+    ((475, 350), 200),
+    ((4000, 1), 200),
+    ((4001, 350), 400),
+    ((475, 100000), 400),
+    ((0, 350), 400),
+    ((-475, -350), 400),
+])
+def test_get_deferred_plot_driver_size(tmp_path, size, expected):
+
+    # Arrange
+    from cpap_server import calc_Metrics_driver, get_deferred_plot_driver
+    from test_cpap_stream import write_recording
+    in_dict = {"fileName": str(tmp_path / "recording.txt"), "plot": False}
+    write_recording(in_dict["fileName"], seconds=60)
+    deferred, status_code = calc_Metrics_driver(in_dict)
+    # Act
+    answer, status_code = get_deferred_plot_driver(deferred["plot_id"], size)
+    # Assert
+    assert status_code == expected
+    if expected == 400:
+        assert answer == "width and height should be between 1 and 4000 " \
+            "pixels"
+
+
+@pytest.mark.parametrize("epoch, expected", [
+    (30, 200),
+    (1, 200),
+    (0.5, 400),
+    (1e-9, 400),
+    (-30, 400),
+    ("30", 400),
+])
+def test_calc_Metrics_driver_epoch(tmp_path, epoch, expected):
+
+    # Arrange
+    from cpap_server import calc_Metrics_driver
+    from test_cpap_stream import write_recording
+    in_dict = {"fileName": str(tmp_path / "recording.txt"), "plot": False,
+               "epoch": epoch}
+    write_recording(in_dict["fileName"], seconds=60)
+    # Act
+    answer, status_code = calc_Metrics_driver(in_dict)
+    # Assert
+    assert status_code == expected
+    if expected == 200:
+        assert len(answer["epochs"]["start"]) == 60 // epoch
+    else:
+        assert answer == \
+            "epoch key should be a number of at least 1 seconds"
+
+
+def test_calc_Metrics_driver_profile(tmp_path):
+
+    # Arrange
+    from cpap_server import calc_Metrics_driver
+    from test_cpap_stream import write_recording
+    in_dict = {"fileName": str(tmp_path / "recording.txt"), "profile": True}
+    write_recording(in_dict["fileName"], seconds=60)
+    # Act
+    timed, timed_status = calc_Metrics_driver(in_dict)
+    traced, traced_status = calc_Metrics_driver(dict(in_dict,
+                                                     profile_memory=True))
+    # Assert
+    assert timed_status == traced_status == 200
+    assert all(stage["memory_bytes"] is None for stage in timed["profile"])
+    assert all(type(stage["memory_bytes"]) is int
+               for stage in traced["profile"])
+    assert calc_Metrics_driver(dict(in_dict, profile_memory="yes")) == \
+        ("profile_memory key should be of type bool", 400)
+
+
+@pytest.mark.usefixtures("database")
 @pytest.mark.parametrize("id_to_find, expected", [
     (good_patient["mrn"], True),
     (good_patient["mrn"] + 1, False)
@@ -155,6 +279,7 @@ def test_verify_patient_in_db(id_to_find, expected):
     db_answer.delete()
 
 
+@pytest.mark.usefixtures("database")
 def test_add_test_to_patient():
     from cpap_server import add_test_to_patient, add_patient_to_database
     # Arrange
@@ -163,21 +288,32 @@ def test_add_test_to_patient():
                 "pressure": 5,
                 "breathingRate": 22.3,
                 "apneaCount": 2,
-                "image": "fdafjalkdf"}
+                "image": "fdafjalk"}
     # Action
     answer = add_test_to_patient(out_data)
-    # Get database entry and clear
+    # Get database entries and clear
+    results = list(CPAP_Record.objects.raw({"mrn": 10304}))
+    image = FlowImage.objects.raw({"_id": results[0].flowImg}).first()
     db_answer = Patient.objects.raw({"_id": 10304}).first()
     db_answer.delete()
     # Assert
     assert answer == ("Test successfully added", 200)
-    assert len(db_answer.results) == 1
+    assert len(results) == 1
+    assert results[0].breathingRate == 22.3
+    assert results[0].flowImg == image_id("fdafjalk")
+    assert bytes(image.data) == base64.b64decode("fdafjalk")
+    assert "results" not in db_answer.to_son()
+    assert list(CPAP_Record.objects.raw({"mrn": 10304})) == []
 
 
+@pytest.mark.usefixtures("database")
 @pytest.mark.parametrize("in_data, expected", [
     ({"mrn": 10304, "pressure": 5, "breathingRate": 22.3, "apneaCount": 2,
-      "image": "fdafa"},
+      "image": "fdafaf=="},
      ("Test successfully added", 200)),
+    ({"mrn": 10304, "pressure": 5, "breathingRate": 22.3, "apneaCount": 2,
+      "image": "not base64!"},
+     ("image key should be a base64 encoded png", 400)),
     ({"pressure": 5, "breathingRate": 22.3, "apneaCount": 2, "image": "12af"},
      ("mrn key is not found in the input", 400)),
     ({"mrn": 10305, "pressure": 5, "breathingRate": 22.3, "apneaCount": 2,
@@ -191,14 +327,16 @@ def test_add_test_driver(in_data, expected):
     # Act
     answer, status_code = add_test_driver(in_data)
     # Get data from and clean database
+    results = len(list(CPAP_Record.objects.raw({"mrn": 10304})))
     patient = Patient.objects.raw({"_id": 10304}).first()
     patient.delete()
     # Assert
     assert (answer, status_code) == expected
     if status_code == 200:
-        assert len(patient.results) == 1
+        assert results == 1
 
 
+@pytest.mark.usefixtures("database")
 def test_updateInfo():
     from cpap_server import updateInfo, add_patient_to_database
     # Arrange
@@ -217,6 +355,7 @@ def test_updateInfo():
     assert db_answer.name == "billy"
 
 
+@pytest.mark.usefixtures("database")
 @pytest.mark.parametrize("in_data, expected", [
     ({"mrn": 10304, "pressure": 5, "name": 'billy'},
      ("Patient MRN 10304 Succesfully Updated", 200)),
@@ -226,6 +365,16 @@ def test_updateInfo():
      ("Patient MRN 10304 Succesfully Updated", 200)),
     ({"mrn": 10304, "pressure": None, "name": "billy"},
      ("Patient MRN 10304 Succesfully Updated", 200)),
+    ({"mrn": 10304, "pressure": "", "name": "billy"},
+     ("Patient MRN 10304 Succesfully Updated", 200)),
+    ({"mrn": 10304, "pressure": "12", "name": "billy"},
+     ("Patient MRN 10304 Succesfully Updated", 200)),
+    ({"mrn": 10304, "pressure": 0, "name": "billy"},
+     ("Patient MRN 10304 Succesfully Updated", 200)),
+    ({"mrn": 10304, "pressure": "0", "name": "billy"},
+     ("Patient MRN 10304 Succesfully Updated", 200)),
+    ({"mrn": 10304, "pressure": "high", "name": "billy"},
+     ("pressure key cannot be converted into type integer", 400)),
     ({"mrn": 10304, "pressure": 5, "name": 'billy'},
      ("Patient MRN 10304 Succesfully Updated", 200)),
     ({"pressure": 5, "breathingRate": 22.3, "apneaCount": 2, "image": "12af"},
@@ -244,8 +393,52 @@ def test_updateInfo_driver(in_data, expected):
     patient.delete()
     # Assert
     assert (answer, status_code) == expected
+    if status_code == 200:
+        pressure = in_data["pressure"]
+        assert patient.pressure == (None if pressure in (None, "")
+                                    else int(pressure))
 
 
+def test_concurrent_writers(database):
+    """
+    Tests are added and the patient information is updated from several
+    threads at once, so every result must be stored and the summary of the
+    latest result must be the newest one, whatever the order of the writes.
+    """
+    if database["MONGO_MOCK"]:
+        pytest.skip("mongomock does not apply an update to a document "
+                    "atomically")
+    from concurrent.futures import ThreadPoolExecutor
+    from cpap_server import add_patient_to_database, add_test_driver
+    from cpap_server import updateInfo_driver
+    # Arrange
+    add_patient_to_database(good_patient)
+    tests = [{"mrn": 10304, "breathingRate": float(i), "apneaCount": i,
+              "image": base64.b64encode(bytes([i])).decode()}
+             for i in range(40)]
+    updates = [{"mrn": 10304, "name": f"name{i}", "pressure": 4 + i % 20}
+               for i in range(200)]
+    # Act
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        added = [pool.submit(add_test_driver, test) for test in tests]
+        updated = list(pool.map(updateInfo_driver, updates))
+        added = [future.result() for future in added]
+    results = list(CPAP_Record.objects.raw({"mrn": 10304}))
+    patient = Patient.objects.raw({"_id": 10304}).first()
+    patient.delete()
+    # Assert
+    newest = max(result.timeStamp for result in results)
+    assert all(status == 200 for answer, status in added + updated)
+    assert sorted(result.apneaCount for result in results) == list(range(40))
+    assert patient.latest.timeStamp == newest
+    assert (patient.latest.apneaCount, patient.latest.flowImg) in {
+        (result.apneaCount, result.flowImg)
+        for result in results if result.timeStamp == newest}
+    assert patient.name in {update["name"] for update in updates}
+    assert patient.pressure in {update["pressure"] for update in updates}
+
+
+@pytest.mark.usefixtures("database")
 def test_get_used_rooms_driver():
     from cpap_server import add_patient_to_database, add_test_to_patient
     from cpap_server import get_used_rooms_driver
@@ -265,6 +458,7 @@ def test_get_used_rooms_driver():
     print(rel_vals)
     # Assert
     assert rel_vals == 3
+    assert all_rooms == sorted(set(all_rooms))
     # Clean database
     pt1_to_delete = Patient.objects.raw({"_id": 804}).first()
     pt1_to_delete.delete()
@@ -274,16 +468,17 @@ def test_get_used_rooms_driver():
     pt3_to_delete.delete()
 
 
+@pytest.mark.usefixtures("database")
 @pytest.mark.parametrize("roomnum, expected", [
     (301,
      {'mrn': 804, 'name': 'UnitTestz', 'p': 43,
-      'br': 22.3, 'ac': 2, 'img': 'efghij'}),
+      'br': 22.3, 'ac': 2, 'img': image_id('efghijkl')}),
     (302,
      {'mrn': 900, 'name': 'UnitTestz', 'p': 14,
-      'br': 97.6, 'ac': 8, 'img': 'pqrstu'}),
+      'br': 97.6, 'ac': 8, 'img': image_id('pqrstuvw')}),
     (402,
      {'mrn': 120, 'name': 'UnitTestz', 'p': 12,
-      'br': 29.3, 'ac': 0, 'img': 'jklmno'}),
+      'br': 29.3, 'ac': 0, 'img': image_id('jklmnopq')}),
     (401,
      {'mrn': 720, 'name': 'UnitTestz', 'p': 19,
       'br': 'N/A', 'ac': 'N/A', 'img': 'N/A'})])
@@ -318,6 +513,28 @@ def test_get_infofromroom_driver(roomnum, expected):
     pt4_to_delete.delete()
 
 
+@pytest.mark.usefixtures("database")
+def test_set_latest():
+    from cpap_server import add_patient_to_database, add_test_to_patient
+    from cpap_server import set_latest
+    # Arrange
+    add_patient_to_database(good_patient2)
+    add_test_to_patient(result1)
+    add_test_to_patient(result2)
+    older = CPAP_Record(mrn=804, timeStamp=datetime(2000, 1, 1),
+                        breathingRate=1.0, apneaCount=0, flowImg="old")
+    # Act
+    replaced = set_latest(804, older)
+    latest = Patient.objects.raw({"_id": 804}).first().latest
+    # Clean database
+    Patient.objects.raw({"_id": 804}).first().delete()
+    # Assert
+    assert replaced is False
+    assert latest.breathingRate == result2["breathingRate"]
+    assert latest.flowImg == image_id(result2["image"])
+
+
+@pytest.mark.usefixtures("database")
 @pytest.mark.parametrize("mrn, expected", [
     (804, True),
     (120, True),
@@ -350,6 +567,7 @@ def test_do_results_exist(mrn, expected):
     pt4_to_delete.delete()
 
 
+@pytest.mark.usefixtures("database")
 @pytest.mark.parametrize("mrn, expected", [
     (804, ('43', 200)),
     (120, ('12', 200)),
@@ -381,6 +599,7 @@ def test_get_pressure_from_mrn_driver(mrn, expected):
     pt4_to_delete.delete()
 
 
+@pytest.mark.usefixtures("database")
 @pytest.mark.parametrize("mrn, expected", [
     (804, 1),
     (120, 0),
@@ -409,14 +628,126 @@ def test_get_test_dates_driver(mrn, expected):
     pt3_to_delete.delete()
 
 
-"""
-test_get_old_img_driver() statement:
+@pytest.mark.usefixtures("database")
+def test_get_old_img_driver():
+    from cpap_server import add_patient_to_database, add_test_to_patient
+    from cpap_server import get_test_dates_driver, get_old_img_driver
+    # Arrange
+    add_patient_to_database(good_patient2)
+    add_patient_to_database(good_patient3)
+    add_test_to_patient(result1)
+    add_test_to_patient(result2)
+    old_tests = get_test_dates_driver(804)
+    # Act
+    image = get_old_img_driver("804", old_tests[0]["id"])
+    other_patient = get_old_img_driver("120", old_tests[0]["id"])
+    unknown = get_old_img_driver("804", "0123456789abcdef01234567")
+    invalid = get_old_img_driver("804", "Wed, 06 Dec 2000 22:28:27 GMT")
+    # Clean database
+    Patient.objects.raw({"_id": 804}).first().delete()
+    Patient.objects.raw({"_id": 120}).first().delete()
+    # Assert
+    missing = ("No matching image found for the given test.", 404)
+    assert len(old_tests) == 1
+    assert image == (image_id(result1["image"]), 200)
+    assert other_patient == missing
+    assert unknown == missing
+    assert invalid == missing
+
+
+@pytest.mark.usefixtures("database")
+def test_get_image():
+    from cpap_server import app, save_image
+    # Arrange
+    png = b"\x89PNG\r\n\x1a\n test image"
+    stored = save_image(png)
+    client = app.test_client()
+    # Act
+    response = client.get("/image/" + stored)
+    cached = client.get("/image/" + stored,
+                        headers={"If-None-Match": response.headers["ETag"]})
+    missing = client.get("/image/" + "0" * 64)
+    invalid = client.get("/image/abc")
+    # Clean database
+    FlowImage.objects.raw({"_id": stored}).delete()
+    # Assert
+    assert stored == hashlib.sha256(png).hexdigest()
+    assert save_image(png) == stored
+    assert response.status_code == 200
+    assert response.data == png
+    assert response.mimetype == "image/png"
+    assert response.headers["ETag"] == '"{}"'.format(stored)
+    assert "immutable" in response.headers["Cache-Control"]
+    assert cached.status_code == 304 and cached.data == b""
+    assert missing.status_code == invalid.status_code == 404
+
+
+def test_create_app_connects_lazily(monkeypatch):
+
+    # Arrange
+    from pymodm import connection
+    from cpap_server import create_app, close_db
+    calls = []
+
+    class FakeClient(dict):
+        def __init__(self, uri, **options):
+            calls.append((uri, options))
+
+        def __missing__(self, name):
+            return type("FakeDatabase", (), {"client": self, "name": name})
 
-I don't believe it is worth performing unit testing on get_old_img_driver.
-The datetime input makes it nearly impossible to test on the dummy variables
-being created to run the tests above, since these values are constantly
-updating and would change even if run at different points within the same func.
+        def close(self):
+            calls.append("closed")
+
+    monkeypatch.delitem(connection._CONNECTIONS, "default", raising=False)
+    app = create_app({"MONGO_URI": "mongodb://localhost:27017/cpapTest",
+                      "MONGO_MAX_POOL_SIZE": 7,
+                      "MONGO_SOCKET_TIMEOUT_MS": 2000,
+                      "MONGO_CLIENT_FACTORY": FakeClient})
+    # Act
+    created = list(calls)
+    first = app.test_client().get("/calcResults/plot/abc")
+    second = app.test_client().get("/calcResults/plot/abc")
+    database = connection._get_db()
+    close_db()
+    # Assert
+    assert created == []
+    assert first.status_code == second.status_code == 404
+    assert calls == [("mongodb://localhost:27017/cpapTest",
+                      {"maxPoolSize": 7, "serverSelectionTimeoutMS": 5000,
+                       "connectTimeoutMS": 5000, "socketTimeoutMS": 2000}),
+                     "closed"]
+    assert database.name == "cpapTest"
+    assert "default" not in connection._CONNECTIONS
 
-I have run the gui and showed that it is able to convert from a dataeval and
-mrn back to an image, (the image succesfully displays)
-"""
+
+def test_load_config(monkeypatch):
+
+    # Arrange
+    from cpap_server import load_config, client_options
+    monkeypatch.setenv("CPAP_MONGO_URI", "mongodb://db:27017/cpap")
+    monkeypatch.setenv("CPAP_MONGO_MAX_POOL_SIZE", "20")
+    monkeypatch.setenv("CPAP_MONGO_CONNECT_TIMEOUT_MS", "none")
+    monkeypatch.setenv("CPAP_PREWARM", "0")
+    monkeypatch.delenv("CPAP_MONGO_MOCK", raising=False)
+    # Act
+    config = load_config({"MONGO_MAX_POOL_SIZE": 50})
+    monkeypatch.setenv("CPAP_MONGO_MOCK", "1")
+    mocked = load_config()
+    monkeypatch.delenv("CPAP_MONGO_URI")
+    mocked_default = load_config()
+    # Assert
+    assert config["MONGO_URI"] == "mongodb://db:27017/cpap"
+    assert config["MONGO_MAX_POOL_SIZE"] == 50
+    assert config["MONGO_CONNECT_TIMEOUT_MS"] is None
+    assert config["PREWARM"] is False
+    assert client_options(config) == {"maxPoolSize": 50,
+                                      "serverSelectionTimeoutMS": 5000}
+    assert "ssl_cert_reqs" in client_options(load_config(
+        {"MONGO_URI": "mongodb+srv://cluster.example.net/cpap"}))
+    assert config["MONGO_MOCK"] is False
+    assert config["MONGO_CLIENT_FACTORY"] is None
+    assert mocked["MONGO_CLIENT_FACTORY"].__name__ == "MongoClient"
+    assert mocked["MONGO_URI"] == "mongodb://db:27017/cpap"
+    assert mocked_default["MONGO_URI"] == \
+        "mongodb://localhost:27017/finalProjectDB"
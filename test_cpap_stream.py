@@ -0,0 +1,136 @@
+import pytest
+import numpy as np
+from testfixtures import LogCapture
+
+
+def write_recording(path, seconds=120, rate=100, bpm=15, apnea=(40, 55)):
+    """Writes a synthetic recording whose flow follows a sine wave"""
+    t = np.arange(0, seconds, 1 / rate)
+    s = np.sin(2 * np.pi * bpm / 60 * t)
+    s[(t >= apnea[0]) & (t < apnea[1])] = 0
+    dp = 30 * s ** 2
+    ins = 5000 + np.where(s > 0, dp, 0)
+    exp = 5000 + np.where(s < 0, dp, 0)
+    with open(path, "w") as out_file:
+        out_file.write("Time,p2,ins,exp,p2b,insb,expb\n")
+        for row in zip(t, ins, exp):
+            out_file.write("{:.2f},5000,{!r},{!r},5000,5000,5000\n"
+                           .format(*row))
+        out_file.write("bad,line\n")
+
+
+@pytest.mark.parametrize("batch, engine", [
+    (500, "spline"),
+    (97, "spline"),
+    (10000, "spline"),
+    (500, "savgol")])
+def test_BreathTracker(batch, engine):
+
+    from cpap_stream import BreathTracker
+    from cpap_analyze import findPeaks
+
+    x = np.linspace(0, 8 * np.pi, 10000)
+    y = np.sin(x)
+    expected, encodedPlot = findPeaks(x, y)
+
+    tracker = BreathTracker(engine=engine)
+    found = [tracker.feed(x[i:i + batch], y[i:i + batch])
+             for i in range(0, len(x), batch)]
+    found.append(tracker.finish())
+    found = np.concatenate(found)
+
+    assert len(found) == 4
+    assert np.allclose(found, expected, atol=tracker.step)
+    assert tracker.numSamples == len(x)
+    assert np.isclose(tracker.leakage, np.trapz(y, x))
+
+
+def test_iterRecording(tmp_path):
+
+    from cpap_stream import iterRecording
+    from cpap_analyze import ValidationReport
+
+    testFile = tmp_path / "recording.txt"
+    write_recording(testFile, seconds=10)
+
+    report = ValidationReport()
+    with LogCapture():
+        chunks = list(iterRecording(testFile, chunkRows=300, report=report))
+
+    assert [len(chunk) for chunk in chunks] == [300, 300, 300, 100]
+    assert report.summary()["dropped"] == {"missing_data": 1,
+                                           "non_numerical": 0}
+
+
+def test_streamMetrics(tmp_path):
+
+    from cpap_stream import streamMetrics
+    from cpap_analyze import obtainMetrics
+
+    testFile = str(tmp_path / "recording.txt")
+    write_recording(testFile)
+
+    with LogCapture():
+        patient, expected = obtainMetrics(testFile)
+        metrics = streamMetrics(testFile, chunkRows=1000)
+
+    assert metrics["duration"] == expected["duration"]
+    assert metrics["breaths"] == expected["breaths"]
+    assert metrics["breath_rate_bpm"] == expected["breath_rate_bpm"]
+    assert metrics["apnea_count"] == expected["apnea_count"] == 1
+    assert np.isclose(metrics["leakage"], expected["leakage"])
+    assert metrics["validation"] == expected["validation"]
+    assert metrics["validation"]["sample_lines"]["missing_data"] == [12002]
+
+
+def test_LiveBreathDetector(tmp_path):
+
+    from cpap_stream import LiveBreathDetector
+    from cpap_analyze import loadRecording
+
+    testFile = tmp_path / "recording.txt"
+    write_recording(testFile)
+    with LogCapture():
+        adc, dropped = loadRecording(testFile)
+
+    detector = LiveBreathDetector()
+    events = []
+    for i in range(0, 5500, 50):
+        events += detector.addSamples(adc[i:i + 50])
+    assert detector.status()["in_apnea"]
+
+    for i in range(5500, len(adc), 50):
+        events += detector.addSamples(adc[i:i + 50])
+    events += detector.finish()
+
+    breaths = [e["time"] for e in events if e["event"] == "breath"]
+    apneas = [e for e in events if e["event"] == "apnea"]
+    status = detector.status()
+
+    assert len(breaths) == status["breaths"] == 26
+    assert len(apneas) == status["apnea_count"] == 1
+    assert 36 < apneas[0]["start"] < 40 < 55 < apneas[0]["end"] < 58
+    assert not status["in_apnea"]
+
+
+@pytest.mark.parametrize("bpm", [8, 10])
+def test_LiveBreathDetector_slow_breathing(tmp_path, bpm):
+
+    from cpap_stream import LiveBreathDetector
+    from cpap_analyze import loadRecording
+
+    testFile = tmp_path / "recording.txt"
+    write_recording(testFile, bpm=bpm, apnea=(0, 0))
+    with LogCapture():
+        adc, dropped = loadRecording(testFile)
+
+    detector = LiveBreathDetector()
+    events = []
+    in_apnea = []
+    for i in range(0, len(adc), 50):
+        events += detector.addSamples(adc[i:i + 50])
+        in_apnea.append(detector.status()["in_apnea"])
+
+    assert detector.status()["breaths"] > 0
+    assert not any(in_apnea)
+    assert not [e for e in events if e["event"] == "apnea"]
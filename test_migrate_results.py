@@ -0,0 +1,40 @@
+import base64
+import pytest
+from datetime import datetime
+from health_db_patient import Patient, CPAP_Result, CPAP_Record, FlowImage
+from test_cpap_server import database
+
+
+@pytest.mark.usefixtures("database")
+def test_migrate_results():
+    from migrate_results import migrate_results
+    # Arrange
+    stamps = [datetime(2023, 12, 6, 22, 28, 27), datetime(2023, 12, 7, 1, 2)]
+    encoded = [base64.b64encode(b"\x89PNG first").decode(), "not base64!"]
+    Patient(mrn=5501, roomNum=55, name="Legacy", pressure=7,
+            registered_timeStamp=datetime.now(),
+            results=[CPAP_Result(timeStamp=stamp, breathingRate=12.5,
+                                 apneaCount=i, flowImg=encoded[i])
+                     for i, stamp in enumerate(stamps)]).save()
+    # Act
+    dry_run = migrate_results(dry_run=True)
+    first = migrate_results()
+    second = migrate_results()
+    records = list(CPAP_Record.objects.raw({"mrn": 5501})
+                   .order_by([("timeStamp", 1)]))
+    images = [FlowImage.objects.raw({"_id": record.flowImg}).first().data
+              for record in records]
+    raw = Patient._mongometa.collection.find_one({"_id": 5501})
+    # Clean database
+    Patient.objects.raw({"_id": 5501}).first().delete()
+    # Assert
+    assert dry_run["copied"] == 2 and len(records) == 2
+    assert first == {"patients": 1, "copied": 2, "skipped": 0, "latest": 1}
+    assert second == {"patients": 0, "copied": 0, "skipped": 0, "latest": 0}
+    assert [record.timeStamp for record in records] == stamps
+    assert [record.apneaCount for record in records] == [0, 1]
+    assert [bytes(image) for image in images] == [b"\x89PNG first",
+                                                  b"not base64!"]
+    assert "results" not in raw and raw["pressure"] == 7
+    assert raw["latest"]["timeStamp"] == stamps[1]
+    assert raw["latest"]["flowImg"] == records[1].flowImg